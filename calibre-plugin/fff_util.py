@@ -33,8 +33,10 @@ def get_fff_config(url,fileform="epub",personalini=None,ini_snippet=None):
     except Exception as e:
         logger.debug("Failed trying to get ini config for url(%s): %s, using section %s instead"%(url,e,sections))
     configuration = Configuration(sections,fileform)
-    configuration.read_file(StringIO(ensure_text(get_resources("plugin-defaults.ini"))))
-    configuration.read_file(StringIO(ensure_text(personalini)))
+    ## read_text() keeps the parsed ini in a per-process cache, so
+    ## they're only parsed once per job rather than once per book.
+    configuration.read_text(get_resources("plugin-defaults.ini"),"plugin-defaults.ini")
+    configuration.read_text(personalini,"personal.ini")
     if ini_snippet:
         logger.debug("ini_snippet:\n%s"%ini_snippet)
         configuration.read_file(StringIO("[overrides]\n"+ensure_text(ini_snippet)))
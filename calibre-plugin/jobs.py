@@ -144,6 +144,8 @@ def do_download_for_worker(book,options,merge,notification=lambda x,y:x):
 
         from calibre_plugins.fanficfare_plugin.fff_util import get_fff_config
 
+        adapter = None
+        updatedata = None
         try:
             logger.info("\n\n" + ("-"*80) + " " + book['url'])
             ## No need to download at all.  Can happen now due to
@@ -230,7 +232,8 @@ def do_download_for_worker(book,options,merge,notification=lambda x,y:x):
 
                 # preserve logfile even on overwrite.
                 if 'epub_for_update' in book:
-                    adapter.logfile = get_update_data(book['epub_for_update'])[6]
+                    with get_update_data(book['epub_for_update']) as updatedata:
+                        adapter.logfile = updatedata.logfile
                     # change the existing entries id to notid so
                     # write_epub writes a whole new set to indicate overwrite.
                     if adapter.logfile:
@@ -275,6 +278,8 @@ def do_download_for_worker(book,options,merge,notification=lambda x,y:x):
                 #urlchaptercount = int(story.getMetadata('numChapters').replace(',',''))
                 # returns int adjusted for start-end range.
                 urlchaptercount = story.getChapterCount()
+                ## closed in finally, also when not written.
+                updatedata = get_update_data(book['epub_for_update'])
                 (url,
                  chaptercount,
                  adapter.oldchapters,
@@ -283,7 +288,8 @@ def do_download_for_worker(book,options,merge,notification=lambda x,y:x):
                  adapter.calibrebookmark,
                  adapter.logfile,
                  adapter.oldchaptersmap,
-                 adapter.oldchaptersdata) = get_update_data(book['epub_for_update'])[0:9]
+                 adapter.oldchaptersdata) = updatedata[0:9]
+                adapter.oldepub = book['epub_for_update']
 
                 # dup handling from fff_plugin needed for anthology updates & BG metadata.
                 if book['collision'] in (UPDATE,UPDATEALWAYS):
@@ -382,6 +388,13 @@ def do_download_for_worker(book,options,merge,notification=lambda x,y:x):
             book['icon']='dialog_error.png'
             book['status'] = _('Error')
             logger.info("Exception: %s:%s"%(book,book['comment']),exc_info=True)
+        finally:
+            ## done with the epub being updated.
+            if updatedata is not None:
+                updatedata.close()
+            ## done writing, release chapter and image temp files.
+            if adapter is not None:
+                adapter.story.close()
     return book
 
 ## calibre's columns for an existing book are passed in and injected
@@ -407,6 +420,8 @@ def inject_cal_cols(book,story,configuration):
 
             # loop a second time to set values so extra_valid_entries
             # is correct first.
+            before = dict(story.metadata_cache.counts)
             for k in book['calibre_columns'].keys():
                 v = book['calibre_columns'][k]
                 story.setMetadata(k,v['val'])
+            logger.debug("inject_cal_cols metadata cache %s"%story.metadata_cache.counts_since(before))
@@ -19,11 +19,14 @@ from __future__ import absolute_import
 import re
 import os
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import hashlib
+import threading
 
 # py2 vs py3 transition
 from ..six import text_type as unicode
 from ..six import string_types as basestring
+from ..six import ensure_binary
 from ..six.moves.urllib.parse import urlparse, parse_qs, urljoin
 
 import logging
@@ -38,22 +41,50 @@ from ..htmlheuristics import replace_br_with_p
 
 logger = logging.getLogger(__name__)
 
-from ..story import Story
+from ..story import Story, OldChapterFile
 from ..requestable import Requestable
-from ..htmlcleanup import stripHTML, decode_email
+from ..htmlcleanup import stripHTML, decode_email, remove_html_head_body, html_head_body_pattern
 from ..exceptions import InvalidStoryURL, StoryDoesNotExist, HTTPErrorFFF
+from ..epubutils import CHAPTER_KEY_VERSION, ChapterScanner
 
 # was defined here before, imported for all the adapters that still
 # expect it.
 from ..dateutils import makeDate
 
+def copy_soup(soup):
+    '''
+    Copy a soup without parsing it again.  BeautifulSoup's own
+    copy either re-parses or, with html5lib, adds an extra empty
+    html/head/body.
+    '''
+    clone = BeautifulSoup("",'html5lib')
+    clone.clear()
+    for c in soup.contents:
+        clone.append(copy.copy(c))
+    return clone
+
+## How many hashes of data parsed only once make_soup remembers, per
+## soup_cache_size.  Data seen again in that window is cached.
+SOUP_CACHE_SEEN_FACTOR = 20
+
+## CSS url()s not treated as images.
+FONT_EXTS = ('ttf','otf','woff','woff2')
+
 # quick convenience class
 class TimeKeeper(defaultdict):
     def __init__(self):
         defaultdict.__init__(self, timedelta)
+        ## image_conversion_threads add times, too.
+        self.lock = threading.Lock()
 
     def add(self, name, td):
-        self[name] = self[name] + td
+        with self.lock:
+            self[name] = self[name] + td
+
+    def count(self, name, n=1):
+        ## counts kept alongside the times, not timedeltas.
+        with self.lock:
+            self[name] = self.get(name,0) + n
 
     def __unicode__(self):
         keys = list(self.keys())
@@ -94,17 +125,23 @@ class BaseSiteAdapter(Requestable):
         self.oldchaptersdata = None
         self.oldimgs = None
         self.oldcover = None # (data of existing cover html, data of existing cover image)
+        self.oldepub = None # path or file of the epub being updated
+        self.chapter_key_base = None # see get_chapter_key()
         self.add_img_names = None
 
         self.calibrebookmark = None
         self.logfile = None
         self.ignore_chapter_url_list = None
         self.parsed_QS = None
+        self.chapter_postprocess = None # (config key, [(name, function)])
+        self.soup_cache = OrderedDict() # hash of data -> (soup, parse time)
+        self.soup_cache_seen = OrderedDict() # hashes of data parsed once, not cached
 
         self.section_url_names(self.getSiteDomain(),self.get_section_url)
 
         ## for doing some performance profiling.
         self.times = TimeKeeper()
+        self.story.times = self.times
 
         ## Save class inheritence list in metadata.  Must be added to
         ## extra_valid_entries to use.
@@ -221,6 +258,80 @@ class BaseSiteAdapter(Requestable):
         "Hook for transforming img urls in adapter"
         return imgurl
 
+    def get_chapter_key(self,index,chap,newchap):
+        '''
+        Everything a chapter's file depends on but its text: the
+        chapter's values and place in the story, and all of the
+        story's settings, since which ones change a chapter isn't
+        known for every adapter.  EpubWriter saves it with the file,
+        see epubutils.chapter_file_key().
+        '''
+        if self.chapter_key_base is None:
+            base = hashlib.sha1()
+            for part in [CHAPTER_KEY_VERSION,
+                         self.story.getMetadataRaw('version'),
+                         self.__class__.__name__,
+                         self.configuration.get_config_digest(),
+                         len(self.chapterUrls) > 1, # chapter numbers
+                         self.story.getMetadata('newforanthology')]:
+                base.update(ensure_binary(u'%s\n'%part))
+            self.chapter_key_base = base
+        key = self.chapter_key_base.copy()
+        key.update(ensure_binary(u'%s %s\n'%(index,newchap)))
+        for k in sorted(chap):
+            if k != 'html':
+                v = ensure_binary(u'%s'%chap[k])
+                key.update(ensure_binary(u'%s %d\n'%(k,len(v))))
+                key.update(v)
+        return key.hexdigest()
+
+    def get_old_chapter_file(self,old,oldkey,chapterkey,urlmap):
+        '''
+        OldChapterFile for old[oldkey] if its file in the epub being
+        updated has chapterkey and can be copied as it is, with its
+        images added like utf8FromSoup() would.  Otherwise None.
+        '''
+        if not hasattr(old,'get_chapter_file'):
+            return None
+        found = old.get_chapter_file(oldkey,chapterkey,urlmap)
+        if not found or found[1] is None:
+            return None
+        (href,text) = found
+        if self.getConfig('include_images') == 'true' and \
+                not self.add_old_chapter_imgs(text):
+            return None
+        return OldChapterFile(href)
+
+    def add_old_chapter_imgs(self,text):
+        '''
+        Add the images of an old chapter's xhtml to the story in the
+        same order utf8FromSoup() would.  False if any come out
+        different from what the chapter has.
+        '''
+        scanner = ChapterScanner()
+        scanner.scan(text)
+        coverexclusion = self.getConfig('cover_exclusion_regexp')
+        for (src,longdesc) in scanner.img_srcs:
+            ## EpubUpdateData.make_chapter_soup() swaps longdesc in.
+            url = src
+            if longdesc and not src.startswith('data:image') and not src.startswith('failedtoload'):
+                url = longdesc
+            (newsrc,newlongdesc) = self.story.addImgUrl(None,self.img_url_trans(url),self.get_request_raw,
+                                                        coverexclusion=coverexclusion)
+            if newsrc != src or (newlongdesc and newlongdesc != longdesc):
+                return False
+        for style in scanner.style_attrs + scanner.style_tags:
+            for style_url in self.css_url_list(style):
+                if self.is_additional_image(style_url) or \
+                        style_url.rsplit('.')[-1].lower() in FONT_EXTS:
+                    continue
+                (newsrc,newlongdesc) = self.story.addImgUrl(None,self.img_url_trans(style_url),
+                                                            self.get_request_raw,
+                                                            coverexclusion=r'.')
+                if newsrc != style_url:
+                    return False
+        return True
+
     # Does the download the first time it's called.
     def getStory(self, notification=lambda x,y:x):
         if not self.storyDone:
@@ -228,7 +339,20 @@ class BaseSiteAdapter(Requestable):
 
             ## one-off step to normalize old chapter URLs if present.
             if self.oldchaptersmap:
-                self.oldchaptersmap = dict((self.normalize_chapterurl(key), value) for (key, value) in self.oldchaptersmap.items())
+                if hasattr(self.oldchaptersmap,'map_urls'):
+                    ## from EpubUpdateData, don't make all the soups now.
+                    self.oldchaptersmap = self.oldchaptersmap.map_urls(self.normalize_chapterurl)
+                else:
+                    self.oldchaptersmap = dict((self.normalize_chapterurl(key), value) for (key, value) in self.oldchaptersmap.items())
+
+            urlmap = None
+            if self.oldepub and self.getConfig('internalize_text_links'):
+                ## chapter url -> file name, like EpubWriter's
+                ## chapurlmap, to tell if old chapters' links change.
+                urlmap = dict( (chap['url'],"file%04d.xhtml"%(index+1))
+                               for (index, chap) in enumerate(self.chapterUrls)
+                               if not ( (self.chapterFirst!=None and index < self.chapterFirst) or
+                                        (self.chapterLast!=None and index > self.chapterLast) ) )
 
             percent = 0.0
             per_step = 1.0/self.story.getChapterCount()
@@ -248,43 +372,53 @@ class BaseSiteAdapter(Requestable):
                 url="chapter url removed due to failure"
                 return data, title, url
 
-            for index, chap in enumerate(self.chapterUrls):
-                title = chap['title']
-                url = chap['url']
-                #logger.debug("index:%s"%index)
-                newchap = False
-                passchap = dict(chap)
-                if (self.chapterFirst!=None and index < self.chapterFirst) or \
-                        (self.chapterLast!=None and index > self.chapterLast):
-                    passchap['html'] = None
-                else:
-                    data = None
-                    if self.oldchaptersmap:
-                        if url in self.oldchaptersmap:
-                            # logger.debug("index:%s title:%s url:%s"%(index,title,url))
-                            # logger.debug(self.oldchaptersmap[url])
-                            data = self.utf8FromSoup(None,
-                                                     self.oldchaptersmap[url])
-                    elif self.oldchapters and index < len(self.oldchapters):
-                        data = self.utf8FromSoup(None,
-                                                 self.oldchapters[index])
-
-                    if self.getConfig('mark_new_chapters') == 'true':
-                        # if already marked new -- ie, origtitle and title don't match
-                        # logger.debug("self.oldchaptersdata[url]:%s"%(self.oldchaptersdata[url]))
-                        newchap = (self.oldchaptersdata is not None and
-                                   url in self.oldchaptersdata and (
-                                self.oldchaptersdata[url]['chapterorigtitle'] !=
-                                self.oldchaptersdata[url]['chaptertitle']) )
-
-                    try:
-                        if not data:
-                            if( self.getConfig('continue_on_chapter_error') and
-                                continue_on_chapter_error_try_limit > 0 and # for -1 == infinite
-                                self.story.chapter_error_count >= continue_on_chapter_error_try_limit ):
-                                logger.info("continue_on_chapter_error: (%s) continue_on_chapter_error_try_limit(%s) exceeded"%(url,continue_on_chapter_error_try_limit))
-                                self.story.chapter_error_count += 1
-                                data, title, url = do_error_chapter("""<div>
+            try:
+                for index, chap in enumerate(self.chapterUrls):
+                    title = chap['title']
+                    url = chap['url']
+                    #logger.debug("index:%s"%index)
+                    newchap = False
+                    key = None
+                    passchap = dict(chap)
+                    if (self.chapterFirst!=None and index < self.chapterFirst) or \
+                            (self.chapterLast!=None and index > self.chapterLast):
+                        passchap['html'] = None
+                    else:
+                        if self.getConfig('mark_new_chapters') == 'true':
+                            # if already marked new -- ie, origtitle and title don't match
+                            # logger.debug("self.oldchaptersdata[url]:%s"%(self.oldchaptersdata[url]))
+                            newchap = (self.oldchaptersdata is not None and
+                                       url in self.oldchaptersdata and (
+                                    self.oldchaptersdata[url]['chapterorigtitle'] !=
+                                    self.oldchaptersdata[url]['chaptertitle']) )
+
+                        data = None
+                        old = None
+                        if self.oldchaptersmap:
+                            if url in self.oldchaptersmap:
+                                # logger.debug("index:%s title:%s url:%s"%(index,title,url))
+                                (old, oldkey) = (self.oldchaptersmap, url)
+                        elif self.oldchapters and index < len(self.oldchapters):
+                            (old, oldkey) = (self.oldchapters, index)
+                        if old is not None:
+                            if self.oldepub and not (index == 0 and self.getConfig('always_reload_first_chapter')):
+                                ## copy the old chapter file as it is
+                                ## if it would come out the same.
+                                data = self.get_old_chapter_file(old,oldkey,
+                                                                 self.get_chapter_key(index,passchap,newchap),
+                                                                 urlmap)
+                            if not data:
+                                data = self.utf8FromSoup(None,old[oldkey])
+
+                        error_count = self.story.chapter_error_count
+                        try:
+                            if not data:
+                                if( self.getConfig('continue_on_chapter_error') and
+                                    continue_on_chapter_error_try_limit > 0 and # for -1 == infinite
+                                    self.story.chapter_error_count >= continue_on_chapter_error_try_limit ):
+                                    logger.info("continue_on_chapter_error: (%s) continue_on_chapter_error_try_limit(%s) exceeded"%(url,continue_on_chapter_error_try_limit))
+                                    self.story.chapter_error_count += 1
+                                    data, title, url = do_error_chapter("""<div>
 <p><b>Error</b></p>
 <p>FanFicFare didn't try to download this chapter, due to earlier chapter errors.</p><p>
 Because <b>continue_on_chapter_error:true</b> is set, processing continued, but because
@@ -292,45 +426,57 @@ Because <b>continue_on_chapter_error:true</b> is set, processing continued, but
 try to download.</p>
 <p>Chapter URL:<br><a href="%s">%s</a></p>
 </div>"""%(continue_on_chapter_error_try_limit,url,url),title)
-                            else:
+                                else:
+                                    data = self.getChapterTextNum(url,index)
+                                    # if had to fetch and has existing chapters
+                                    newchap = bool(self.oldchapters or self.oldchaptersmap)
+
+                            if index == 0 and self.getConfig('always_reload_first_chapter'):
                                 data = self.getChapterTextNum(url,index)
-                                # if had to fetch and has existing chapters
-                                newchap = bool(self.oldchapters or self.oldchaptersmap)
-
-                        if index == 0 and self.getConfig('always_reload_first_chapter'):
-                            data = self.getChapterTextNum(url,index)
-                            # first chapter is rarely marked new
-                            # anyway--only if it's replaced during an
-                            # update.
-                            newchap = False
-                    except Exception as e:
-                        if self.getConfig('continue_on_chapter_error',False):
-                            logger.info("continue_on_chapter_error: (%s) %s"%(url,e))
-                            logger.debug(traceback.format_exc())
-                            self.story.chapter_error_count += 1
-                            data, title, url = do_error_chapter("""<div>
+                                # first chapter is rarely marked new
+                                # anyway--only if it's replaced during an
+                                # update.
+                                newchap = False
+                        except Exception as e:
+                            if self.getConfig('continue_on_chapter_error',False):
+                                logger.info("continue_on_chapter_error: (%s) %s"%(url,e))
+                                logger.debug(traceback.format_exc())
+                                self.story.chapter_error_count += 1
+                                data, title, url = do_error_chapter("""<div>
 <p><b>Error</b></p>
 <p>FanFicFare failed to download this chapter.  Because
 <b>continue_on_chapter_error</b> is set to <b>true</b>, the download continued.</p>
 <p>Chapter URL:<br><a href="%s">%s</a></p>
 <p>Error:<br><pre>%s</pre></p>
 </div>"""%(url,url,traceback.format_exc().replace("&","&amp;").replace(">","&gt;").replace("<","&lt;")),title)
-                        else:
-                            raise
-
-                    percent += per_step
-                    notification(percent,self.url)
-                    passchap['url'] = url
-                    passchap['title'] = title
-                    passchap['html'] = data
-                    ## XXX -- add chapter text replacement here?
-                    ## No?  Want to be able to configure by [writer]
-                    ## It's a soup or soup part?
-                self.story.addChapter(passchap, newchap)
+                            else:
+                                raise
+
+                        percent += per_step
+                        notification(percent,self.url)
+                        passchap['url'] = url
+                        passchap['title'] = title
+                        passchap['html'] = data
+                        ## XXX -- add chapter text replacement here?
+                        ## No?  Want to be able to configure by [writer]
+                        ## It's a soup or soup part?
+                        ## error chapters aren't kept for next update.
+                        if self.story.chapter_error_count == error_count:
+                            key = self.get_chapter_key(index,passchap,newchap)
+                    self.story.addChapter(passchap, newchap, key=key)
+            finally:
+                ## also when a chapter fails, don't leave the pool's
+                ## threads running.
+                self.story.close_image_pool()
+                ## done reading old chapters from the epub being updated.
+                for old in (self.oldchapters, self.oldchaptersmap):
+                    if hasattr(old,'close'):
+                        old.close()
             self.storyDone = True
 
             # copy oldcover tuple to story.
             self.story.oldcover = self.oldcover
+            self.story.oldepub = self.oldepub
 
             # include image, but no cover from story, add default_cover_image cover.
             if self.getConfig('include_images'):
@@ -671,18 +817,38 @@ try to download.</p>
             self.add_img_names = [ "images/"+os.path.basename(imgfn) for imgfn in self.getConfigList('additional_images') ]
         return url in self.add_img_names
 
+    def css_url_list(self,style):
+        ## url(href)
+        ## url("href")
+        ## url('href')
+        ## the pattern will also accept mismatched '/", which is broken CSS.
+        return re.findall(r'url\([\'"]?(.*?)[\'"]?\)', style)
+
+    def prefetch_chapter_imgs(self,url,soup,fetch):
+        ## image_prefetch_threads: fetch all the chapter's <img> and
+        ## CSS url() images at once before they're added one by one.
+        urls = []
+        for img in soup.find_all('img'):
+            if img.has_attr('src'):
+                urls.append((self.img_url_trans(img['src']),fetch))
+        styles = [ inline['style'] for inline in soup.select('*[style]') if inline.contents ]
+        styles.extend([ embedded.string for embedded in soup.select('style') if embedded.string ])
+        for style in styles:
+            for style_url in self.css_url_list(style):
+                if not self.is_additional_image(style_url) and \
+                        style_url.rsplit('.')[-1].lower() not in FONT_EXTS:
+                    urls.append((self.img_url_trans(style_url),self.get_request_raw))
+        start = datetime.now()
+        self.story.prefetch_img_urls(url,urls)
+        self.times.add("utf8FromSoup->prefetch images", datetime.now() - start)
+
     def include_css_urls(self,parenturl,style):
-        FONT_EXTS = ('ttf','otf','woff','woff2')
         # logger.debug("include_css_urls(%s,%s)"%(parenturl,style))
         ## pass in the style string, will be returned with URLs
         ## replaced and images will be added.
         newstyle = style
         if 'url(' in style:
-            ## url(href)
-            ## url("href")
-            ## url('href')
-            ## the pattern will also accept mismatched '/", which is broken CSS.
-            for style_url in re.findall(r'url\([\'"]?(.*?)[\'"]?\)', style):
+            for style_url in self.css_url_list(style):
                 ## additional_images don't get processing.  Applies
                 ## only to CSS url(), that should be the only time
                 ## additional_images is used.
@@ -777,27 +943,42 @@ try to download.</p>
         if self.getConfig('include_images') == 'true': # not false or coveronly
             ## actually effects all tags' attrs, not just <img>, but I'm okay with that.
             acceptable_attributes.extend(('src','alt','longdesc'))
-            for img in soup.find_all('img'):
-                try:
-                    # some pre-existing epubs have img tags that had src stripped off.
-                    if img.has_attr('src'):
-                        (img['src'],longdesc)=self.story.addImgUrl(url,self.img_url_trans(img['src']),fetch,
-                                                                   coverexclusion=self.getConfig('cover_exclusion_regexp'))
+            try:
+                if self.getConfig('image_prefetch_threads'):
+                    self.prefetch_chapter_imgs(url,soup,fetch)
+                ## images may be converted in image_conversion_threads
+                ## while the rest are fetched.
+                pending = []
+                for img in soup.find_all('img'):
+                    try:
+                        # some pre-existing epubs have img tags that had src stripped off.
+                        if img.has_attr('src'):
+                            pending.append((img,self.story.addImgUrl(url,self.img_url_trans(img['src']),fetch,
+                                                                     coverexclusion=self.getConfig('cover_exclusion_regexp'),
+                                                                     pending=True)))
+                    except AttributeError as ae:
+                        logger.info("Parsing for img tags failed--probably poor input HTML.  Skipping img(%s)"%img)
+                for (img,finish) in pending:
+                    try:
+                        (img['src'],longdesc)=finish()
                         if longdesc:
                             # logger.debug("---set longdesc:%s"%longdesc)
                             img['longdesc'] = longdesc
-                except AttributeError as ae:
-                    logger.info("Parsing for img tags failed--probably poor input HTML.  Skipping img(%s)"%img)
-            ## Inline CSS url() images
-            for inline in soup.select('*[style]'):
-                # Only if there's something in that tag.  mostly for
-                # empty <span style=> where media embed failed on XF
-                # sites.  Prevents including unseeable images.
-                if inline.contents:
-                    inline['style'] = self.include_css_urls(url,inline['style'])
-            ## Embedded CSS <style> tag url() images
-            for embedded in soup.select('style'):
-                embedded.string = self.include_css_urls(url,embedded.string)
+                    except AttributeError as ae:
+                        logger.info("Parsing for img tags failed--probably poor input HTML.  Skipping img(%s)"%img)
+                ## Inline CSS url() images
+                for inline in soup.select('*[style]'):
+                    # Only if there's something in that tag.  mostly for
+                    # empty <span style=> where media embed failed on XF
+                    # sites.  Prevents including unseeable images.
+                    if inline.contents:
+                        inline['style'] = self.include_css_urls(url,inline['style'])
+                ## Embedded CSS <style> tag url() images
+                for embedded in soup.select('style'):
+                    embedded.string = self.include_css_urls(url,embedded.string)
+            finally:
+                ## prefetched images not used by this chapter.
+                self.story.clear_prefetched_imgs()
         elif self.getConfig('keep_img_tags'):
             logger.debug("keep_img_tags")
             ## keep <img>s normalize src attrs.
@@ -923,52 +1104,146 @@ try to download.</p>
 
         retval = unicode(soup)
 
-        if self.getConfig('nook_img_fix') and not self.getConfig('replace_br_with_p'):
+        for (name, stage) in self.get_chapter_postprocess():
+            if name == 'replace_br_with_p' and not allow_replace_br_with_p:
+                continue
+            start = datetime.now()
+            retval = stage(retval)
+            self.times.add("utf8FromSoup->"+name, datetime.now() - start)
+
+        return retval
+
+    def get_chapter_postprocess(self):
+        '''
+        Returns a list of (name, function) stages that
+        _do_utf8FromSoup applies in order to the chapter text after
+        it's been turned back into a string.  Built once from config
+        with the regexps compiled and kept until those config values
+        change.
+        '''
+        key = (self.getConfig('nook_img_fix'),
+               self.getConfig('replace_br_with_p'),
+               self.getConfig('replace_xbr_with_hr',default=0),
+               self.getConfig('replace_hr'),
+               self.getConfig('remove_empty_p'))
+        if self.chapter_postprocess is None or self.chapter_postprocess[0] != key:
+            self.chapter_postprocess = (key,self.make_chapter_postprocess(*key))
+        return self.chapter_postprocess[1]
+
+    def make_chapter_postprocess(self,nook_img_fix,br_with_p,xbr,hr,empty_p):
+        stages = []
+
+        if nook_img_fix and not br_with_p:
             # if the <img> tag doesn't have a div or a p around it,
             # nook gets confused and displays it on every page after
             # that under the text for the rest of the chapter.
-            retval = re.sub(r"(?!<(div|p)>)\s*(?P<imgtag><img[^>]+>)\s*(?!</(div|p)>)",
-                            r"<div>\g<imgtag></div>",retval)
-
-        # Don't want html, head or body tags in chapter html--writers add them.
-        # This is primarily for epub updates.
-        retval = re.sub(r"</?(html|head|body)[^>]*>\r?\n?","",retval)
+            # Done in the same pass as removing html, head and body
+            # tags below, the two can't match the same text.
+            nook_re = re.compile(r"(?!<(?:div|p)>)\s*(?P<imgtag><img[^>]+>)\s*(?!</(?:div|p)>)|"
+                                 +html_head_body_pattern)
+            def nook_repl(m):
+                if m.group('imgtag'):
+                    return "<div>%s</div>"%m.group('imgtag')
+                return ""
+            stages.append(('nook_img_fix',partial(nook_re.sub,nook_repl)))
+        else:
+            # Don't want html, head or body tags in chapter html--writers add them.
+            # This is primarily for epub updates.
+            stages.append(('remove_html_head_body',remove_html_head_body))
 
         try:
-            xbr = int(self.getConfig("replace_xbr_with_hr",default=0))
+            xbr = int(xbr)
             if xbr > 0:
-                start = datetime.now()
-                retval = re.sub(r'(\s*<br[^>]*>\s*){%d,}'%xbr,
-                                '<br/>\n<br/>\n<hr/>\n<br/>',retval)
-                self.times.add("utf8FromSoup->replace_xbr_with_hr", datetime.now() - start)
+                xbr_re = re.compile(r'(\s*<br[^>]*>\s*){%d,}'%xbr)
+                stages.append(('replace_xbr_with_hr',
+                               partial(xbr_re.sub,'<br/>\n<br/>\n<hr/>\n<br/>')))
         except:
-            logger.debug("Ignoring non-int replace_xbr_with_hr(%s)"%self.getConfig("replace_xbr_with_hr"))
+            logger.debug("Ignoring non-int replace_xbr_with_hr(%s)"%xbr)
 
-        if self.getConfig("replace_br_with_p") and allow_replace_br_with_p:
+        if br_with_p:
             # Apply heuristic processing to replace <br> paragraph
-            # breaks with <p> tags.
-            start = datetime.now()
-            retval = replace_br_with_p(retval)
-            self.times.add("utf8FromSoup->replace_br_with_p", datetime.now() - start)
-
-        if self.getConfig('replace_hr'):
-            # replacing a self-closing tag with a container tag in the
-            # soup is more difficult than it first appears.  So cheat.
-            retval = re.sub("<hr[^>]*>","<div class='center'>* * *</div>",retval)
-
-        if self.getConfig('remove_empty_p'):
-            # Remove <p> tags that contain only whitespace and/or <br>
-            # tags.  Generally for AO3/OTW because their document
-            # converter tends to add them where not intended.
-            retval = re.sub(r"<p[^>]*>\s*(\s*<br ?/?>\s*)*\s*</p>","",retval)
-
-        return retval
+            # breaks with <p> tags.  Skipped when
+            # allow_replace_br_with_p is False.
+            stages.append(('replace_br_with_p',replace_br_with_p))
+
+        # replace_hr: replacing a self-closing tag with a container
+        # tag in the soup is more difficult than it first appears.
+        # So cheat.
+        # remove_empty_p: Remove <p> tags that contain only
+        # whitespace and/or <br> tags.  Generally for AO3/OTW because
+        # their document converter tends to add them where not
+        # intended.
+        # Can be done in one pass when both are on--an <hr> can't be
+        # inside an empty <p>.
+        hr_pattern = r"(?P<hr><hr[^>]*>)"
+        empty_p_pattern = r"<p[^>]*>\s*(?:\s*<br ?/?>\s*)*\s*</p>"
+        if hr and empty_p:
+            hr_p_re = re.compile(hr_pattern+"|"+empty_p_pattern)
+            def hr_p_repl(m):
+                if m.group('hr'):
+                    return "<div class='center'>* * *</div>"
+                return ""
+            stages.append(('replace_hr+remove_empty_p',partial(hr_p_re.sub,hr_p_repl)))
+        elif hr:
+            stages.append(('replace_hr',partial(re.compile(hr_pattern).sub,
+                                                "<div class='center'>* * *</div>")))
+        elif empty_p:
+            stages.append(('remove_empty_p',partial(re.compile(empty_p_pattern).sub,"")))
+
+        return stages
 
     def make_soup(self,data):
         '''
         Convenience method for getting a bs4 soup.  bs3 has been removed.
+
+        Soups of data seen before are kept in a small LRU cache keyed
+        by a hash of data, see soup_cache_size.  Soups from the cache
+        are new copies, so callers are free to change them.  Data seen
+        for the first time is just parsed and returned--most pages
+        are only parsed once and copying isn't free.
         '''
+        try:
+            cachesize = int(self.getConfig('soup_cache_size',5))
+        except ValueError:
+            logger.warning("soup_cache_size(%s) is not a number, not caching soups."%self.getConfig('soup_cache_size'))
+            cachesize = 0
+        if cachesize < 1:
+            return self._do_make_soup(data)
+
+        key = hashlib.sha1(ensure_binary(data)).digest()
+        if key in self.soup_cache:
+            start = datetime.now()
+            # pop and re-add to make most recently used.
+            (soup,parsetime) = self.soup_cache.pop(key)
+            self.soup_cache[key] = (soup,parsetime)
+            retval = copy_soup(soup)
+            self.times.add("make_soup->cache saved", parsetime - (datetime.now() - start))
+            self.times.count("make_soup->cache hits")
+            return retval
 
+        start = datetime.now()
+        soup = self._do_make_soup(data)
+        parsetime = datetime.now() - start
+        self.times.add("make_soup->parse", parsetime)
+        self.times.count("make_soup->parses")
+        if key not in self.soup_cache_seen:
+            ## first time, remember the hash, but don't keep a copy.
+            self._soup_cache_seen(key,cachesize)
+            return soup
+        del self.soup_cache_seen[key]
+        self.soup_cache[key] = (soup,parsetime)
+        while len(self.soup_cache) > cachesize:
+            ## evicted soups were wanted more than once, cache them
+            ## again if they come back.
+            self._soup_cache_seen(self.soup_cache.popitem(last=False)[0],cachesize)
+        return copy_soup(soup)
+
+    def _soup_cache_seen(self,key,cachesize):
+        self.soup_cache_seen[key] = True
+        while len(self.soup_cache_seen) > cachesize*SOUP_CACHE_SEEN_FACTOR:
+            self.soup_cache_seen.popitem(last=False)
+
+    def _do_make_soup(self,data):
         ## html5lib handles <noscript> oddly.  See:
         ## https://bugs.launchpad.net/beautifulsoup/+bug/1277464 This
         ## should 'hide' and restore <noscript> tags.  Need to do
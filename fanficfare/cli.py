@@ -17,7 +17,6 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
-from io import StringIO
 from optparse import OptionParser, SUPPRESS_HELP
 from os.path import expanduser, join, dirname
 from subprocess import call
@@ -485,29 +484,32 @@ def do_download(arg,
                 # update now handled by pre-populating the old
                 # images and chapters in the adapter rather than
                 # merging epubs.
-                (url,
-                 chaptercount,
-                 adapter.oldchapters,
-                 adapter.oldimgs,
-                 adapter.oldcover,
-                 adapter.calibrebookmark,
-                 adapter.logfile,
-                 adapter.oldchaptersmap,
-                 adapter.oldchaptersdata) = (get_update_data(output_filename))[0:9]
-
-                print('Do update - epub(%d) vs url(%d)' % (chaptercount, urlchaptercount))
-
-                if not update_story and chaptercount == urlchaptercount and adapter.getConfig('do_update_hook'):
-                    adapter.hookForUpdates(chaptercount)
-
-                if adapter.getConfig('pre_process_safepattern'):
-                    metadata = adapter.story.get_filename_safe_metadata(pattern=adapter.getConfig('pre_process_safepattern'))
-                else:
-                    metadata = adapter.story.getAllMetadata()
-                call(string.Template(adapter.getConfig('pre_process_cmd')).substitute(metadata), shell=True)
+                ## the old epub is read from until the story is written.
+                with get_update_data(output_filename) as updatedata:
+                    (url,
+                     chaptercount,
+                     adapter.oldchapters,
+                     adapter.oldimgs,
+                     adapter.oldcover,
+                     adapter.calibrebookmark,
+                     adapter.logfile,
+                     adapter.oldchaptersmap,
+                     adapter.oldchaptersdata) = updatedata[0:9]
+                    adapter.oldepub = output_filename
+
+                    print('Do update - epub(%d) vs url(%d)' % (chaptercount, urlchaptercount))
+
+                    if not update_story and chaptercount == urlchaptercount and adapter.getConfig('do_update_hook'):
+                        adapter.hookForUpdates(chaptercount)
+
+                    if adapter.getConfig('pre_process_safepattern'):
+                        metadata = adapter.story.get_filename_safe_metadata(pattern=adapter.getConfig('pre_process_safepattern'))
+                    else:
+                        metadata = adapter.story.getAllMetadata()
+                    call(string.Template(adapter.getConfig('pre_process_cmd')).substitute(metadata), shell=True)
 
-                output_filename = write_story(configuration, adapter, 'epub',
-                                              nooutput=options.nooutput)
+                    output_filename = write_story(configuration, adapter, 'epub',
+                                                  nooutput=options.nooutput)
 
         else:
             if not options.metaonly and adapter.getConfig('pre_process_cmd'):
@@ -563,6 +565,8 @@ def do_download(arg,
         if adapter.story.chapter_error_count > 0:
             warn("===================\n!!!! %s chapters errored downloading %s !!!!\n==================="%(adapter.story.chapter_error_count,
                                                         url))
+        ## done writing, release chapter and image temp files.
+        adapter.story.close()
         del adapter
 
     except exceptions.InvalidStoryURL as isu:
@@ -599,9 +603,9 @@ def get_configuration(url,
     xdgpath = join(xdgpath, 'fanficfare')
 
     if passed_defaultsini:
-        # new StringIO each time rather than pass StringIO and rewind
-        # for case of list download.  Just makes more sense to me.
-        configuration.read_file(StringIO(unicode(passed_defaultsini)))
+        # parsed once and then copied from a cache for each URL in
+        # case of list download.
+        configuration.read_text(unicode(passed_defaultsini))
     else:
         # don't need to check existance for our selves.
         conflist.append(join(dirname(__file__), 'defaults.ini'))
@@ -611,9 +615,9 @@ def get_configuration(url,
         conflist.append('defaults.ini')
 
     if passed_personalini:
-        # new StringIO each time rather than pass StringIO and rewind
-        # for case of list download.  Just makes more sense to me.
-        configuration.read_file(StringIO(unicode(passed_personalini)))
+        # parsed once and then copied from a cache for each URL in
+        # case of list download.
+        configuration.read_text(unicode(passed_personalini))
 
     conflist.append(join(homepath, 'personal.ini'))
     conflist.append(join(homepath2, 'personal.ini'))
@@ -17,8 +17,12 @@
 
 from __future__ import absolute_import
 import sys
+import os
 import re
 import codecs
+import hashlib
+from io import StringIO
+from collections import OrderedDict
 
 # py2 vs py3 transition
 from . import six
@@ -34,6 +38,7 @@ if not hasattr(ConfigParser, 'read_file'):
     ConfigParser.read_file = ConfigParser.readfp
 
 from .six import string_types as basestring
+from .six import ensure_binary, ensure_text
 
 import logging
 logger = logging.getLogger(__name__)
@@ -352,6 +357,7 @@ def get_valid_keywords():
                  'browser_cache_age_limit',
                  'chapter_end',
                  'chapter_start',
+                 'chapter_store_max_memory',
                  'chapter_title_add_pattern',
                  'chapter_title_addnew_pattern',
                  'chapter_title_def_pattern',
@@ -374,6 +380,7 @@ def get_valid_keywords():
                  'default_cover_image',
                  'description_limit',
                  'epub_version',
+                 'epub_write_threads',
                  'exclude_editor_signature',
                  'exclude_notes',
                  'notelabel_authorheadnotes',
@@ -410,6 +417,12 @@ def get_valid_keywords():
                  'https_proxy',
                  'ignore_chapter_url_list',
                  'image_max_size',
+                 'image_conversion_threads',
+                 'converted_image_cache_dir',
+                 'converted_image_cache_size',
+                 'image_prefetch_threads',
+                 'image_prefetch_per_host',
+                 'image_store_max_memory',
                  'include_subject_tags',
                  'join_string_authorHTML',
                  'keep_empty_tags',
@@ -448,6 +461,7 @@ def get_valid_keywords():
                  'skip_threadmarks_categories',
                  'slow_down_sleep_time',
                  'sort_ships_splits',
+                 'soup_cache_size',
                  'strip_chapter_numeral',
                  'threadmark_category_order',
                  'threadmarks_per_page',
@@ -466,6 +480,7 @@ def get_valid_keywords():
                  'website_encodings',
                  'wide_titlepage_entries',
                  'wrap_width',
+                 'zip_compression_levels',
                  'zip_filename',
                  'zip_output'
                  ]
@@ -557,6 +572,20 @@ def make_generate_cover_settings(param):
     return vlist
 
 
+## Parsed INI sources, see Configuration._read_snapshot().  Key ->
+## (sections, defaults, linenos)
+INI_SNAPSHOTS_SIZE = 20
+_ini_snapshots = OrderedDict()
+
+def _meta_entries_property(name):
+    ## For Configuration.validEntries & co, setting one clears the
+    ## cached meta entry sets.
+    attr = '_'+name
+    def set_entries(self,entries):
+        setattr(self,attr,entries)
+        self.reset_meta_entry_sets()
+    return property(lambda self : getattr(self,attr),set_entries)
+
 class Configuration(ConfigParser):
 
     def __init__(self, sections, fileform, lightweight=False,
@@ -616,10 +645,49 @@ class Configuration(ConfigParser):
         self.reset_cached_config()
 
     def reset_cached_config(self):
-        ## should argubly be called by read_file, etc, but there's
-        ## several read methods.  Revisit if ever needed from more
-        ## than just calibre-plugin/jobs.py:inject_cal_cols()
+        ## Called by set(), add_section(), addConfigSection(), etc.
+        ## The read methods that go through _read() or
+        ## _merge_snapshot() also call it.
         self.cached_config = {}
+        ## getConfig()/hasConfig() on sectionslist:
+        ## key -> resolved value
+        self.resolved_config = {}
+        ## key -> add_to_key values when key isn't set.
+        self.unset_config = {}
+        ## option name -> sections in sectionslist that have it.
+        self.config_index = None
+        ## see get_config_digest()
+        self.config_digest = None
+        self.reset_meta_entry_sets()
+
+    def reset_meta_entry_sets(self):
+        ## Called by reset_cached_config() and when validEntries,
+        ## immutableEntries or listTypeEntries are set.  Call it after
+        ## changing one of them in place.
+        ## (valid list, valid set, immutable set, list type set)
+        self.meta_entry_sets = None
+
+    validEntries = _meta_entries_property('validEntries')
+    immutableEntries = _meta_entries_property('immutableEntries')
+    listTypeEntries = _meta_entries_property('listTypeEntries')
+
+    ## Anything that changes sections or values has to clear the
+    ## cached config.
+    def set(self, section, option, value=None):
+        ConfigParser.set(self, section, option, value)
+        self.reset_cached_config()
+
+    def add_section(self, section):
+        ConfigParser.add_section(self, section)
+        self.reset_cached_config()
+
+    def remove_section(self, section):
+        self.reset_cached_config()
+        return ConfigParser.remove_section(self, section)
+
+    def remove_option(self, section, option):
+        self.reset_cached_config()
+        return ConfigParser.remove_option(self, section, option)
 
     def section_url_names(self,domain,section_url_f):
         ## domain is passed as a method to limit the damage if/when an
@@ -631,6 +699,7 @@ class Configuration(ConfigParser):
             ## a section would mess up the order.
             ## assumes _dict and _sections from ConfigParser parent.
             self._sections = self._dict((section_url_f(k) if (domain in k and 'http' in k) else k, v) for k, v in six.viewitems(self._sections))
+            self.reset_cached_config()
             # logger.debug(self._sections.keys())
         except Exception as e:
             logger.warning("Failed to perform section_url_names: %s"%e)
@@ -640,6 +709,7 @@ class Configuration(ConfigParser):
             # replace if already set once.
             if self.url_config_set:
                 self.sectionslist[self.sectionslist.index('overrides')+1]=url
+                self.reset_cached_config()
             else:
                 self.addConfigSection(url,'overrides')
                 self.url_config_set=True
@@ -652,27 +722,83 @@ class Configuration(ConfigParser):
                 ## because sectionslist is hi-pri first, lo-pri last,
                 ## 'before' means after in the list.
                 self.sectionslist.insert(self.sectionslist.index(before)+1,section)
+            self.reset_cached_config()
+
+    def get_meta_entry_sets(self):
+        if self.meta_entry_sets is None:
+            validlist = self.validEntries + self.getConfigList("extra_valid_entries")
+            self.meta_entry_sets = (validlist,
+                                    frozenset(validlist),
+                                    frozenset(self.immutableEntries),
+                                    frozenset(self.listTypeEntries))
+        return self.meta_entry_sets
 
     def isListType(self,key):
-        return key in self.listTypeEntries or self.hasConfig("include_in_"+key)
+        return key in self.get_meta_entry_sets()[3] or self.hasConfig("include_in_"+key)
 
     def isValidMetaEntry(self, key):
-        return key in self.getValidMetaList()
+        return key in self.get_meta_entry_sets()[1]
 
     def getValidMetaList(self):
-        return self.validEntries + self.getConfigList("extra_valid_entries")
+        return list(self.get_meta_entry_sets()[0])
 
     def isImmutableMetaEntry(self, key):
-        return key in self.getImmutableMetaList()
+        return key in self.get_meta_entry_sets()[2]
 
     def getImmutableMetaList(self):
         return self.immutableEntries
 
+    def get_config_index(self):
+        ## option name -> list of sections in sectionslist that have
+        ## it, in sectionslist order.  Rebuilt after
+        ## reset_cached_config().
+        if self.config_index is None:
+            index = {}
+            for section in self.sectionslist:
+                if section in self._sections:
+                    for option in set(self._sections[section].keys()) | set(self._defaults.keys()):
+                        index.setdefault(option,[]).append(section)
+            self.config_index = index
+        return self.config_index
+
+    def get_config_digest(self):
+        '''
+        Hash of every setting in sectionslist, for telling if a saved
+        chapter was made with the same settings.  Passwords and
+        usernames are left out.  Can fetch _filelist files.
+        '''
+        if self.config_digest is None:
+            digest = hashlib.sha1()
+            def add(name,value):
+                v = ensure_binary(u'%s'%value)
+                digest.update(ensure_binary(u'%s %d\n'%(name,len(v))))
+                digest.update(v)
+            for section in self.sectionslist + [DEFAULTSECT]:
+                if section == DEFAULTSECT:
+                    options = self._defaults
+                elif section in self._sections:
+                    options = self._sections[section]
+                else:
+                    continue
+                add('[%s]'%section,len(options))
+                for option in sorted(options):
+                    if option == '__name__' or 'password' in option or 'username' in option:
+                        continue
+                    add(option,options[option])
+                    if option.endswith('_filelist'):
+                        add(option,self.getConfig(option[:-len('_filelist')]))
+            self.config_digest = digest.hexdigest()
+        return self.config_digest
+
     # used by adapters & writers, non-convention naming style
     def hasConfig(self, key):
-        return self.has_config(self.sectionslist, key)
+        index = self.get_config_index()
+        key = self.optionxform(key)
+        return key in index or key+"_filelist" in index or "add_to_"+key in index
 
     def has_config(self, sections, key):
+        if sections is self.sectionslist:
+            return self.hasConfig(key)
         for section in sections:
             try:
                 self.get(section,key)
@@ -695,9 +821,69 @@ class Configuration(ConfigParser):
 
     # used by adapters & writers, non-convention naming style
     def getConfig(self, key, default=""):
-        return self.get_config(self.sectionslist,key,default)
+        try:
+            return self.resolved_config[key]
+        except KeyError as ke:
+            pass
+        try:
+            add_tos = self.unset_config[key]
+        except KeyError as ke:
+            return self._resolve_config(key, default)
+        val = default
+        for v in add_tos:
+            val = val + v
+        return val
+
+    def _resolve_config(self, key, default):
+        ## Same as get_config(self.sectionslist,...), but using
+        ## get_config_index() instead of trying every section.  Saved
+        ## in resolved_config, or if key isn't set, any add_to_key
+        ## values are saved in unset_config to add to default.
+        index = self.get_config_index()
+        val = default
+        resolved = False
+
+        val_files = []
+        if not key.endswith("_filelist"):
+            ## see get_config() below.
+            val_files = self.getConfigList(key+"_filelist")
+
+        file_val = False
+        if val_files:
+            val = ''
+            resolved = True
+            for v in val_files:
+                try:
+                    val = val + self._read_file_opener(v)
+                    file_val = True
+                except:
+                    pass
+            if not file_val:
+                logger.warning("All files for (%s) failed!  Using (%s) instead. Filelist: (%s)"%
+                            (key+"_filelist",key,val_files))
+
+        if not file_val:
+            sections = index.get(self.optionxform(key),None)
+            if sections:
+                val = self.get(sections[0],key)
+                if val and val.lower() == "false":
+                    val = False
+                resolved = True
+
+        add_tos = [ self.get(section,"add_to_"+key)
+                    for section in index.get(self.optionxform("add_to_"+key),[])[::-1] ]
+        for v in add_tos:
+            val = val + v
+
+        if resolved:
+            self.resolved_config[key] = val
+        else:
+            self.unset_config[key] = add_tos
+        return val
 
     def get_config(self, sections, key, default=""):
+        if sections is self.sectionslist:
+            return self.getConfig(key,default)
         try:
             return self.cached_config[(tuple(sections),key)]
         except KeyError as ke:
@@ -783,20 +969,85 @@ class Configuration(ConfigParser):
         configuration files in the list will be read.  A single
         filename may also be given.
         Return list of successfully read files.
+
+        Parsed files are kept in a per-process cache keyed by path,
+        mtime and size, see _read_snapshot().
         """
         if isinstance(filenames, basestring):
             filenames = [filenames]
         read_ok = []
         for filename in filenames:
             try:
-                fp = codecs.open(filename,encoding='utf-8')
-            except IOError:
+                st = os.stat(filename)
+            except OSError:
                 continue
-            self._read(fp, filename)
-            fp.close()
+            key = ('file',os.path.abspath(filename),st.st_mtime,st.st_size)
+            if not self._apply_snapshot(key):
+                try:
+                    fp = codecs.open(filename,encoding='utf-8')
+                except IOError:
+                    continue
+                try:
+                    self._read_snapshot(key, fp, filename)
+                finally:
+                    fp.close()
             read_ok.append(filename)
         return read_ok
 
+    def read_text(self, text, source='<string>'):
+        """
+        Same as read_file(StringIO(text)), but the parse is kept in
+        a per-process cache keyed by a hash of text.  For
+        plugin-defaults.ini and personal.ini text, which are read
+        again for every story.
+        """
+        text = ensure_text(text)
+        key = ('text',hashlib.sha1(ensure_binary(text)).hexdigest())
+        if not self._apply_snapshot(key):
+            self._read_snapshot(key, StringIO(text), source)
+
+    def _read_snapshot(self, key, fp, fpname):
+        ## Parse into empty sections so the result is just this
+        ## source, save that and then merge it in the same as _read()
+        ## would have.  Not saved if there were parsing errors.
+        saved = (self._sections, self._defaults, self.linenos)
+        self._sections = self._dict()
+        self._defaults = self._dict()
+        self.linenos = dict()
+        try:
+            self._read(fp, fpname)
+            _ini_snapshots[key] = (self._sections, self._defaults, self.linenos)
+            while len(_ini_snapshots) > INI_SNAPSHOTS_SIZE:
+                _ini_snapshots.popitem(last=False)
+        finally:
+            snapshot = (self._sections, self._defaults, self.linenos)
+            (self._sections, self._defaults, self.linenos) = saved
+            self._merge_snapshot(snapshot)
+
+    def _apply_snapshot(self, key):
+        snapshot = _ini_snapshots.get(key,None)
+        if snapshot is None:
+            return False
+        self._merge_snapshot(snapshot)
+        return True
+
+    def _merge_snapshot(self, snapshot):
+        ## Copies everything so the snapshot is never changed by
+        ## set() etc.  Section linenos are only kept from the first
+        ## source that has the section, option linenos from the last.
+        (sections, defaults, linenos) = snapshot
+        existing = set(self._sections.keys())
+        self._defaults.update(defaults)
+        for name, options in six.iteritems(sections):
+            if name in existing:
+                self._sections[name].update(options)
+            else:
+                self._sections[name] = self._dict(options)
+        for k, v in six.iteritems(linenos):
+            if k not in existing or k not in sections:
+                self.linenos[k] = v
+        self.reset_cached_config()
+
     ## Copied from Python 2.7 library so as to make it save linenos too.
     #
     # Regular expressions for parsing section headers and options.
@@ -885,6 +1136,7 @@ class Configuration(ConfigParser):
                         if not e:
                             e = ParsingError(fpname)
                         e.append(lineno, line)
+        self.reset_cached_config()
         # if any parsing errors occurred, raise an exception
         if e:
             raise e
@@ -1017,6 +1269,11 @@ class Configuration(ConfigParser):
 #### methods for fetching.  Moved here from base_adapter when
 #### *_filelist feature was added.
 
+    def is_fetcher_thread_safe(self):
+        ## For image_prefetch_threads.  BrowserCache isn't known to
+        ## be safe either.
+        return self.get_fetcher().thread_safe and not self.getConfig('use_browser_cache')
+
     def get_fetcher(self,
                     make_new = False):
         cookiejar = None
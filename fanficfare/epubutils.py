@@ -10,28 +10,56 @@ logger = logging.getLogger(__name__)
 
 import os
 import re
+import hashlib
 import warnings
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 from xml.dom.minidom import parseString
 
 # py2 vs py3 transition
-from .six import ensure_text, text_type as unicode
+from .six import ensure_text, ensure_binary, text_type as unicode
 from .six import string_types as basestring
+from .six.moves.collections_abc import Mapping, Sequence
+from .six.moves.html_parser import HTMLParser
 from io import BytesIO
 
+from .htmlcleanup import get_link_hrefs
+
 FONT_EXTS = ('ttf','otf','woff','woff2')
 
+## Part of every chapter key, change when how chapter files are made
+## changes so updates don't reuse chapters made the old way.
+CHAPTER_KEY_VERSION = 3
+
+def chapter_file_key(chapterkey,crc,size,text=None,urlmap=None):
+    '''
+    What EpubWriter saves as the zip comment of a chapter file: a hash
+    of the chapter's key from BaseSiteAdapter.get_chapter_key(), the
+    file's CRC and size and, with urlmap for internalize_text_links,
+    which files the urls text links to are in.  An update copies the
+    file as it is if the same key comes out for it again.
+    '''
+    key = hashlib.sha1(ensure_binary(u'%s\n%s\n%s\n'%(chapterkey,crc,size)))
+    if urlmap is not None:
+        for url in sorted(get_link_hrefs(text)):
+            key.update(ensure_binary(u'%s %s\n'%(url,urlmap.get(url))))
+    return ensure_binary(key.hexdigest())
+
 from fanficfare.fff_profile import do_cprofile
 
 import bs4
 
 def get_dcsource(inputio):
-    return get_update_data(inputio,getfilecount=False,getsoups=False)[0]
+    updatedata = get_update_data(inputio,getfilecount=False,getsoups=False)
+    updatedata.close()
+    return updatedata.source
 
 def get_dcsource_chaptercount(inputio):
     ## getsoups=True to check for continue_on_chapter_error chapters.
-    return get_update_data(inputio,getfilecount=True,getsoups=True)[:2] # (source,filecount)
+    updatedata = get_update_data(inputio,getfilecount=True,getsoups=True)
+    retval = updatedata[:2] # (source,filecount)
+    updatedata.close()
+    return retval
 
 ## only finds and returns cover image type and data, not cover page.
 ## should work on any epub.  Added for anthology cover issues.
@@ -128,197 +156,276 @@ def get_oldcover(epub,relpath,contentdom,item):
 def get_update_data(inputio,
                     getfilecount=True,
                     getsoups=True):
-    epub = ZipFile(inputio, 'r') # works equally well with inputio as a path or a blob
-
-    ## Find the .opf file.
-    container = epub.read("META-INF/container.xml")
-    containerdom = parseString(container)
-    rootfilenodelist = containerdom.getElementsByTagName("rootfile")
-    rootfilename = rootfilenodelist[0].getAttribute("full-path")
+    '''
+    EpubUpdateData for inputio.  Can still be used as the tuple this
+    used to return:
+    (source,filecount,soups,images,oldcover,calibrebookmark,logfile,urlsoups,datamaps)
+    '''
+    return EpubUpdateData(inputio,getfilecount,getsoups)
 
-    contentdom = parseString(epub.read(rootfilename))
-    firstmetadom = contentdom.getElementsByTagName("metadata")[0]
-    try:
-        source=ensure_text(firstmetadom.getElementsByTagName("dc:source")[0].firstChild.data)
-    except:
-        source=None
+## for EpubUpdateData values not read yet.
+NOT_LOADED = object()
 
-    ## Save the path to the .opf file--hrefs inside it are relative to it.
-    relpath = get_path_part(rootfilename)
+class EpubUpdateData(object):
+    '''
+    What an update needs from an existing epub.  Only source is read
+    up front, the rest is read from the epub, which stays open until
+    close() or the end of a with block, when first used.  Chapter
+    soups are only made for chapters that are used.
+    '''
+    fields = ('source','filecount','soups','images','oldcover',
+              'calibrebookmark','logfile','urlsoups','datamaps')
+
+    def __init__(self,inputio,getfilecount=True,getsoups=True):
+        self.epub = ZipFile(inputio, 'r') # works equally well with inputio as a path or a blob
+        self.getfilecount = getfilecount
+        self.getsoups = getsoups
+
+        ## Find the .opf file.
+        container = self.epub.read("META-INF/container.xml")
+        containerdom = parseString(container)
+        rootfilenodelist = containerdom.getElementsByTagName("rootfile")
+        rootfilename = rootfilenodelist[0].getAttribute("full-path")
+
+        self.contentdom = parseString(self.epub.read(rootfilename))
+        firstmetadom = self.contentdom.getElementsByTagName("metadata")[0]
+        try:
+            self.source=ensure_text(firstmetadom.getElementsByTagName("dc:source")[0].firstChild.data)
+        except:
+            self.source=None
+
+        ## Save the path to the .opf file--hrefs inside it are relative to it.
+        self.relpath = get_path_part(rootfilename)
+
+        self._filecount = NOT_LOADED
+        self._chapters = NOT_LOADED
+        self._images = NOT_LOADED
+        self._oldcover = NOT_LOADED
+        self._calibrebookmark = NOT_LOADED
+        self._logfile = NOT_LOADED
+        self._datamaps = NOT_LOADED
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return tuple( getattr(self,field) for field in self.fields[index] )
+        return getattr(self,self.fields[index])
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        for field in self.fields:
+            yield getattr(self,field)
+
+    def close(self):
+        self.epub.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def manifest_items(self):
+        ## (href, item) for each item in the manifest--only place
+        ## there are item tags.
+        for item in self.contentdom.getElementsByTagName("item"):
+            yield (self.relpath+item.getAttribute("href"), item)
+
+    def chapter_hrefs(self):
+        for (href, item) in self.manifest_items():
+            # FFF uses file0000.xhtml, but can also update epubs
+            # downloaded from Twisting the Hellmouth, which uses
+            # chapter0.html.
+            # (_u\d+)? is from calibre convert naming files
+            # 3/OEBPS/file0005_u3.xhtml etc.
+            if item.getAttribute("media-type") == "application/xhtml+xml" and \
+                    re.match(r'.*/(file|chapter)\d+(_u\d+)?\.x?html',href):
+                yield href
+
+    def read_chapter(self,href):
+        try:
+            return self.epub.read(href).decode("utf-8")
+        except:
+            logger.warning("Listed chapter file(%s) not found in epub, skipping."%href)
+            return None
 
-    oldcover = None
-    calibrebookmark = None
-    logfile = None
-    # Looking for pre-existing cover.
-    for item in contentdom.getElementsByTagName("reference"):
-        if item.getAttribute("type") == "cover":
-            # there is a cover (x)html file, save the soup for it.
-            oldcover = get_oldcover(epub,relpath,contentdom,item)
-
-    filecount = 0
-    soups = [] # list of xhmtl blocks
-    urlsoups = {} # map of xhtml blocks by url
-    images = {} # dict() longdesc->(epubsrc, data)
-    datamaps = defaultdict(dict) # map of data maps by url
-    if getfilecount:
-        # spin through the manifest--only place there are item tags.
-        for item in contentdom.getElementsByTagName("item"):
-            href=relpath+item.getAttribute("href")
-            # First, count the 'chapter' files.  FFF uses file0000.xhtml,
-            # but can also update epubs downloaded from Twisting the
-            # Hellmouth, which uses chapter0.html.
-            if item.getAttribute("media-type") == "application/xhtml+xml":
-                # for epub3--only works on Calibre tagged covers.
-                # Back tracking to find the cover *page* from the
-                # cover *image* isn't currently done.
-                if "calibre:title-page" in item.getAttribute("properties"):
-                    oldcover = get_oldcover(epub,relpath,contentdom,item)
-                #print("---- item href:%s path part: %s"%(href,get_path_part(href)))
-                if re.match(r'.*/log_page(_u\d+)?\.x?html',href):
-                    try:
-                        logfile = epub.read(href).decode("utf-8")
-                    except:
-                        pass # corner case I bumped into while testing.
-                if re.match(r'.*/(file|chapter)\d+(_u\d+)?\.x?html',href):
-                    # (_u\d+)? is from calibre convert naming files
-                    # 3/OEBPS/file0005_u3.xhtml etc.
-                    if getsoups:
-                        try:
-                            soup = make_soup(epub.read(href).decode("utf-8"))
-                        except:
-                            logger.warning("Listed chapter file(%s) not found in epub, skipping."%href)
+    @property
+    def filecount(self):
+        if self._filecount is NOT_LOADED:
+            if not self.getfilecount:
+                self._filecount = 0
+            elif not self.getsoups:
+                self._filecount = len(list(self.chapter_hrefs()))
+            else:
+                self._filecount = len(self.chapters)
+        return self._filecount
+
+    @property
+    def chapters(self):
+        '''
+        UpdateChapters for the chapter files, not including missing
+        files or continue_on_chapter_error chapters.  Only reads the
+        <head>s unless a chapter doesn't have a chapterurl <meta>.
+        '''
+        if self._chapters is NOT_LOADED:
+            self._chapters = []
+            self._datamaps = defaultdict(dict) # map of data maps by url
+            urls = set()
+            if self.getfilecount and self.getsoups:
+                for href in self.chapter_hrefs():
+                    data = self.read_chapter(href)
+                    if data is None:
+                        continue
+                    headend = data.find("</head>")
+                    scanner = ChapterScanner()
+                    scanner.scan(data if headend < 0 else data[:headend])
+                    chapter = UpdateChapter(href)
+                    ## <meta name="chapterurl" content="${url}"></meta>
+                    currenturl = None
+                    if 'chapterurl' in scanner.metas:
+                        chapurl = scanner.metas['chapterurl']
+                        if chapurl == "chapter url removed due to failure":
+                            # don't count/include continue_on_chapter_error chapters.
                             continue
-                        for img in soup.find_all('img'):
-                            newsrc=''
-                            longdesc=''
-                            ## skip <img src="data:image..."
-                            ## NOTE - also only applying this processing if img has a longdesc (aka origurl)
-                            ## in past, would error out entirely.
-                            if img.has_attr('src') and img.has_attr('longdesc') and not img['src'].startswith('data:image') and not img['src'].startswith('failedtoload'):
-                                try:
-                                    newsrc=get_path_part(href)+img['src']
-                                    # remove all .. and the path part above it, if present.
-                                    # Mostly for epubs edited by Sigil.
-                                    newsrc = re.sub(r"([^/]+/\.\./)","",newsrc)
-                                    longdesc=img['longdesc']
-                                    img['src'] = img['longdesc']
-                                    # logger.debug("html -->img:%s"%longdesc)
-                                    if longdesc not in images:
-                                        data = epub.read(newsrc)
-                                        images[longdesc] = (newsrc, data)
-                                        # logger.debug("-->html Add oldimages:%s"%newsrc)
-                                except Exception as e:
-                                    logger.warning("Image %s not found!\n(originally:%s)"%(newsrc,longdesc))
-                                    # logger.warning("Exception: %s"%(unicode(e)),exc_info=True)
-                        ## Inline and embedded CSS url() images
-                        for inline in soup.select('*[style]') + soup.select('style'):
-                            style = ''
-                            if inline.name == 'style':
-                                style = inline.string
-                            if inline.has_attr('style'):
-                                style = inline['style']
-                            if 'url(' in style:
-                                ## the pattern will also accept mismatched '/", which is broken CSS.
-                                for style_url in re.findall(r'url\([\'"]?(.*?)[\'"]?\)', style):
-                                    if style_url.startswith('failedtoload'):
-                                        continue
-                                    if style_url.rsplit('.')[-1].lower() in FONT_EXTS:
-                                        logger.debug("Skipping sheet style url(%s), assumed font"%style_url)
-                                        continue
-                                    logger.debug("Updating inline/embedded style url(%s)"%style_url)
-                                    newsrc=''
-                                    longdesc=''
-                                    try:
-                                        newsrc=get_path_part(href)+style_url
-                                        # remove all .. and the path part above it, if present.
-                                        # Mostly for epubs edited by Sigil.
-                                        newsrc = re.sub(r"([^/]+/\.\./)","",newsrc)
-                                        # logger.debug("htmlcss -->img:%s"%href)
-                                        if style_url not in images:
-                                            data = epub.read(newsrc)
-                                            images[style_url] = (newsrc, data)
-                                            # logger.debug("-->htmlcss Add oldimages:%s"%newsrc)
-                                            # logger.debug("\nimg %s len(%s)\n"%(newsrc,len(data)))
-                                    except Exception as e:
-                                        logger.warning("Image %s not found!\n(originally:%s)"%(newsrc,longdesc))
-
-                        bodysoup = soup.find('body')
-                        # ffdl epubs have chapter title h3
-                        h3 = bodysoup.find('h3')
-                        if h3:
-                            h3.extract()
-                        # TtH epubs have chapter title h2
-                        h2 = bodysoup.find('h2')
-                        if h2:
-                            h2.extract()
-
-                        for skip in bodysoup.find_all(attrs={'class':'skip_on_ffdl_update'}):
-                            skip.extract()
-
-                        ## <meta name="chapterurl" content="${url}"></meta>
-                        #print("look for meta chapurl")
-                        currenturl = None
-                        chapurl = soup.find('meta',{'name':'chapterurl'})
-                        if chapurl:
-                            # logger.debug("chapurl['content']:%s"%chapurl['content'])
-                            if chapurl['content'] == "chapter url removed due to failure":
-                                # don't count/include continue_on_chapter_error chapters.
-                                continue
-                            if chapurl['content'] not in urlsoups: # keep first found if more than one.
-                            # print("Found chapurl['content']:%s"%chapurl['content'])
-                                currenturl = chapurl['content']
-                                urlsoups[chapurl['content']] = bodysoup
-                        else:
-                            # for older pre-meta.  Only temp.
-                            chapa = bodysoup.find('a',{'class':'chapterurl'})
-                            if chapa and chapa['href'] not in urlsoups: # keep first found if more than one.
-                                urlsoups[chapa['href']] = bodysoup
-                                currenturl = chapa['href']
-                                chapa.extract()
-
-                        chapterorigtitle = soup.find('meta',{'name':'chapterorigtitle'})
-                        if chapterorigtitle:
-                            datamaps[currenturl]['chapterorigtitle'] = chapterorigtitle['content']
-
-                        chaptertitle = soup.find('meta',{'name':'chaptertitle'})
-                        if chaptertitle:
-                            datamaps[currenturl]['chaptertitle'] = chaptertitle['content']
-
-                        soups.append(bodysoup)
-
-                    filecount+=1
-            ## CSS files -- only process when also getting soups for
-            ## update.  output_css is configured, but 'extra_css' like
-            ## otw workskin might vary.
-            if item.getAttribute("media-type") == "text/css" and getsoups:
-                try:
-                    style = epub.read(href).decode("utf-8")
-                except:
-                    logger.warning("Listed CSS file(%s) not found in epub, skipping."%href)
+                        if chapurl not in urls: # keep first found if more than one.
+                            currenturl = chapter.url = chapurl
+                    else:
+                        # for older pre-meta.  Only temp.
+                        if headend >= 0:
+                            scanner = ChapterScanner()
+                            scanner.scan(data)
+                        chapa = scanner.chapterurl_href
+                        if chapa is not None and chapa not in urls: # keep first found if more than one.
+                            currenturl = chapter.url = chapa
+                            chapter.extract_chapa = True
+                    if currenturl is not None:
+                        urls.add(currenturl)
+                    for name in ('chapterorigtitle','chaptertitle'):
+                        if name in scanner.metas:
+                            self._datamaps[currenturl][name] = scanner.metas[name]
+                    self._chapters.append(chapter)
+        return self._chapters
+
+    @property
+    def soups(self):
+        "list of chapter body soups, made when used."
+        return UpdateSoupList(self,self.chapters)
+
+    @property
+    def urlsoups(self):
+        "map of chapter body soups by url, made when used."
+        return UpdateSoupMap(self,[ (chapter.url, chapter) for chapter in self.chapters
+                                    if chapter.url is not None ])
+
+    @property
+    def datamaps(self):
+        if self._datamaps is NOT_LOADED:
+            if self.getfilecount and self.getsoups:
+                self.chapters
+            else:
+                self._datamaps = defaultdict(dict)
+        return self._datamaps
+
+    def get_chapter_file(self,chapter,chapterkey,urlmap=None):
+        '''
+        (href,text) of chapter's file if it has the chapter_file_key()
+        chapterkey and urlmap give, so it can be copied as it is.
+        None if it doesn't.
+        '''
+        try:
+            zinfo = self.epub.getinfo(chapter.href)
+        except KeyError:
+            return None
+        oldkey = zinfo.comment.split(b' ')[0]
+        if not oldkey:
+            return None
+        text = None
+        if urlmap is not None:
+            text = self.read_chapter(chapter.href)
+        if oldkey != chapter_file_key(chapterkey,zinfo.CRC,zinfo.file_size,text,urlmap):
+            return None
+        if text is None:
+            text = self.read_chapter(chapter.href)
+        return (chapter.href,text)
+
+    def make_chapter_soup(self,chapter):
+        soup = make_soup(self.epub.read(chapter.href).decode("utf-8"))
+        for img in soup.find_all('img'):
+            ## skip <img src="data:image..."
+            ## NOTE - also only applying this processing if img has a longdesc (aka origurl)
+            if img.has_attr('src') and img.has_attr('longdesc') and not img['src'].startswith('data:image') and not img['src'].startswith('failedtoload'):
+                img['src'] = img['longdesc']
+
+        bodysoup = soup.find('body')
+        # ffdl epubs have chapter title h3
+        h3 = bodysoup.find('h3')
+        if h3:
+            h3.extract()
+        # TtH epubs have chapter title h2
+        h2 = bodysoup.find('h2')
+        if h2:
+            h2.extract()
+
+        for skip in bodysoup.find_all(attrs={'class':'skip_on_ffdl_update'}):
+            skip.extract()
+
+        if chapter.extract_chapa:
+            bodysoup.find('a',{'class':'chapterurl'}).extract()
+        return bodysoup
+
+    @property
+    def images(self):
+        '''
+        dict() longdesc->(epubsrc, data) of the images in chapters,
+        CSS and the manifest.
+        '''
+        if self._images is NOT_LOADED:
+            self._images = {}
+            if self.getfilecount and self.getsoups:
+                self.load_images()
+        return self._images
+
+    def load_images(self):
+        images = self._images
+        chapter_hrefs = set(self.chapter_hrefs())
+        for (href, item) in self.manifest_items():
+            if href in chapter_hrefs:
+                data = self.read_chapter(href)
+                if data is None:
                     continue
-                if 'url(' in style:
-                    # logger.debug("%s CSS url:%s"%(href,style))
-                    ## the pattern will also accept mismatched '/", which is broken CSS.
-                    for style_url in re.findall(r'url\([\'"]?(.*?)[\'"]?\)', style):
-                        if style_url.rsplit('.')[-1].lower() in FONT_EXTS:
-                            logger.debug("Skipping sheet style url(%s), assumed font"%style_url)
-                            continue
-                        logger.debug("Updating sheet style url(%s)"%style_url)
-                        newsrc=''
-                        longdesc=''
+                scanner = ChapterScanner()
+                scanner.scan(data)
+                for (src, longdesc) in scanner.imgs:
+                    newsrc=''
+                    ## skip <img src="data:image..."
+                    ## NOTE - also only applying this processing if img has a longdesc (aka origurl)
+                    ## in past, would error out entirely.
+                    if not src.startswith('data:image') and not src.startswith('failedtoload'):
                         try:
-                            newsrc=get_path_part(href)+style_url
+                            newsrc=get_path_part(href)+src
                             # remove all .. and the path part above it, if present.
                             # Mostly for epubs edited by Sigil.
                             newsrc = re.sub(r"([^/]+/\.\./)","",newsrc)
-                            # logger.debug("css -->img:%s"%href)
-                            if style_url not in images:
-                                data = epub.read(newsrc)
-                                images[style_url] = (newsrc, data)
-                                # logger.debug("css -->Add oldimages:%s"%newsrc)
-                                # logger.debug("\nimg %s len(%s)\n"%(newsrc,len(data)))
+                            # logger.debug("html -->img:%s"%longdesc)
+                            if longdesc not in images:
+                                images[longdesc] = (newsrc, self.epub.read(newsrc))
+                                # logger.debug("-->html Add oldimages:%s"%newsrc)
                         except Exception as e:
                             logger.warning("Image %s not found!\n(originally:%s)"%(newsrc,longdesc))
+                ## Inline and embedded CSS url() images
+                for style in scanner.style_attrs + scanner.style_tags:
+                    self.load_style_images(href,style,skipfailed=True)
+            ## CSS files -- only process when also getting soups for
+            ## update.  output_css is configured, but 'extra_css' like
+            ## otw workskin might vary.
+            if item.getAttribute("media-type") == "text/css":
+                try:
+                    style = self.epub.read(href).decode("utf-8")
+                except:
+                    logger.warning("Listed CSS file(%s) not found in epub, skipping."%href)
+                    continue
+                self.load_style_images(href,style)
         ## Find all images in file.  Some redundancy with above
         ## finding images in chapters and css, but also keeps images
         ## in the epub that aren't referenced by removed chapters in
@@ -326,10 +433,9 @@ def get_update_data(inputio,
         ## discarded on epub write if not used.
         ## Done on a second spin through manifest to ensure chapter
         ## <img longdesc imgurls get registered first.
-        for item in contentdom.getElementsByTagName("item"):
-            href=relpath+item.getAttribute("href")
-            if item.getAttribute("media-type").startswith("image/") and getsoups:
-                if oldcover and href == oldcover[3]:
+        for (href, item) in self.manifest_items():
+            if item.getAttribute("media-type").startswith("image/"):
+                if self.oldcover and href == self.oldcover[3]:
                     # don't include cover image, already handled by
                     # oldcover code and can trip de-dup unintentionally.
                     continue
@@ -337,21 +443,179 @@ def get_update_data(inputio,
                 # logger.debug("-->img img:%s"%img_url)
                 if img_url not in images:
                     try:
-                        data = epub.read(href)
+                        data = self.epub.read(href)
                     except:
                         logger.warning("Listed image file(%s) not found in epub, skipping."%href)
                         continue
                     # logger.debug("-->img Add oldimages:%s"%href)
                     images[img_url] = (img_url, data)
-    try:
-        calibrebookmark = epub.read("META-INF/calibre_bookmarks.txt")
-    except:
-        pass
-
-    #for k in images.keys():
-        #print("\tlongdesc:%s\n\tData len:%s\n"%(k,len(images[k])))
-    #print("datamaps:%s"%datamaps)
-    return (source,filecount,soups,images,oldcover,calibrebookmark,logfile,urlsoups,datamaps)
+
+    def load_style_images(self,href,style,skipfailed=False):
+        images = self._images
+        if 'url(' in style:
+            ## the pattern will also accept mismatched '/", which is broken CSS.
+            for style_url in re.findall(r'url\([\'"]?(.*?)[\'"]?\)', style):
+                if skipfailed and style_url.startswith('failedtoload'):
+                    continue
+                if style_url.rsplit('.')[-1].lower() in FONT_EXTS:
+                    logger.debug("Skipping style url(%s), assumed font"%style_url)
+                    continue
+                logger.debug("Updating style url(%s)"%style_url)
+                newsrc=''
+                try:
+                    newsrc=get_path_part(href)+style_url
+                    # remove all .. and the path part above it, if present.
+                    # Mostly for epubs edited by Sigil.
+                    newsrc = re.sub(r"([^/]+/\.\./)","",newsrc)
+                    if style_url not in images:
+                        images[style_url] = (newsrc, self.epub.read(newsrc))
+                        # logger.debug("\nimg %s len(%s)\n"%(newsrc,len(data)))
+                except Exception as e:
+                    logger.warning("Image %s not found!\n(originally:%s)"%(newsrc,''))
+
+    @property
+    def oldcover(self):
+        if self._oldcover is NOT_LOADED:
+            self._oldcover = None
+            # Looking for pre-existing cover.
+            for item in self.contentdom.getElementsByTagName("reference"):
+                if item.getAttribute("type") == "cover":
+                    # there is a cover (x)html file, save the soup for it.
+                    self._oldcover = get_oldcover(self.epub,self.relpath,self.contentdom,item)
+            if self.getfilecount:
+                for (href, item) in self.manifest_items():
+                    # for epub3--only works on Calibre tagged covers.
+                    # Back tracking to find the cover *page* from the
+                    # cover *image* isn't currently done.
+                    if item.getAttribute("media-type") == "application/xhtml+xml" and \
+                            "calibre:title-page" in item.getAttribute("properties"):
+                        self._oldcover = get_oldcover(self.epub,self.relpath,self.contentdom,item)
+        return self._oldcover
+
+    @property
+    def logfile(self):
+        if self._logfile is NOT_LOADED:
+            self._logfile = None
+            if self.getfilecount:
+                for (href, item) in self.manifest_items():
+                    if item.getAttribute("media-type") == "application/xhtml+xml" and \
+                            re.match(r'.*/log_page(_u\d+)?\.x?html',href):
+                        try:
+                            self._logfile = self.epub.read(href).decode("utf-8")
+                        except:
+                            pass # corner case I bumped into while testing.
+        return self._logfile
+
+    @property
+    def calibrebookmark(self):
+        if self._calibrebookmark is NOT_LOADED:
+            try:
+                self._calibrebookmark = self.epub.read("META-INF/calibre_bookmarks.txt")
+            except:
+                self._calibrebookmark = None
+        return self._calibrebookmark
+
+class UpdateChapter(object):
+    ## A chapter file in an EpubUpdateData.
+    __slots__ = ('href','url','extract_chapa')
+
+    def __init__(self,href):
+        self.href = href
+        self.url = None
+        self.extract_chapa = False # older pre-meta chapterurl link.
+
+class UpdateSoupList(Sequence):
+    def __init__(self,updatedata,chapters):
+        self.updatedata = updatedata
+        self.chapters = chapters
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            ## hookForUpdates() can drop chapters, soups still made
+            ## when used.
+            return UpdateSoupList(self.updatedata,self.chapters[index])
+        return self.updatedata.make_chapter_soup(self.chapters[index])
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def get_chapter_file(self,index,chapterkey,urlmap=None):
+        return self.updatedata.get_chapter_file(self.chapters[index],chapterkey,urlmap)
+
+    def close(self):
+        self.updatedata.close()
+
+class UpdateSoupMap(Mapping):
+    def __init__(self,updatedata,chapters):
+        self.updatedata = updatedata
+        self.chapters = OrderedDict(chapters) # url -> UpdateChapter
+
+    def __getitem__(self,url):
+        return self.updatedata.make_chapter_soup(self.chapters[url])
+
+    def __iter__(self):
+        return iter(self.chapters)
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def __contains__(self,url):
+        return url in self.chapters
+
+    def get_chapter_file(self,url,chapterkey,urlmap=None):
+        return self.updatedata.get_chapter_file(self.chapters[url],chapterkey,urlmap)
+
+    def map_urls(self,func):
+        "Copy with func(url) for each url."
+        return UpdateSoupMap(self.updatedata,[ (func(url), chapter) for (url, chapter) in self.chapters.items() ])
+
+    def close(self):
+        self.updatedata.close()
+
+class ChapterScanner(HTMLParser):
+    '''
+    Finds what EpubUpdateData needs in a chapter's (x)html without
+    making a soup of it, which is many times slower.
+    '''
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.metas = {} # name -> content of the first <meta> with each name
+        self.imgs = [] # (src,longdesc) of <img>s with both
+        self.img_srcs = [] # (src,longdesc or None) of <img>s with src
+        self.style_attrs = [] # style="" values
+        self.style_tags = [] # <style> contents
+        self.chapterurl_href = None # href of the first <a class="chapterurl">
+        self.in_style = False
+
+    def scan(self,data):
+        self.feed(data.replace("noscript>","fff_hide_noscript>"))
+        self.close()
+
+    def handle_starttag(self,tag,attrs):
+        ## first of repeated attrs like html5lib, u'' for no value.
+        attrs = dict( (name, value or u'') for (name, value) in reversed(attrs) )
+        if tag == 'meta' and 'name' in attrs and attrs['name'] not in self.metas:
+            self.metas[attrs['name']] = attrs.get('content')
+        elif tag == 'img' and 'src' in attrs:
+            self.img_srcs.append((attrs['src'],attrs.get('longdesc')))
+            if 'longdesc' in attrs:
+                self.imgs.append((attrs['src'],attrs['longdesc']))
+        elif tag == 'a' and self.chapterurl_href is None and \
+                'chapterurl' in attrs.get('class',u'').split():
+            self.chapterurl_href = attrs.get('href')
+        elif tag == 'style':
+            self.in_style = True
+            self.style_tags.append(u'')
+        if 'style' in attrs:
+            self.style_attrs.append(attrs['style'])
+
+    def handle_endtag(self,tag):
+        if tag == 'style':
+            self.in_style = False
+
+    def handle_data(self,data):
+        if self.in_style:
+            self.style_tags[-1] += data
 
 def get_path_part(n):
     relpath = os.path.dirname(n)
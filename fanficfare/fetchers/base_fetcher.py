@@ -33,6 +33,10 @@ class FetcherResponse(object):
         self.json = json
 
 class Fetcher(object):
+    ## Safe to fetch with from more than one thread at once, for
+    ## image_prefetch_threads.
+    thread_safe = False
+
     def __init__(self,getConfig_fn,getConfigList_fn):
         self.getConfig = getConfig_fn
         self.getConfigList = getConfigList_fn
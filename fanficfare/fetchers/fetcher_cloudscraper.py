@@ -33,6 +33,9 @@ from .fetcher_requests import RequestsFetcher
 # http_client.HTTPConnection.debuglevel = 5
 
 class CloudScraperFetcher(RequestsFetcher):
+    ## challenge handling keeps state in the session.
+    thread_safe = False
+
     def __init__(self,getConfig_fn,getConfigList_fn):
         super(CloudScraperFetcher,self).__init__(getConfig_fn,getConfigList_fn)
 
@@ -38,6 +38,9 @@ FLARESOLVERR_SESSION="FanFicFareSession"
 ## no convinced this is a good idea yet.
 
 class FlareSolverr_ProxyFetcher(RequestsFetcher):
+    ## one FlareSolverr session.
+    thread_safe = False
+
     def __init__(self, getConfig_fn, getConfigList_fn):
         logger.debug("using FlareSolverr_ProxyFetcher")
         super(FlareSolverr_ProxyFetcher, self).__init__(getConfig_fn,
@@ -29,6 +29,8 @@ from .fetcher_requests import RequestsFetcher
 import socket
 
 class NSAPA_ProxyFetcher(RequestsFetcher):
+    ## its own socket protocol to one proxy.
+    thread_safe = False
 
     def __init__(self, getConfig_fn, getConfigList_fn):
         super(NSAPA_ProxyFetcher, self).__init__(getConfig_fn,
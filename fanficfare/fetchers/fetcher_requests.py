@@ -37,6 +37,9 @@ from .log import make_log
 from .base_fetcher import FetcherResponse, Fetcher
 
 class RequestsFetcher(Fetcher):
+    ## requests sessions and BasicCache can be shared by threads.
+    thread_safe = True
+
     def __init__(self,getConfig_fn,getConfigList_fn):
         super(RequestsFetcher,self).__init__(getConfig_fn,getConfigList_fn)
         self.requests_session = None
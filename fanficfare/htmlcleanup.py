@@ -20,6 +20,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import re
+import sys
 
 # py2 vs py3 transition
 from .six.moves.urllib.parse import unquote
@@ -30,8 +31,11 @@ from .six import unichr
 from .six import PY2
 if PY2:
     from cgi import escape as htmlescape
+    from HTMLParser import HTMLParser
+    htmlunescape = HTMLParser().unescape
 else: # PY3
     from html import escape as htmlescape
+    from html import unescape as htmlunescape
 
 def _unirepl(match):
     "Return the unicode string for a decimal number"
@@ -51,6 +55,7 @@ def _unirepl(match):
         retval = ""
     return retval
 
+_number_entity_re = re.compile(r'&#(x[0-9a-fA-F]{,4}|[0-9]{,5})([0-9a-fA-F]*?);')
 def _replaceNumberEntities(data):
     # The same brokenish entity parsing in SGMLParser that inserts ';'
     # after non-entities will also insert ';' incorrectly after number
@@ -59,14 +64,68 @@ def _replaceNumberEntities(data):
     # "Don't&#8212e;ver&#8212d;o&#8212;that&#8212a;gain,"
     # Also need to allow for 5 digit decimal entities &#27861;
     # Last expression didn't allow for 2 digit hex correctly: &#xE9;
-    p = re.compile(r'&#(x[0-9a-fA-F]{,4}|[0-9]{,5})([0-9a-fA-F]*?);')
-    return p.sub(_unirepl, data)
+    return _number_entity_re.sub(_unirepl, data)
 
+def _named_entity_keys(space_only):
+    # reverse sort will put entities with ; before the same one without, when valid.
+    for e in reversed(sorted(entities.keys())):
+        if space_only and re.match(r"^[^\s]$", entities[e], re.UNICODE | re.S):
+            # if not space
+            continue
+        yield e
+
+def _replaceNamedEntitiesLoop(data, space_only):
+    for e in _named_entity_keys(space_only):
+        v = entities[e]
+        try:
+            data = data.replace(e, v)
+        except UnicodeDecodeError as ex:
+            # for the pound symbol
+            data = data.replace(e, v.decode('utf-8'))
+    return data
+
+## Compiled on first use, keyed by space_only.  Replacing each entity
+## in turn means scanning the whole text once per entity.  Instead,
+## runs of entities are done with one alternation each, in the same
+## order, so the same entity wins at any given '&'.  Only the &amp;
+## entities create new '&'s ('&amp;eacute;' -> '&eacute;' -> 'é'), so
+## runs are split on those, which are still done with replace().
+_named_entity_passes = {}
+def _get_named_entity_passes(space_only):
+    if space_only not in _named_entity_passes:
+        passes = []
+        run = []
+        for e in _named_entity_keys(space_only):
+            if entities[e] == '&':
+                if run:
+                    passes.append(re.compile('|'.join([ re.escape(r) for r in run ])))
+                    run = []
+                passes.append(e)
+            else:
+                run.append(e)
+        if run:
+            passes.append(re.compile('|'.join([ re.escape(r) for r in run ])))
+        _named_entity_passes[space_only] = passes
+    return _named_entity_passes[space_only]
+
+def _entity_repl(match):
+    return entities[match.group(0)]
+
+def _replaceNamedEntities(data, space_only):
+    if '&' not in data:
+        return data
+    for p in _get_named_entity_passes(space_only):
+        if isinstance(p, basestring):
+            data = data.replace(p, entities[p])
+        else:
+            data = p.sub(_entity_repl, data)
+    return data
+
+_not_entity_re = re.compile(r'&([a-zA-Z][-.a-zA-Z0-9]*);')
 def _replaceNotEntities(data):
     # not just \w or \S.  regexp from c:\Python25\lib\sgmllib.py
     # (or equiv), SGMLParser, entityref
-    p = re.compile(r'&([a-zA-Z][-.a-zA-Z0-9]*);')
-    return p.sub(r'&\1', data)
+    return _not_entity_re.sub(r'&\1', data)
 
 def stripHTML(soup, remove_all_entities=True):
     if isinstance(soup,basestring):
@@ -121,17 +180,11 @@ def removeEntities(text, space_only=False, remove_all_entities=False):
     text = _replaceNumberEntities(text)
 
     # replace several named entities with character, such as &mdash; -> -
-    # reverse sort will put entities with ; before the same one without, when valid.
-    for e in reversed(sorted(entities.keys())):
-        v = entities[e]
-        if space_only and re.match(r"^[^\s]$", v, re.UNICODE | re.S):
-            # if not space
-            continue
-        try:
-            text = text.replace(e, v)
-        except UnicodeDecodeError as ex:
-            # for the pound symbol
-            text = text.replace(e, v.decode('utf-8'))
+    try:
+        text = _replaceNamedEntities(text, space_only)
+    except UnicodeDecodeError as ex:
+        # for the pound symbol
+        text = _replaceNamedEntitiesLoop(text, space_only)
 
     # SGMLParser, and in turn, BeautifulStoneSoup doesn't parse
     # entities terribly well and inserts (;) after something that
@@ -150,6 +203,125 @@ def removeEntities(text, space_only=False, remove_all_entities=False):
         text = text.replace('&', '&amp;').replace('&amp;lt', '&lt;').replace('&amp;gt', '&gt;')
     return text
 
+## Don't want html, head or body tags in chapter html--writers add
+## them.  The pattern is also combined with others in base_adapter's
+## chapter post-processing.
+html_head_body_pattern = r"</?(?:html|head|body)[^>]*>\r?\n?"
+_html_head_body_re = re.compile(html_head_body_pattern)
+def remove_html_head_body(text):
+    return _html_head_body_re.sub("",text)
+
+## Start tags, with <!-- comments --> and <script>/<style> contents
+## matched only to skip over them.
+_html_tag_re = re.compile(r'''<!--.*?(?:-->|$)|<(script|style)\b(?:[^>"']|"[^"]*"|'[^']*')*>.*?(?:</\1\s*>|$)|<([a-zA-Z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''',re.I|re.S)
+_html_attr_re = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?''')
+
+def _a_tags(text):
+    """
+    (match,attrs,names) for each <a> tag in text.  attrs is name ->
+    (value,start,end) for the first of each attribute, with start:end
+    the value's span in text, quotes and all.  names is (name,start)
+    for each attribute in order.
+    """
+    for m in _html_tag_re.finditer(text):
+        if m.group(2) and m.group(2).lower() == 'a':
+            attrs = {}
+            names = []
+            for a in _html_attr_re.finditer(m.group(3)):
+                name = a.group(1).lower()
+                names.append((name,m.start(3)+a.start(1)))
+                if name in attrs:
+                    continue
+                value = a.group(2)
+                if value is None:
+                    ## no value, new one goes after the name.
+                    end = m.start(3)+a.end(1)
+                    attrs[name] = ('',end,end)
+                    continue
+                start = m.start(3)+a.start(2)
+                end = m.start(3)+a.end(2)
+                if value[0] in '"\'':
+                    value = value[1:-1]
+                if '&' in value:
+                    value = htmlunescape(value)
+                attrs[name] = (value,start,end)
+            yield (m,attrs,names)
+
+def _attr_value(value):
+    ## quoted the way bs4 does.
+    value = value.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+    if '"' not in value:
+        return '"%s"'%value
+    if "'" not in value:
+        return "'%s'"%value
+    return '"%s"'%value.replace('"','&quot;')
+
+def get_link_hrefs(text):
+    """
+    Set of the href and data-orighref values of the <a> tags in text.
+    """
+    hrefs = set()
+    for (m,attrs,names) in _a_tags(text):
+        for name in ('href','data-orighref'):
+            if name in attrs:
+                hrefs.add(attrs[name][0])
+    return hrefs
+
+def internalize_links(text,urlmap,keep_orighref=False):
+    """
+    Point the <a href>s in text found in urlmap at urlmap's value
+    instead.  With keep_orighref, the original href is saved in
+    data-orighref, and a data-orighref in urlmap is used before href.
+
+    Only the changed attributes are rewritten, the rest of text is
+    left as it is, unparsed.  A new data-orighref goes where bs4's
+    sorted attributes would put it.
+    """
+    edits = [] # (start,end,new text)
+    for (m,attrs,names) in _a_tags(text):
+        href = attrs.get('href')
+        orighref = attrs.get('data-orighref')
+        ## Chapters can be inserted in the middle which can break
+        ## existing internal links.  So save the original href and
+        ## update.
+        if keep_orighref and orighref and orighref[0] in urlmap:
+            newhref = urlmap[orighref[0]]
+            addorig = False
+        elif href and href[0] in urlmap:
+            newhref = urlmap[href[0]]
+            # only save orig href if not already internal.
+            addorig = keep_orighref and not href[0].startswith('file')
+        else:
+            continue
+        end = m.end(3)
+        if text[m.start(3):end].endswith('/'):
+            end -= 1
+        value = _attr_value(newhref)
+        if href:
+            edits.append((href[1],href[2],value if href[1] < href[2] else '='+value))
+        else:
+            edits.append((end,end,' href=%s'%value))
+        if addorig:
+            value = _attr_value(href[0])
+            if orighref:
+                edits.append((orighref[1],orighref[2],value if orighref[1] < orighref[2] else '='+value))
+            else:
+                after = [ start for (name,start) in names if name > 'data-orighref' ]
+                if after:
+                    edits.append((after[0],after[0],'data-orighref=%s '%value))
+                else:
+                    edits.append((end,end,' data-orighref=%s'%value))
+    if not edits:
+        return text
+    parts = []
+    last = 0
+    for (start,end,new) in sorted(edits,key=lambda e : e[0]):
+        parts.append(text[last:start])
+        parts.append(new)
+        last = end
+    parts.append(text[last:])
+    return ''.join(parts)
+
 ## Currently used(optionally) by adapter_novelonlinefullcom and
 ## adapter_wwwnovelallcom only.  I hesitate to put the option in
 ## base_adapter.make_soup for all adapters due to concerns about it
@@ -169,21 +341,73 @@ def fix_excess_space(text):
 
 import unicodedata
 ZALGO_CHAR_CATEGORIES = ['Mn', 'Me']
+
+## Character classes of all ZALGO_CHAR_CATEGORIES code points, built
+## on first use.  re can check a class of only BMP characters with a
+## bitmap, but any character beyond that makes it check every range
+## in turn, so the marks beyond the BMP are kept in a separate class
+## only used when the text has such characters.  Compiled patterns
+## are cached by (max_zalgo, astral).
+_zalgo_char_classes = None
+_zalgo_res = {}
+_non_ascii_re = re.compile(r'[^\x00-\x7f]')
+_astral_re = None
+if sys.maxunicode > 0xFFFF:
+    _astral_re = re.compile(u"[%s-%s]"%(unichr(0x10000),unichr(sys.maxunicode)))
+
+def _get_zalgo_char_classes():
+    global _zalgo_char_classes
+    if _zalgo_char_classes is None:
+        ranges = []
+        start = None
+        for i in range(sys.maxunicode+1):
+            if unicodedata.category(unichr(i)) in ZALGO_CHAR_CATEGORIES:
+                if start is None:
+                    start = i
+            elif start is not None:
+                ranges.append((start,i-1))
+                start = None
+        if start is not None:
+            ranges.append((start,sys.maxunicode))
+        def charclass(rs):
+            return u"[%s]"%(u"".join([ unichr(a) if a == b else u"%s-%s"%(unichr(a),unichr(b))
+                                       for (a,b) in rs ]))
+        bmp = charclass([ r for r in ranges if r[1] <= 0xFFFF ])
+        astral = [ r for r in ranges if r[1] > 0xFFFF ]
+        if astral:
+            astral = u"(?:%s|(?=%s)%s)"%(bmp,_astral_re.pattern,charclass(astral))
+        else:
+            astral = bmp
+        _zalgo_char_classes = (bmp,astral)
+    return _zalgo_char_classes
+
+def _get_zalgo_re(max_zalgo,astral):
+    if (max_zalgo,astral) not in _zalgo_res:
+        zclass = _get_zalgo_char_classes()[1 if astral else 0]
+        if max_zalgo > 0:
+            # keep the first max_zalgo of each run.
+            pattern = u"(%s{%d})%s+"%(zclass,max_zalgo,zclass)
+        else:
+            pattern = u"%s+"%zclass
+        _zalgo_res[(max_zalgo,astral)] = re.compile(pattern)
+    return _zalgo_res[(max_zalgo,astral)]
+
 def reduce_zalgo(text,max_zalgo=1):
     # borrows from https://stackoverflow.com/questions/22277052/how-can-zalgo-text-be-prevented
     # Also applies unicodedata.normalize('NFD')
     # See: https://docs.python.org/2/library/unicodedata.html#unicodedata.normalize
-    lineout=[]
-    count=0
-    for c in unicodedata.normalize('NFD', text):
-        if unicodedata.category(c) not in ZALGO_CHAR_CATEGORIES:
-            lineout.append(c)
-            count=0
-        else:
-            if count < max_zalgo:
-                lineout.append(c)
-            count+=1
-    return ''.join(lineout)
+    # Runs of more than max_zalgo Mn/Me characters are cut down to
+    # max_zalgo.
+    if not _non_ascii_re.search(text):
+        # plain ASCII, nothing to normalize or remove.
+        return text
+    text = unicodedata.normalize('NFD', text)
+    zalgo_re = _get_zalgo_re(max(max_zalgo,0),
+                             _astral_re is not None and _astral_re.search(text) is not None)
+    if max_zalgo > 0:
+        return zalgo_re.sub(r"\1",text)
+    else:
+        return zalgo_re.sub(u"",text)
 
 def parse_hex(n, c):
     r = n[c:c+2]
@@ -5,6 +5,7 @@
 # Changes Copyright 2018 FanFicFare team
 from __future__ import absolute_import
 
+import itertools
 import struct
 import time
 import random
@@ -32,6 +33,47 @@ languages = {"en-us" : 0x0409,
              "en"    : 0x0009,
              "en-gb" : 0x0809}
 
+def PalmDocCompress(data):
+  """PalmDoc LZ77 compress one text record's data."""
+  src = bytearray(data)
+  out = bytearray()
+  n = len(src)
+  i = 0
+  while i < n:
+    # Copy of the next 3-10 bytes in the 2047 before them, longest
+    # and then nearest.
+    if n - i >= 3:
+      window = max(0, i - 2047)
+      match = data.rfind(data[i:i+3], window, i)
+      if match >= 0:
+        length = 3
+        while length < 10 and i + length < n:
+          m = data.rfind(data[i:i+length+1], window, i)
+          if m < 0:
+            break
+          match = m
+          length += 1
+        out += struct.pack('>H', 0x8000 | ((i - match) << 3) | (length - 3))
+        i += length
+        continue
+    c = src[i]
+    if c == 0x20 and i + 1 < n and 0x40 <= src[i+1] < 0x80:
+      # space and a character in one byte.
+      out.append(src[i+1] ^ 0x80)
+      i += 2
+    elif c == 0 or 0x09 <= c < 0x80:
+      out.append(c)
+      i += 1
+    else:
+      # up to 8 bytes that don't stand for themselves, after their count.
+      j = i + 1
+      while j < n and j - i < 8 and not (src[j] == 0 or 0x09 <= src[j] < 0x80):
+        j += 1
+      out.append(j - i)
+      out += src[i:j]
+      i = j
+  return bytes(out)
+
 class _SubEntry:
   def __init__(self, pos, html_data):
     self.pos = pos
@@ -51,8 +93,10 @@ class _SubEntry:
     return self.html.RenameAnchors(self._name + '_')
 
 class Converter:
-  def __init__(self, refresh_url='', title='Unknown', author='Unknown', publisher='Unknown'):
+  def __init__(self, refresh_url='', title='Unknown', author='Unknown', publisher='Unknown',
+               compress=True):
     self._header = Header()
+    self._compress = compress
     self._header.SetTitle(title)
     self._header.SetAuthor(author)
     self._header.SetPublisher(publisher)
@@ -158,47 +202,61 @@ class Converter:
     #   print "index offset: %d length: %d" % (lastj,j-lastj)
     #   lastj=j
 
-    records = []
 #    title = html.title
 #    if title:
 #      self._header.SetTitle(title)
-    record_id = 1
+    text_record_count = (len(data) + Record.MAX_SIZE - 1) // Record.MAX_SIZE
+    self._header.SetText(len(data), text_record_count, self._compress)
+    self._header.SetImageRecordIndex(text_record_count + 1)
+    num_records = text_record_count + 1
+
+    header, rec_offset = self._header.PDBHeader(num_records)
+    out.write(ensure_binary(header))
+    # Compressed record sizes, and so their offsets, aren't known
+    # until they're made, so the index is filled in after them.
+    index_pos = out.tell()
+    out.write(b'\0' * (num_records * Record.INDEX_LEN))
+    # Write to nuls for some reason
+    out.write(b'\0\0')
+    index = BytesIO()
+    for record in itertools.chain([self._header.MobiHeader()],
+                                  self._TextRecords(data)):
+      record.WriteHeader(index, rec_offset)
+      # logger.debug("rec_offset: %d len(record.data): %d" % (rec_offset,len(record.data)))
+      record.WriteData(out)
+      rec_offset += len(record.data)
+    end_pos = out.tell()
+    out.seek(index_pos)
+    out.write(index.getvalue())
+    out.seek(end_pos)
+
+  def _TextRecords(self, data):
+    """Yields the text Records of data, each made when it's needed."""
     # logger.debug("len(data):%s"%len(data))
+    record_id = 1
     for start_pos in range(0, len(data), Record.MAX_SIZE):
       end = min(len(data), start_pos + Record.MAX_SIZE)
       record_data = data[start_pos:end]
-      records.append(self._header.AddRecord(record_data, record_id))
       # logger.debug("HTML Record %03d: (size:%d) [[%s ... %s]]" % ( record_id, len(record_data), record_data[:20], record_data[-20:] ))
+      if self._compress:
+        record_data = PalmDocCompress(record_data)
+      # Trailing multibyte entry: the rest of a UTF-8 character split
+      # by the end of the record, then the count of those bytes.
+      # Readers strip it, otherwise they eat the last char of each
+      # record.
+      overlap = end
+      while overlap < len(data) and overlap - end < 3 and ord(data[overlap:overlap+1]) & 0xC0 == 0x80:
+        overlap += 1
+      record_data += data[end:overlap] + struct.pack('>B', overlap - end)
+      yield Record(record_data, record_id)
       record_id += 1
-    self._header.SetImageRecordIndex(record_id)
-    records[0:0] = [self._header.MobiHeader()]
-
-    header, rec_offset = self._header.PDBHeader(len(records))
-    out.write(ensure_binary(header))
-    for record in records:
-      record.WriteHeader(out, rec_offset)
-      # logger.debug("rec_offset: %d len(record.data): %d" % (rec_offset,len(record.data)))
-      rec_offset += (len(record.data)+1) # plus one for trailing null
-
-    # Write to nuls for some reason
-    out.write(b'\0\0')
-    for record in records:
-      record.WriteData(out)
-      out.write(b'\0')
-      # needs a trailing null, I believe it indicates zero length 'overlap'.
-      # otherwise, the readers eat the last char of each html record.
-      # Calibre writes another 6-7 bytes of stuff after that, but we seem
-      # to be getting along without it.
 
 class Record:
-  MAX_SIZE = 4096
+  MAX_SIZE = 4096 # of text before compression
   INDEX_LEN = 8
   _unique_id_seed = 28  # should be arbitrary, but taken from MobiHeader
 
-  # TODO(chatham): Record compression doesn't look that hard.
-
   def __init__(self, data, record_id):
-    assert len(data) <= self.MAX_SIZE
     self.data = data
     if record_id != 0:
       self._id = record_id
@@ -237,6 +295,7 @@ class Header:
   def __init__(self):
     self._length = 0
     self._record_count = 0
+    self._compress = False
     self._title = '2008_2_34'
     self._author = 'Unknown author'
     self._publisher = 'Unknown publisher'
@@ -254,18 +313,19 @@ class Header:
   def SetPublisher(self, publisher):
     self._publisher = publisher.encode('ascii','ignore')
 
-  def AddRecord(self, data, record_id):
-    self.max_record_size = max(Record.MAX_SIZE, len(data))
-    self._record_count += 1
-    # logger.debug("len(data):%s"%len(data))
-    self._length += len(data)
-    return Record(data, record_id)
+  def SetText(self, length, record_count, compress):
+    self._length = length
+    self._record_count = record_count
+    self._compress = compress
 
   def _ReplaceWord(self, data, pos, word):
     return data[:pos] + struct.pack('>I', word) + data[pos+4:]
 
   def PalmDocHeader(self):
-    compression = 1  # no compression
+    if self._compress:
+      compression = 2  # PalmDoc
+    else:
+      compression = 1  # no compression
     unused = 0
     encryption_type = 0  # no ecryption
     records = self._record_count + 1  # the header record itself
@@ -350,7 +410,8 @@ class Header:
     mobi_type = 2 # BOOK
     text_encoding = encoding['UTF-8']
     unique_id = random.randint(1, 1<<32)
-    creator_version = 4
+    # trailing entries (extra_data_flags) need version 5 or later.
+    creator_version = 6
     reserved = b'%c' % 0xff * 40
     nonbook_index = fs
     # logger.debug("header_len:%s"%header_len)
@@ -380,6 +441,7 @@ class Header:
     drm_size = 0
     drm_flags = 0
     exth_flags = 0x50
+    extra_data_flags = 1 # multibyte trailing entry on text records
     header_end = chr(0) * 64
     mobi_header += struct.pack('>IIIIIII',
                                creator_version,
@@ -389,7 +451,8 @@ class Header:
                                fs,
                                unused,
                                exth_flags)
-    mobi_header += b'\0' * 112 # TODO: Why this much padding?
+    mobi_header += b'\0' * 110 # TODO: Why this much padding?
+    mobi_header += struct.pack('>H', extra_data_flags)
     # Set some magic offsets to be 0xFFFFFFF.
     for pos in (0x94, 0x98, 0xb0, 0xb8, 0xc0, 0xc8, 0xd0, 0xd8, 0xdc):
       mobi_header = self._ReplaceWord(mobi_header, pos, fs)
@@ -398,7 +461,9 @@ class Header:
     padding = b'\0' * 48 * 4 # why?
     total_header = palmdoc_header + mobi_header + exth_header + self._title + padding
 
-    return self.AddRecord(total_header, 0)
+    # trailing null like the text records had before they got their
+    # trailing entries.
+    return Record(total_header + b'\0', 0)
 
 if __name__ == '__main__':
   import sys
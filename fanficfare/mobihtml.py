@@ -9,6 +9,7 @@
 from __future__ import absolute_import
 
 import re
+import bisect
 import logging
 
 # py2 vs py3 transition
@@ -22,6 +23,65 @@ from bs4 import BeautifulSoup
 
 logger = logging.getLogger(__name__)
 
+# every name=" in the text, even ones starting inside another's value.
+_NAME_RE = re.compile(br'(?=name="([^"]*))')
+_FILEPOS_RE = re.compile(br'filepos="(\d{10})"')
+
+def _FillAnchorStubs(assembled_text, anchor_references):
+  '''Replace each anchor's filepos="<anchor number>" stub in
+  assembled_text with the byte position of the tag named by its
+  href, found in one pass over the text and put in with one join.'''
+  # First position of each name="..." value, sorted so the names
+  # starting with a ref can be found.
+  name_pos = {}
+  for m in _NAME_RE.finditer(assembled_text):
+    name_pos.setdefault(m.group(1), m.start())
+  names = sorted(name_pos)
+  stub_pos = {}
+  for m in _FILEPOS_RE.finditer(assembled_text):
+    stub_pos.setdefault(int(m.group(1)), m.start())
+
+  ref_pos = {}
+  replacements = []
+  for anchor_num, original_ref in anchor_references:
+    ref = ensure_binary(unquote(original_ref[1:])) # remove leading '#'
+    if ref not in ref_pos:
+      # Find the position of ref in the utf-8 document, the first
+      # name=" followed by it.
+      if b'"' in ref:
+        newpos = assembled_text.find(b'name="'+ref)
+      else:
+        newpos = -1
+        i = bisect.bisect_left(names, ref)
+        while i < len(names) and names[i].startswith(ref):
+          if newpos == -1 or name_pos[names[i]] < newpos:
+            newpos = name_pos[names[i]]
+          i += 1
+      if newpos == -1:
+        newpos = None
+      else:
+        # instead of somewhere slightly *after* the <a> tag pointed to,
+        # let's go right in front of it instead by looking for the page
+        # break before it.
+        newpos = assembled_text.rfind(b'<',0,newpos)
+      ref_pos[ref] = newpos
+    newpos = ref_pos[ref]
+    if newpos is None:
+      logger.warning('Could not find anchor "%s"' % original_ref)
+      continue
+    # logger.debug("Anchor Pos: %s %s '%s|%s'"%((anchor_num, newpos,assembled_text[newpos-15:newpos],assembled_text[newpos:newpos+15])))
+    assert anchor_num in stub_pos
+    replacements.append((stub_pos[anchor_num], b'filepos="%.10d"' % newpos))
+
+  pieces = []
+  last = 0
+  for (pos, new_filepos) in sorted(replacements):
+    pieces.append(assembled_text[last:pos])
+    pieces.append(new_filepos)
+    last = pos + len(new_filepos)
+  pieces.append(assembled_text[last:])
+  return b''.join(pieces)
+
 class HtmlProcessor:
   WHITESPACE_RE = re.compile(r'\s')
   # Look for </blockquote  <p>
@@ -78,24 +138,7 @@ class HtmlProcessor:
     assembled_text = assembled_text.replace(b'</mbp:pagebreak>',b'')
 
     del self._soup # shouldn't touch this anymore
-    for anchor_num, original_ref in self._anchor_references:
-      ref = unquote(original_ref[1:]) # remove leading '#'
-      # Find the position of ref in the utf-8 document.
-      # TODO(chatham): Using regexes and looking for name= would be better.
-      newpos = assembled_text.find(b'name="'+ensure_binary(ref)) # .encode('utf-8')
-      if newpos == -1:
-        logger.warning('Could not find anchor "%s"' % original_ref)
-        continue
-      # instead of somewhere slightly *after* the <a> tag pointed to,
-      # let's go right in front of it instead by looking for the page
-      # break before it.
-      newpos = assembled_text.rfind(b'<',0,newpos)
-      # logger.debug("Anchor Pos: %s %s '%s|%s'"%((anchor_num, newpos,assembled_text[newpos-15:newpos],assembled_text[newpos:newpos+15])))
-      old_filepos = b'filepos="%.10d"' % anchor_num
-      new_filepos = b'filepos="%.10d"' % newpos
-      assert assembled_text.find(old_filepos) != -1
-      assembled_text = assembled_text.replace(old_filepos, new_filepos, 1)
-    return assembled_text
+    return _FillAnchorStubs(assembled_text, self._anchor_references)
 
   def _FixPreTags(self):
     '''Replace <pre> tags with HTML-ified text.'''
@@ -17,19 +17,23 @@
 
 from __future__ import absolute_import
 import os, re, sys
-from collections import defaultdict, OrderedDict
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict, deque
 import string
 import datetime
 from math import floor
 import base64
 import hashlib
 import uuid
+import tempfile
+import threading
 import logging
 logger = logging.getLogger(__name__)
 
 # py2 vs py3 transition
 from . import six
 from .six.moves.urllib.parse import (urlparse, urljoin)
+from .six.moves.collections_abc import MutableMapping
 from .six import text_type as unicode
 from .six import string_types as basestring
 from .six import ensure_binary, ensure_str
@@ -65,6 +69,7 @@ try:
         set_image_allocation_limit
     )
     convtype = {'jpg':'JPG', 'png':'PNG'}
+    image_converter = 'calibre'
 
     # Calibre function that increases qt image processing buffer size
     # for larger than 32 megapixel images.  At time of writing,
@@ -79,7 +84,8 @@ try:
         return owidth, oheight
 
     def convert_image(url,data,sizes,grayscale,
-                      removetrans,imgtype="jpg",background='#ffffff',jpg_quality=95):
+                      removetrans,imgtype="jpg",background='#ffffff',jpg_quality=95,
+                      times=None):
         # logger.debug("calibre convert_image called")
         ## I can just see somebody doing logo_svg.jpg
         if url.lower().endswith('.svg') or '.svg?' in url.lower() \
@@ -131,6 +137,7 @@ except:
         from PIL import Image
         from .six import BytesIO
         convtype = {'jpg':'JPEG', 'png':'PNG'}
+        image_converter = 'pillow'
 
         def get_image_size(data):
             img = Image.open(BytesIO(data))
@@ -138,34 +145,53 @@ except:
             return owidth, oheight
 
         def convert_image(url,data,sizes,grayscale,
-                          removetrans,imgtype="jpg",background='#ffffff',jpg_quality=95):
+                          removetrans,imgtype="jpg",background='#ffffff',jpg_quality=95,
+                          times=None):
             # logger.debug("Pillow convert_image called")
+            timer = ConvertTimer(times)
             export = False
             img = Image.open(BytesIO(data))
+            format = normalize_format_name(img.format)
 
             owidth, oheight = img.size
             nwidth, nheight = sizes
             scaled, nwidth, nheight = fit_image(owidth, oheight, nwidth, nheight)
+            if scaled and format == 'jpg':
+                ## Let the JPEG decoder scale down by 1/2, 1/4 or 1/8
+                ## while still giving at least twice the final size to
+                ## the LANCZOS resize, like Image.thumbnail() does.
+                img.draft(img.mode,(nwidth*2,nheight*2))
+            img.load()
+            timer.lap("decode")
+
             if scaled:
                 img = img.resize((nwidth, nheight),Image.LANCZOS)
                 export = True
+                timer.lap("resize")
 
-            if normalize_format_name(img.format) != imgtype:
+            if scaled or format != imgtype:
                 if img.mode == "P":
                     # convert pallete gifs to RGB so jpg save doesn't fail.
                     img = img.convert("RGB")
                 export = True
 
             if removetrans and img.mode == "RGBA":
-                background = Image.new('RGBA', img.size, background)
-                # Paste the image on top of the background
-                background.paste(img, img)
-                img = background.convert('RGB')
-                export = True
+                alpha = img.getchannel("A")
+                if alpha.getextrema()[0] < 255:
+                    # Paste the image on top of the background
+                    flat = Image.new('RGB', img.size, background)
+                    flat.paste(img, mask=alpha)
+                    img = flat
+                    export = True
+                elif export:
+                    ## no transparent pixels, just drop alpha.
+                    img = img.convert('RGB')
+                timer.lap("flatten")
 
             if grayscale and img.mode != "L":
                 img = img.convert("L")
                 export = True
+                timer.lap("grayscale")
 
             if export:
                 outsio = BytesIO()
@@ -173,19 +199,23 @@ except:
                     img.save(outsio,convtype[imgtype],quality=jpg_quality,optimize=True)
                 else:
                     img.save(outsio,convtype[imgtype])
+                timer.lap("encode")
                 return (outsio.getvalue(),imgtype,imagetypes[imgtype])
             else:
                 # logger.debug("image used unchanged")
                 return (data,imgtype,imagetypes[imgtype])
 
     except:
+        image_converter = None
+
         # No calibre or PIL, give a random largish size.
         def get_image_size(data):
             return 1000,1000
 
         # No calibre or PIL, simple pass through with mimetype.
         def convert_image(url,data,sizes,grayscale,
-                          removetrans,imgtype="jpg",background='#ffffff',jpg_quality=95):
+                          removetrans,imgtype="jpg",background='#ffffff',jpg_quality=95,
+                          times=None):
             # logger.debug("NO convert_image called")
             return no_convert_image(url,data)
 
@@ -253,6 +283,160 @@ def fit_image(width, height, pwidth, pheight):
 
     return scaled, int(width), int(height)
 
+class ConvertTimer(object):
+    ## Adds the time of each convert_image() stage to the adapter's
+    ## TimeKeeper, when there is one.
+    def __init__(self,times):
+        self.times = times
+        self.start = datetime.datetime.now()
+
+    def lap(self,name):
+        if self.times is not None:
+            now = datetime.datetime.now()
+            self.times.add("convert_image->"+name, now - self.start)
+            self.start = now
+
+## convert_image() or no_convert_image() with args from
+## Story.get_convert_image_args().  Run in image_conversion_threads
+## when set.  Results are kept in converted_image_cache when given.
+def convert_image_with_args(url,data,args,converted_image_cache=None,times=None):
+    if args is None:
+        return no_convert_image(url,data)
+    if converted_image_cache is not None and image_converter:
+        key = converted_image_cache.make_key(data,args)
+        retval = converted_image_cache.get(key,args)
+        if retval:
+            return retval
+    (sizes,grayscale,removetrans,imgtype,background,jpg_quality) = args
+    retval = convert_image(url,
+                           data,
+                           sizes,
+                           grayscale,
+                           removetrans,
+                           imgtype,
+                           background=background,
+                           jpg_quality=jpg_quality,
+                           times=times)
+    if converted_image_cache is not None and image_converter:
+        converted_image_cache.put(key,retval)
+    return retval
+
+class ConvertedImageCache:
+    ## convert_image() results saved in a directory as <key>.<ext>,
+    ## keyed by the sha256 of the source image data and the
+    ## conversion args.  Shared by all stories, CLI runs and calibre
+    ## jobs using the same converted_image_cache_dir.  When over
+    ## max_size bytes, the least recently used files are removed.
+    ## Cache hits touch the file's mtime for that.
+    filename_re = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
+
+    def __init__(self,directory,max_size):
+        self.directory = directory
+        self.max_size = max_size
+        ## total size of the files, None until first put().
+        self.size = None
+        self.lock = threading.Lock()
+
+    def make_key(self,data,args):
+        (sizes,grayscale,removetrans,imgtype,background,jpg_quality) = args
+        digest = hashlib.sha256(ensure_binary(data))
+        digest.update(ensure_binary("|%s|%s|%s|%s|%s|%s|%s"%(image_converter,
+                                                             ",".join([ "%s"%x for x in sizes ]),
+                                                             grayscale,
+                                                             removetrans,
+                                                             imgtype,
+                                                             background,
+                                                             jpg_quality)))
+        return digest.hexdigest()
+
+    def get(self,key,args):
+        imgtype = args[3]
+        path = os.path.join(self.directory,"%s.%s"%(key,imgtype))
+        try:
+            with open(path,'rb') as f:
+                data = f.read()
+            os.utime(path,None)
+        except (IOError,OSError):
+            return None
+        # logger.debug("converted image cache hit: %s"%path)
+        return (data,imgtype,imagetypes[imgtype])
+
+    def put(self,key,retval):
+        (data,ext,mime) = retval
+        path = os.path.join(self.directory,"%s.%s"%(key,ext))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            ## write under a temp name so other processes never see a
+            ## partial file.
+            tmppath = "%s.%s.tmp"%(path,uuid.uuid4().hex)
+            with open(tmppath,'wb') as f:
+                f.write(data)
+            try:
+                os.rename(tmppath,path)
+            except OSError:
+                ## Windows won't rename over an existing file, which
+                ## another process just saved.
+                os.remove(tmppath)
+                return
+        except (IOError,OSError) as e:
+            logger.warning("Failed to save converted image cache file %s: %s"%(path,e))
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = sum([ s for (s,m,p) in self.list_files() ])
+            else:
+                self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def list_files(self):
+        retlist = []
+        for fn in os.listdir(self.directory):
+            if self.filename_re.match(fn):
+                path = os.path.join(self.directory,fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                retlist.append((st.st_size,st.st_mtime,path))
+        return retlist
+
+    def evict(self):
+        files = self.list_files()
+        self.size = sum([ s for (s,m,p) in files ])
+        ## oldest first
+        files.sort(key=lambda x : x[1])
+        for (size,mtime,path) in files:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+        logger.debug("converted image cache %s evicted down to %s bytes"%(self.directory,self.size))
+
+## ConvertedImageCache by directory, so multiple downloads in one
+## process share the size count.
+converted_image_caches = {}
+converted_image_caches_lock = threading.Lock()
+
+def get_converted_image_cache(directory,max_size):
+    directory = os.path.abspath(os.path.expanduser(directory))
+    with converted_image_caches_lock:
+        cache = converted_image_caches.get(directory)
+        if cache is None:
+            cache = converted_image_caches[directory] = ConvertedImageCache(directory,max_size)
+        cache.max_size = max_size
+        return cache
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # py2 without the futures backport, images converted inline.
+    ThreadPoolExecutor = None
+
 try:
     from calibre.library.comments import sanitize_comments_html
 except:
@@ -557,6 +741,107 @@ def make_replacements(replace):
     # print("replace lines:%s"%len(retval))
     return retval
 
+## replace_metadata patterns that are plain strings, anchored with ^
+## and $.
+exact_pattern_re = re.compile(r'^\^([^.^$*+?{}\[\]\\|()]*)\$$')
+## Patterns that can't go in an alternation without changing what
+## they match: backrefs, conditionals and inline flags.
+uncombinable_pattern_re = re.compile(r'\\[1-9]|\(\?(?:P=|\(|[aiLmsux-])')
+## replace_metadata lines per alternation.
+COMBINED_LINES = 32
+
+class KeyReplacements:
+    ## The replace_metadata lines that apply to one key, in order.
+    ## first_match() returns the position and line of the first line
+    ## at or after start whose regexp matches value--the same one a
+    ## line by line regexp.search() would find.
+    def __init__(self,lines):
+        self.lines = lines
+        ## ^string$ -> positions, looked up by value.
+        self.exact = defaultdict(list)
+        ## [(alternation or None,[positions])], checked line by line
+        ## only when the alternation of all of them matches.
+        self.blocks = []
+        block = []
+        for i, replaceline in enumerate(lines):
+            pattern = replaceline[2].pattern
+            m = exact_pattern_re.match(pattern)
+            if m:
+                self.exact[m.group(1)].append(i)
+            elif uncombinable_pattern_re.search(pattern):
+                self.add_block(block)
+                block = []
+                self.blocks.append((None,[i]))
+            else:
+                block.append(i)
+                if len(block) == COMBINED_LINES:
+                    self.add_block(block)
+                    block = []
+        self.add_block(block)
+        self.block_starts = [ positions[0] for (regexp,positions) in self.blocks ]
+
+    def add_block(self,block):
+        if block:
+            try:
+                regexp = re.compile('|'.join([ '(?:%s)'%self.lines[i][2].pattern for i in block ]),re.DOTALL)
+            except Exception:
+                ## duplicate group names, too many groups in py2, etc.
+                regexp = None
+            self.blocks.append((regexp,block))
+
+    def first_match(self,value,start):
+        found = None
+        ## $ also matches before a trailing newline.
+        keys = [value]
+        if value.endswith('\n'):
+            keys.append(value[:-1])
+        for k in keys:
+            positions = self.exact.get(k)
+            if positions:
+                j = bisect_left(positions,start)
+                if j < len(positions) and (found is None or positions[j] < found):
+                    found = positions[j]
+        ## first block that can have positions >= start.
+        b = max(bisect_left(self.block_starts,start+1)-1,0)
+        for (regexp,positions) in self.blocks[b:]:
+            if found is not None and positions[0] > found:
+                break
+            if regexp is None or regexp.search(value):
+                for i in positions[bisect_left(positions,start):]:
+                    if found is not None and i > found:
+                        break
+                    if self.lines[i][2].search(value):
+                        found = i
+                        break
+        if found is None:
+            return (None,None)
+        return (found,self.lines[found])
+
+class ReplacementsIndex:
+    ## replace_metadata lines by metadata key, keyless lines apply to
+    ## every key.
+    def __init__(self,replacements):
+        self.replacements = replacements
+        self.keyed = defaultdict(list)
+        self.keyless = []
+        for i, replaceline in enumerate(replacements):
+            metakeys = replaceline[1]
+            if metakeys == None:
+                self.keyless.append(i)
+            else:
+                for key in set(metakeys):
+                    self.keyed[key].append(i)
+        self.by_key = {}
+
+    def get(self,key):
+        if key not in self.by_key:
+            if key in self.keyed:
+                positions = sorted(self.keyed[key] + self.keyless)
+            else:
+                positions = self.keyless
+            self.by_key[key] = KeyReplacements([ self.replacements[i] for i in positions ])
+        return self.by_key[key]
+
 def make_chapter_text_replacements(replace):
     retval=[]
     for repl_line in replace.splitlines():
@@ -589,8 +874,250 @@ IMG_NS = uuid.UUID('5d976d9e-7d55-4e9e-975a-8cec6c69f98e')
 def url2uuid(url):
     return unicode(uuid.uuid5(IMG_NS,ensure_str(url)))
 
+class _UnicodeDefaultMapping(MutableMapping):
+    ## Unset keys read as u'' like defaultdict(unicode), so get(),
+    ## pop() and setdefault() have to check for the key themselves,
+    ## MutableMapping's try [] to find out.
+    __slots__ = ()
+    _marker = object()
+
+    def get(self,key,default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self,key,default=_marker):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is _UnicodeDefaultMapping._marker:
+            raise KeyError(key)
+        return default
+
+    def setdefault(self,key,default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+class Chapter(_UnicodeDefaultMapping):
+    ## One chapter, readable and writable like the
+    ## defaultdict(unicode) chapters used to be--unset keys are
+    ## u''--so string.Template.substitute() and writers keep working.
+    ## The usual keys are slots, adapter and writer extras go in a
+    ## dict only created when needed.
+    fields = ('url','title','html','origtitle','toctitle','new',
+              'number','index04','index','chapter')
+    field_set = frozenset(fields)
+    __slots__ = fields + ('extras',)
+
+    def __init__(self,*args,**kwargs):
+        self.extras = None
+        self.update(*args,**kwargs)
+
+    def __getitem__(self,key):
+        try:
+            if key in Chapter.field_set:
+                value = getattr(self,key)
+                ## html can be in a ChapterStore temp file.
+                if isinstance(value,StoredData):
+                    value = value.get()
+                return value
+            if self.extras is not None:
+                return self.extras[key]
+        except (AttributeError,KeyError):
+            pass
+        return u''
+
+    def __setitem__(self,key,value):
+        if key in Chapter.field_set:
+            setattr(self,key,value)
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[key] = value
+
+    def __delitem__(self,key):
+        try:
+            if key in Chapter.field_set:
+                delattr(self,key)
+            else:
+                del self.extras[key]
+        except (AttributeError,KeyError,TypeError):
+            raise KeyError(key)
+
+    def __contains__(self,key):
+        if key in Chapter.field_set:
+            return hasattr(self,key)
+        return self.extras is not None and key in self.extras
+
+    def __iter__(self):
+        for key in Chapter.fields:
+            if hasattr(self,key):
+                yield key
+        if self.extras is not None:
+            for key in list(self.extras):
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def copy(self):
+        chapter = Chapter()
+        for key in Chapter.fields:
+            try:
+                setattr(chapter,key,getattr(self,key))
+            except AttributeError:
+                pass
+        if self.extras is not None:
+            chapter.extras = dict(self.extras)
+        return chapter
+
+    def __repr__(self):
+        return 'Chapter(%r)'%dict(self)
+
+class OldChapterFile(object):
+    ## A chapter's html when its file in the epub being updated can be
+    ## copied as it is.  Only EpubWriter, writing with story.oldepub,
+    ## gets these.
+    __slots__ = ('href',)
+
+    def __init__(self,href):
+        self.href = href
+
+    def __repr__(self):
+        return 'OldChapterFile(%r)'%self.href
+
+class ChapterView(_UnicodeDefaultMapping):
+    ## What getChapters() hands out: reads through to a memoized
+    ## Chapter, changes stay in the view.
+    __slots__ = ('chapter','changes')
+    deleted = object()
+
+    def __init__(self,chapter):
+        self.chapter = chapter
+        self.changes = None
+
+    def __getitem__(self,key):
+        if self.changes is not None and key in self.changes:
+            value = self.changes[key]
+            return u'' if value is ChapterView.deleted else value
+        return self.chapter[key]
+
+    def __setitem__(self,key,value):
+        if self.changes is None:
+            self.changes = {}
+        self.changes[key] = value
+
+    def __delitem__(self,key):
+        if key not in self:
+            raise KeyError(key)
+        self[key] = ChapterView.deleted
+
+    def __contains__(self,key):
+        if self.changes is not None and key in self.changes:
+            return self.changes[key] is not ChapterView.deleted
+        return key in self.chapter
+
+    def __iter__(self):
+        for key in self.chapter:
+            if key in self:
+                yield key
+        if self.changes is not None:
+            for key in list(self.changes):
+                if key not in self.chapter and key in self:
+                    yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def copy(self):
+        return Chapter(self)
+
+    def __repr__(self):
+        return 'ChapterView(%r)'%dict(self)
+
+class StoredData(object):
+    ## Where a TempFileStore put some bytes.
+    __slots__ = ('store','offset','length')
+
+    def __init__(self,store,offset,length):
+        self.store = store
+        self.offset = offset
+        self.length = length
+
+    def get(self):
+        return self.store.read(self.offset,self.length)
+
+class StoredChapterText(StoredData):
+    __slots__ = ()
+
+    def get(self):
+        return self.store.read(self.offset,self.length).decode('utf-8')
+
+class TempFileStore:
+    ## Appends bytes to a temp file, created when first needed and
+    ## deleted when closed or garbage collected.
+    def __init__(self):
+        self.tempfile = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def put(self,data,storedclass=StoredData):
+        with self.lock:
+            if self.tempfile is None:
+                self.tempfile = tempfile.TemporaryFile()
+            self.tempfile.seek(self.size)
+            self.tempfile.write(data)
+            stored = storedclass(self,self.size,len(data))
+            self.size += len(data)
+        return stored
+
+    def read(self,offset,length):
+        with self.lock:
+            self.tempfile.seek(offset)
+            return self.tempfile.read(length)
+
+    def close(self):
+        if self.tempfile is not None:
+            self.tempfile.close()
+            self.tempfile = None
+
+class ChapterStore:
+    ## Keeps chapter texts.  put() returns the text itself while under
+    ## max_memory characters have been kept, after that it writes the
+    ## text to a temp file and returns a StoredChapterText to read it
+    ## back with.  max_memory None or 0 keeps everything in memory.
+    def __init__(self,max_memory=None):
+        self.max_memory = max_memory
+        self.in_memory = 0
+        self.tempfilestore = TempFileStore()
+
+    def put(self,text):
+        if not self.max_memory or self.in_memory + len(text) <= self.max_memory:
+            self.in_memory += len(text)
+            return text
+        return self.tempfilestore.put(ensure_binary(text),StoredChapterText)
+
+    def close(self):
+        self.tempfilestore.close()
+
+class ImageInfo(dict):
+    ## An ImageStore image.  'data' can be in the store's temp file,
+    ## info['data'] reads it back.
+    def __getitem__(self,key):
+        value = dict.__getitem__(self,key)
+        if isinstance(value,StoredData):
+            value = value.get()
+        return value
+
+    def get(self,key,default=None):
+        if key in self:
+            return self[key]
+        return default
+
 class ImageStore:
-    def __init__(self,dedup=False):
+    def __init__(self,dedup=False,max_memory=None):
         self.prefix='ffdl'
         self.cover_name='cover'
 
@@ -600,12 +1127,16 @@ class ImageStore:
         self.url_index={}
         ## index of image uuid->info, not including cover.
         self.uuid_index={}
-        ## dict of img sizes -> lists of info dicts
-        ## size_index contains list for case of different images of same size.
-        self.size_index=defaultdict(list)
+        ## index of sha256 of image data->uuid, not including cover.
+        self.digest_index={}
         self.cover = None
         self.dedup = dedup
 
+        ## image data past max_memory bytes goes to a temp file.
+        self.max_memory = max_memory
+        self.in_memory = 0
+        self.tempfilestore = TempFileStore()
+
     # returns newsrc
     def add_img(self,url,ext=None,mime=None,data=None,cover=False,actuallyused=True,failure=False):
         # logger.debug("add_img0(%s,%s,%s)"%(url,ext,mime))
@@ -617,15 +1148,15 @@ class ImageStore:
         else:
             # logger.debug("---- uuid from URL")
             uuid = url2uuid(url)
-        info = {'url':url,
-                'uuid':uuid,
-                'ext':ext,
-                #'newsrc':newsrc, # set below
-                'mime':mime,
-                # for the admittedly rare case of an updating epub
-                # *not* needing all the images is already contains.
-                'actuallyused':actuallyused,
-                'data':data}
+        info = ImageInfo({'url':url,
+                          'uuid':uuid,
+                          'ext':ext,
+                          #'newsrc':newsrc, # set below
+                          'mime':mime,
+                          # for the admittedly rare case of an updating epub
+                          # *not* needing all the images is already contains.
+                          'actuallyused':actuallyused,
+                          'data':data})
         if cover:
             info['newsrc'] = "images/%s.%s"%(self.cover_name,ext)
             self.cover = info
@@ -636,16 +1167,16 @@ class ImageStore:
                 ext)
             ## Replace info out right if it's a dup image
             was_deduped = False
+            digest = None
             if self.dedup and data:
-                same_sz_imgs = self.get_imgs_by_size(len(data),actuallyused)
-                for szimg in same_sz_imgs:
-                    if data == szimg['data']:
-                        # matching data, duplicate file with a different URL.
-                        logger.info("found duplicate image: %s, %s"%(szimg['newsrc'],
-                                                                     szimg['url']))
-                        info = szimg
-                        was_deduped = True
-                        break
+                digest = hashlib.sha256(ensure_binary(data)).digest()
+            if digest in self.digest_index:
+                # matching data, duplicate file with a different URL.
+                szimg = self.get_img_by_uuid(self.digest_index[digest],actuallyused)
+                logger.info("found duplicate image: %s, %s"%(szimg['newsrc'],
+                                                             szimg['url']))
+                info = szimg
+                was_deduped = True
             ## I believe this can theoretically end up with more than
             ## one 'info' hash for the same file if an image is in
             ## both CSS and <img longdesc>
@@ -655,13 +1186,22 @@ class ImageStore:
                 self.uuid_index[uuid]=info
                 if data and not was_deduped:
                     self.infos.append(info)
-                    self.size_index[len(data)].append(uuid)
+                    if digest and digest not in self.digest_index:
+                        self.digest_index[digest] = uuid
+                    self.store_data(info)
         if failure:
             info['newsrc'] = 'failedtoload'
             info['actuallyused'] = False
         # logger.debug("add_img(%s,%s,%s,%s,%s,used:%s)"%(url,ext,mime,uuid,info['newsrc'],info['actuallyused']))
         return info
 
+    def store_data(self,info):
+        data = dict.__getitem__(info,'data')
+        if not self.max_memory or self.in_memory + len(data) <= self.max_memory:
+            self.in_memory += len(data)
+        else:
+            info['data'] = self.tempfilestore.put(ensure_binary(data))
+
     def cache_failed_url(self,url):
         # logger.debug("cache_failed_url(%s)"%url)
         self.add_img(url,failure=True)
@@ -687,9 +1227,6 @@ class ImageStore:
             info['actuallyused'] = info['actuallyused'] or actuallyused
         return info
 
-    def get_imgs_by_size(self,size,actuallyused=True):
-        return [ self.get_img_by_uuid(uuid,actuallyused) for uuid in self.size_index[size] ]
-
     # cover plus list
     def get_imgs(self):
         retval = [ x for x in self.infos if x['actuallyused'] ]
@@ -697,6 +1234,9 @@ class ImageStore:
             retval.insert(0,self.cover)
         return retval
 
+    def close(self):
+        self.tempfilestore.close()
+
     def debug_out(self):
         # logger.debug(self.fails_index)
         # import pprint
@@ -716,42 +1256,68 @@ class MetadataCache:
         ## that should also be cache invalided when key is.
         # {'key':['name','name',...]
         self.dependent_entries = {}
+        ## transitive closure of dependent_entries, compiled when
+        ## first needed after add_dependencies().
+        # {'key':frozenset(['key','name',...]) or None to clear all}
+        self.invalidates = None
+
+        ## hits, misses, invalidated and cleared counts.
+        self.counts = defaultdict(int)
 
     def clear(self):
+        self.counts['cleared'] += 1
         self.processed_metadata_cache = {}
         self.processed_metadata_list_cache = {}
 
-    def invalidate(self,key,seen_list={}):
+    def invalidate(self,key):
         # logger.debug("invalidate(%s)"%key)
-        # logger.debug("seen_list(%s)"%seen_list)
-        if key in seen_list:
-            raise exceptions.CacheCleared('replace all')
-        try:
-            new_seen_list = dict(seen_list)
-            new_seen_list[key]=True
-            if key in self.processed_metadata_cache:
-                del self.processed_metadata_cache[key]
-            if key in self.processed_metadata_list_cache:
-                del self.processed_metadata_list_cache[key]
-
-            for entry in self.dependent_entries.get(key,[]):
-                ## replace_metadata lines without keys apply to all
-                ## entries--special key '' used to clear deps on *all*
-                ## cache sets.
-                if entry == '':
-                    # logger.debug("clear in invalidate(%s)"%key)
-                    raise exceptions.CacheCleared('recursed')
-                self.invalidate(entry,new_seen_list)
-        except exceptions.CacheCleared as e:
-            # logger.debug(e)
+        self.counts['invalidated'] += 1
+        if self.invalidates is None:
+            self.invalidates = self.compile_invalidates()
+        entries = self.invalidates.get(key,(key,))
+        if entries is None:
+            # logger.debug("clear in invalidate(%s)"%key)
             self.clear()
-        # logger.debug(self.dependent_entries)
+            return
+        for entry in entries:
+            self.processed_metadata_cache.pop(entry,None)
+            self.processed_metadata_list_cache.pop(entry,None)
+
+    def compile_invalidates(self):
+        invalidates = {}
+        for key in self.dependent_entries:
+            seen = set([key])
+            todo = [key]
+            while todo:
+                for entry in self.dependent_entries.get(todo.pop(),()):
+                    if entry not in seen:
+                        seen.add(entry)
+                        todo.append(entry)
+            ## replace_metadata lines without keys apply to all
+            ## entries--special key '' used to clear deps on *all*
+            ## cache sets.
+            if '' in seen:
+                invalidates[key] = None
+            else:
+                invalidates[key] = frozenset(seen)
+        # logger.debug(invalidates)
+        return invalidates
 
     def add_dependencies(self,include_key,list_keys):
         for key in list_keys:
+            ## conditionals can use key_LIST, but invalidate() is
+            ## called with key.
+            key = key.replace('_LIST','')
             if key not in self.dependent_entries:
                 self.dependent_entries[key] = set()
             self.dependent_entries[key].add(include_key)
+        self.invalidates = None
+
+    def counts_since(self,before):
+        counts = dict((k,self.counts[k]-before.get(k,0)) for k in ('hits','misses','invalidated','cleared'))
+        looks = counts['hits']+counts['misses']
+        counts['rate'] = 100.0*counts['hits']/looks if looks else 0.0
+        return "hits:%(hits)d misses:%(misses)d (%(rate).0f%% hits) invalidated:%(invalidated)d cleared:%(cleared)d"%counts
 
     def set_cached_scalar(self,key,removeallentities,doreplacements,value):
         if key not in self.processed_metadata_cache:
@@ -759,8 +1325,12 @@ class MetadataCache:
         self.processed_metadata_cache[key][(removeallentities,doreplacements)] = value
 
     def is_cached_scalar(self,key,removeallentities,doreplacements):
-        return key in self.processed_metadata_cache \
-            and (removeallentities,doreplacements) in self.processed_metadata_cache[key]
+        if key in self.processed_metadata_cache \
+                and (removeallentities,doreplacements) in self.processed_metadata_cache[key]:
+            self.counts['hits'] += 1
+            return True
+        self.counts['misses'] += 1
+        return False
 
     def get_cached_scalar(self,key,removeallentities,doreplacements):
         return self.processed_metadata_cache[key][(removeallentities,doreplacements)]
@@ -772,8 +1342,12 @@ class MetadataCache:
         self.processed_metadata_list_cache[key][(removeallentities,doreplacements)] = value
 
     def is_cached_list(self,key,removeallentities,doreplacements):
-        return key in self.processed_metadata_list_cache \
-            and (removeallentities,doreplacements) in self.processed_metadata_list_cache[key]
+        if key in self.processed_metadata_list_cache \
+                and (removeallentities,doreplacements) in self.processed_metadata_list_cache[key]:
+            self.counts['hits'] += 1
+            return True
+        self.counts['misses'] += 1
+        return False
 
     def get_cached_list(self,key,removeallentities,doreplacements):
         return self.processed_metadata_list_cache[key][(removeallentities,doreplacements)]
@@ -790,17 +1364,37 @@ class Story(Requestable):
             self.metadata = {'version':'unknown'}
         self.metadata['python_version']=sys.version
         self.replacements = []
+        self.replacements_index = ReplacementsIndex(self.replacements)
         self.chapter_text_replacements = []
         self.in_ex_cludes = {}
         self.chapters = [] # chapters will be dict containing(url,title,html,etc)
+        ## BaseSiteAdapter.get_chapter_key() of each chapter, or None.
+        self.chapter_keys = []
+        ## chapter html, created by the first addChapter().
+        self.chapter_store = None
+        ## (title,html) after replace_chapter_text, by chapter index.
+        self.chapters_replaced = []
+        ## getChapters() results by the settings they depend on,
+        ## cleared by addChapter().
+        self.chapters_memo = {}
         self.extra_css = ""  # story-wide author-defined CSS, like AO3's workskins
         self.chapter_first = None
         self.chapter_last = None
 
-        self.img_store = ImageStore(dedup=self.getConfig('dedup_img_files'))
+        self.img_store = ImageStore(dedup=self.getConfig('dedup_img_files'),
+                                    max_memory=self.get_max_memory('image_store_max_memory'))
+        ## image_conversion_threads pool, created when first needed.
+        self.image_pool = None
+        ## imgurl -> Future for images being converted.
+        self.pending_imgs = {}
+        ## imgurl -> (data,exception) from prefetch_img_urls().
+        self.prefetched_imgs = {}
 
         self.metadata_cache = MetadataCache()
 
+        ## adapter's TimeKeeper, for convert_image() stage times.
+        self.times = None
+
         ## set include_in_ cache dependencies
         for entry in self.getValidMetaList():
             if self.hasConfig("include_in_"+entry):
@@ -809,6 +1403,7 @@ class Story(Requestable):
 
         self.cover=None # *href* of new cover image--need to create html.
         self.oldcover=None # (oldcoverhtmlhref,oldcoverhtmltype,oldcoverhtmldata,oldcoverimghref,oldcoverimgtype,oldcoverimgdata)
+        self.oldepub=None # epub being updated, chapters can be copied from it.
         self.calibrebookmark=None # cheesy way to carry calibre bookmark file forward across update.
         self.logfile=None # cheesy way to carry log file forward across update.
 
@@ -854,6 +1449,7 @@ class Story(Requestable):
                     self.addToList(metadata,val)
 
             self.replacements =  make_replacements(self.getConfig('replace_metadata'))
+            self.replacements_index = ReplacementsIndex(self.replacements)
 
             ## set replace_metadata conditional key cache dependencies
             for replaceline in self.replacements:
@@ -984,20 +1580,20 @@ class Story(Requestable):
         value = self.do_in_ex_clude('exclude_metadata_pre',value,key,seen_list)
 
         retlist = [value]
-        for replaceline in self.replacements:
-            (repl_line,metakeys,regexp,replacement,cond_match) = replaceline
-            # logger.debug("replacement tuple:%s"%replaceline)
-            # logger.debug("key:%s value:%s"%(key,value))
-            # logger.debug("value class:%s"%value.__class__.__name__)
-            if (metakeys == None or key in metakeys) \
-                    and isinstance(value,basestring) \
-                    and regexp.search(value):
+        if isinstance(value,basestring):
+            replacements = self.replacements_index.get(key)
+            (i,replaceline) = replacements.first_match(value,0)
+            while replaceline:
+                (repl_line,metakeys,regexp,replacement,cond_match) = replaceline
+                # logger.debug("replacement tuple:%s"%replaceline)
+                # logger.debug("key:%s value:%s"%(key,value))
                 # recursion on pattern, bail -- Compare by original text
                 # line because I saw an issue with duplicate lines in a
                 # huuuge replace list cause a problem.  Also allows dict()
                 # instead of list() for quicker lookups.
                 if repl_line in seen_list:
                     logger.info("Skipping replace_metadata line '%s' on %s to prevent infinite recursion."%(repl_line,key))
+                    (i,replaceline) = replacements.first_match(value,i+1)
                     continue
                 doreplace=True
                 if cond_match and cond_match.key() != key: # prevent infinite recursion.
@@ -1036,10 +1632,10 @@ class Story(Requestable):
                         except:
                             logger.error("Exception with replacement line,value:(%s),(%s)"%(repl_line,value))
                             raise
+                (i,replaceline) = replacements.first_match(value,i+1)
 
-        for val in retlist:
-            retlist = [ self.do_in_ex_clude('include_metadata_post',x,key=key,seen_list=seen_list) for x in retlist ]
-            retlist = [ self.do_in_ex_clude('exclude_metadata_post',x,key=key,seen_list=seen_list) for x in retlist ]
+        retlist = [ self.do_in_ex_clude('include_metadata_post',x,key=key,seen_list=seen_list) for x in retlist ]
+        retlist = [ self.do_in_ex_clude('exclude_metadata_post',x,key=key,seen_list=seen_list) for x in retlist ]
 
         if return_list:
             return retlist
@@ -1202,6 +1798,7 @@ class Story(Requestable):
         All single value *and* list value metadata as strings (unless
         keeplists=True, then keep lists).
         '''
+        before = dict(self.metadata_cache.counts)
         allmetadata = {}
 
         # special handling for authors/authorUrls
@@ -1255,6 +1852,7 @@ class Story(Requestable):
             else:
                 allmetadata[k] = self.getMetadata(k, removeallentities, doreplacements)
 
+        logger.debug("getAllMetadata metadata cache %s"%self.metadata_cache.counts_since(before))
         return allmetadata
 
     def get_sanitized_description(self):
@@ -1500,10 +2098,12 @@ class Story(Requestable):
         # logger.debug("getSubjectTags:%s"%subjectset.keys())
         return list(subjectset.keys())
 
-    def addChapter(self, chap, newchap=False):
+    def addChapter(self, chap, newchap=False, key=None):
         # logger.debug("addChapter(%s,%s)"%(chap,newchap))
-        chapter = defaultdict(unicode,chap) # default unknown to empty string
-        chapter['html'] = removeEntities(chapter['html'])
+        chapter = Chapter(chap) # default unknown to empty string
+        oldfile = isinstance(chapter['html'],OldChapterFile)
+        if not oldfile:
+            chapter['html'] = removeEntities(chapter['html'])
         if self.getConfig('strip_chapter_numbers') and \
                 self.getConfig('chapter_title_strip_pattern'):
             chapter['title'] = re.sub(self.getConfig('chapter_title_strip_pattern'),"",chapter['title'])
@@ -1517,10 +2117,17 @@ class Story(Requestable):
         ## index04 is to disambiguate, but index is kept for users'
         ## pre-existing settings.
         chapter['index']=chapter['index04']
+        if self.chapter_store is None:
+            self.chapter_store = ChapterStore(self.get_max_memory('chapter_store_max_memory'))
+        if not oldfile:
+            chapter.html = self.chapter_store.put(chapter['html'])
         self.chapters.append(chapter)
+        self.chapter_keys.append(key)
+        ## numbering and marked_new_chapters change with the count.
+        self.chapters_memo = {}
 
     def getChapters(self,fortoc=False):
-        "Chapters will be defaultdicts(unicode)"
+        "Chapters will be ChapterViews, unset keys are u''"
         retval = []
 
         ## only add numbers if more than one chapter.  Ditto (new) marks.
@@ -1549,37 +2156,64 @@ class Story(Requestable):
             tocpattern = defpattern
 
         # logger.debug("Patterns: (%s)(%s)"%(pattern,newpattern))
-        templ = string.Template(pattern)
-        newtempl = string.Template(newpattern)
-        toctempl = string.Template(tocpattern)
-
-        marked_new_chapters = 0
-        for index, chap in enumerate(self.chapters):
-            if chap['new'] or self.getMetadata('newforanthology'):
-                usetempl = newtempl
-                marked_new_chapters += 1
-            else:
-                usetempl = templ
-            # logger.debug("chap(%s)"%chap)
-            chapter = defaultdict(unicode,chap)
-            ## Due to poor planning on my part,
-            ## chapter_title_*_pattern expect index==1 not
-            ## index=0001 like output settings.  index04 is now
-            ## used, but index is still included for backward
-            ## compatibility.
-            chapter['title'] = self.do_chapter_text_replacements(chapter['title'])
-            chapter['index'] = chapter['number']
-            chapter['chapter'] = usetempl.substitute(chapter)
-            chapter['origtitle'] = templ.substitute(chapter)
-            chapter['toctitle'] = toctempl.substitute(chapter)
-            # set after, otherwise changes origtitle and toctitle
-            chapter['title'] = chapter['chapter']
-            ## chapter['html'] is a string.
-            chapter['html'] = self.do_chapter_text_replacements(chapter['html'])
-            retval.append(chapter)
+        newforanthology = self.getMetadata('newforanthology')
+        memokey = (pattern,newpattern,tocpattern,newforanthology)
+        if memokey not in self.chapters_memo:
+            templ = string.Template(pattern)
+            newtempl = string.Template(newpattern)
+            toctempl = string.Template(tocpattern)
+
+            marked_new_chapters = 0
+            for index, chap in enumerate(self.chapters):
+                if chap['new'] or newforanthology:
+                    usetempl = newtempl
+                    marked_new_chapters += 1
+                else:
+                    usetempl = templ
+                # logger.debug("chap(%s)"%chap)
+                chapter = chap.copy()
+                (title, html) = self.get_chapter_replaced(index)
+                ## Due to poor planning on my part,
+                ## chapter_title_*_pattern expect index==1 not
+                ## index=0001 like output settings.  index04 is now
+                ## used, but index is still included for backward
+                ## compatibility.
+                chapter.title = title
+                chapter.index = chapter.number
+                chapter.chapter = usetempl.substitute(chapter)
+                chapter.origtitle = templ.substitute(chapter)
+                chapter.toctitle = toctempl.substitute(chapter)
+                # set after, otherwise changes origtitle and toctitle
+                chapter.title = chapter.chapter
+                ## chapter.html is a string.
+                chapter.html = html
+                retval.append(chapter)
+            self.chapters_memo[memokey] = (retval,marked_new_chapters)
+        (memo,marked_new_chapters) = self.chapters_memo[memokey]
         if marked_new_chapters:
             self.setMetadata('marked_new_chapters',marked_new_chapters)
-        return retval
+        ## views, callers are free to change them.
+        return [ ChapterView(chapter) for chapter in memo ]
+
+    def get_chapter_replaced(self,index):
+        ## replace_chapter_text is only compiled once, so the results
+        ## for each chapter only need to be computed once.
+        while len(self.chapters_replaced) <= index:
+            chap = self.chapters[len(self.chapters_replaced)]
+            html = chap['html']
+            if isinstance(html,OldChapterFile):
+                ## replacements were done when the file was made.
+                replaced = html
+            else:
+                replaced = self.do_chapter_text_replacements(html)
+            if replaced == html:
+                ## keep the same stored text.
+                replaced = chap.html
+            else:
+                replaced = self.chapter_store.put(replaced)
+            self.chapters_replaced.append((self.do_chapter_text_replacements(chap['title']),
+                                           replaced))
+        return self.chapters_replaced[index]
 
     def do_chapter_text_replacements(self,data):
         '''
@@ -1649,7 +2283,19 @@ class Story(Requestable):
 
     # pass fetch in from adapter in case we need the cookies collected
     # as well as it's a base_story class method.
-    def addImgUrl(self,parenturl,url,fetch,cover=None,coverexclusion=None):
+    def addImgUrl(self,parenturl,url,fetch,cover=None,coverexclusion=None,pending=False):
+        '''
+        Returns (newsrc, imgurl).  With pending=True, returns a
+        function that returns (newsrc, imgurl) instead, and the image
+        may be converted in image_conversion_threads in the meantime.
+        Call them in the same order addImgUrl() was called.
+        '''
+        retval = self.add_img_url(parenturl,url,fetch,cover,coverexclusion,pending)
+        if pending and not callable(retval):
+            return lambda : retval
+        return retval
+
+    def add_img_url(self,parenturl,url,fetch,cover,coverexclusion,pending):
         logger.debug("addImgUrl(parenturl=%s,url=%s,cover=%s,coverexclusion=%s"%(parenturl,url,cover,coverexclusion))
 
         ## flaresolverr can't download images and browser_cache can be setup to ignore image,
@@ -1679,19 +2325,12 @@ class Story(Requestable):
                 # Decode the image data
                 imgdata = base64.b64decode(base64data)
                 imgurl = "file:///fakefile/img-data-image/"+hashlib.md5(imgdata).hexdigest()+"."+file_ext
+                refererurl = parenturl
             else:
                 # don't do anything to in-line images.
                 return (url, "inline image")
         else:
-            ## Mistakenly ended up with some // in image urls, like:
-            ## https://forums.spacebattles.com//styles/default/xenforo/clear.png
-            ## Removing one /, but not ://
-            if not url.startswith("file:"): # keep file:///
-                url = re.sub(r"([^:])//",r"\1/",url)
-            if url.startswith("http") or url.startswith("file:") or parenturl == None:
-                imgurl = url
-            else:
-                imgurl = urljoin(parenturl,url)
+            (imgurl,refererurl) = self.get_img_url_referer(parenturl,url)
 
         ## apply coverexclusion to specific covers, too.  Primarily for ffnet imageu.
         ## (Note that default and force covers don't pass cover_exclusion_regexp)
@@ -1701,6 +2340,10 @@ class Story(Requestable):
 
         self.img_store.debug_out()
         imginfo = self.img_store.get_img_by_url(imgurl)
+        if not imginfo and pending and imgurl in self.pending_imgs:
+            ## already being converted, will be in img_store by the
+            ## time this is called.
+            return lambda : self.addImgUrl(parenturl,url,fetch,cover,coverexclusion)
         if not imginfo:
             try:
                 if imgurl.startswith('failedtoload'):
@@ -1712,59 +2355,27 @@ class Story(Requestable):
 
                 if not imgdata:
                     # might already have from data:image in-line allow
-
-                    # allow referer to be forced for a few image sites
-                    # and authors who link images that watermark or
-                    # don't work anymore.
-                    refererurl = parenturl
-                    if( self.getConfig("force_img_self_referer_regexp") and
-                        re.search(self.getConfig("force_img_self_referer_regexp"),
-                                  url) ):
-                        refererurl = url
-                        logger.debug("Use Referer:%s"%refererurl)
-                    imgdata = fetch(imgurl,referer=refererurl,image=True)
-
-                if self.no_image_processing(imgurl):
-                    (data,ext,mime) = no_convert_image(imgurl,
-                                                       imgdata)
-                else:
-                    # logger.debug("Doing image processing on (%s)"%imgurl)
-                    try:
-                        sizes = [ int(x) for x in self.getConfigList('image_max_size',['580', '725']) ]
-                    except Exception as e:
-                        raise exceptions.FailedToDownload("Failed to parse image_max_size from personal.ini:%s\nException: %s"%(self.getConfigList('image_max_size'),e))
-                    grayscale = self.getConfig('grayscale_images')
-                    imgtype = self.getConfig('convert_images_to')
-                    if not imgtype:
-                        imgtype = "jpg"
-                    removetrans = self.getConfig('remove_transparency')
-                    removetrans = removetrans or grayscale or imgtype=="jpg"
-                    if 'ffdl-' in imgurl:
-                        raise exceptions.FailedToDownload("ffdl image is internal only...")
-                    bgcolor = self.getConfig('background_color','ffffff')
-                    if not bgcolor or len(bgcolor)<3 or len(bgcolor)>6 or not re.match(r"^[0-9a-fA-F]+$",bgcolor):
-                        logger.info("background_color(%s) needs to be a hexidecimal color--using ffffff instead."%bgcolor)
-                        bgcolor = 'ffffff'
-                    try:
-                        jpg_quality = int(self.getConfig('jpg_quality', '95'))
-                    except Exception as e:
-                        raise exceptions.FailedToDownload("Failed to parse jpg_quality as int from personal.ini:%s\nException: %s"%(self.getConfig('jpg_quality'),e))
-                    (data,ext,mime) = convert_image(imgurl,
-                                                    imgdata,
-                                                    sizes,
-                                                    grayscale,
-                                                    removetrans,
-                                                    imgtype,
-                                                    background="#"+bgcolor,
-                                                    jpg_quality=jpg_quality)
+                    if imgurl in self.prefetched_imgs:
+                        (imgdata,e) = self.prefetched_imgs.pop(imgurl)
+                        if e is not None:
+                            raise e
+                    else:
+                        imgdata = fetch(imgurl,referer=refererurl,image=True)
+
+                convert_args = self.get_convert_image_args(imgurl)
+                ## only while there can't be a first image cover,
+                ## that needs this image's data now.
+                if pending and not cover and \
+                        not (self.cover == None and self.getConfig('make_firstimage_cover')) and \
+                        self.get_image_pool():
+                    future = self.image_pool.submit(convert_image_with_args,imgurl,imgdata,convert_args,
+                                                    self.get_converted_image_cache(),self.times)
+                    self.pending_imgs[imgurl] = future
+                    return lambda : self.finish_img_url(parenturl,imgurl,future)
+                (data,ext,mime) = convert_image_with_args(imgurl,imgdata,convert_args,
+                                                          self.get_converted_image_cache(),self.times)
             except Exception as e:
-                try:
-                    logger.info("Failed to load or convert image, \nparent:%s\nskipping:%s\nException: %s"%(parenturl,imgurl,e))
-                except:
-                    logger.info("Failed to load or convert image, \nparent:%s\nskipping:%s\n(Exception output also caused exception)"%(parenturl,imgurl))
-                self.img_store.cache_failed_url(imgurl)
-                fs = "failedtoload %s"%imgurl
-                return (fs,'')
+                return self.failed_img_url(parenturl,imgurl,e)
 
             if not cover: # cover now handled below
                 imginfo = self.img_store.add_img(imgurl,
@@ -1830,6 +2441,184 @@ class Story(Requestable):
         # logger.debug("%s,%s"%(newsrc,imgurl))
         return (newsrc, imgurl)
 
+    def get_img_url_referer(self,parenturl,url):
+        '''
+        (imgurl,referer) addImgUrl() fetches a (not data:) image url
+        with.
+        '''
+        ## Mistakenly ended up with some // in image urls, like:
+        ## https://forums.spacebattles.com//styles/default/xenforo/clear.png
+        ## Removing one /, but not ://
+        if not url.startswith("file:"): # keep file:///
+            url = re.sub(r"([^:])//",r"\1/",url)
+        if url.startswith("http") or url.startswith("file:") or parenturl == None:
+            imgurl = url
+        else:
+            imgurl = urljoin(parenturl,url)
+
+        # allow referer to be forced for a few image sites
+        # and authors who link images that watermark or
+        # don't work anymore.
+        refererurl = parenturl
+        if( self.getConfig("force_img_self_referer_regexp") and
+            re.search(self.getConfig("force_img_self_referer_regexp"),
+                      url) ):
+            refererurl = url
+            logger.debug("Use Referer:%s"%refererurl)
+        return (imgurl,refererurl)
+
+    def prefetch_img_urls(self,parenturl,urls):
+        '''
+        Fetch the images for a list of (url,fetch) in
+        image_prefetch_threads, at most image_prefetch_per_host at a
+        time from each host.  addImgUrl() then uses the fetched data,
+        or raises the fetch's exception the same as if it had fetched
+        it itself.  Images already in the story aren't fetched.
+        '''
+        threads = int(self.getConfig('image_prefetch_threads') or 0)
+        if threads < 1 or not ThreadPoolExecutor:
+            return
+        ## direct_fetcher is always a plain RequestsFetcher.
+        if not self.direct_fetcher and not self.configuration.is_fetcher_thread_safe():
+            logger.debug("image_prefetch_threads skipped, fetcher may not be thread safe")
+            return
+        per_host = int(self.getConfig('image_prefetch_per_host') or 2)
+
+        hosts = OrderedDict()
+        for (url,fetch) in urls:
+            url = url.strip()
+            if url.startswith("data:") or url.startswith("failedtoload") or 'ffdl-' in url:
+                continue
+            (imgurl,refererurl) = self.get_img_url_referer(parenturl,url)
+            if imgurl in self.prefetched_imgs or \
+                    self.img_store.get_img_by_url(imgurl,actuallyused=False):
+                continue
+            ## None marks it as queued for dups in the list.
+            self.prefetched_imgs[imgurl] = None
+            hosts.setdefault(urlparse(imgurl).netloc,deque()).append((imgurl,refererurl,
+                                                                      self.direct_fetcher or fetch))
+        if not hosts:
+            return
+
+        def fetch_queue(queue):
+            while True:
+                try:
+                    (imgurl,refererurl,fetch) = queue.popleft()
+                except IndexError:
+                    return
+                try:
+                    self.prefetched_imgs[imgurl] = (fetch(imgurl,referer=refererurl,image=True),None)
+                except Exception as e:
+                    self.prefetched_imgs[imgurl] = (None,e)
+
+        logger.debug("prefetching %s images from %s hosts"%(sum([ len(q) for q in hosts.values() ]),
+                                                              len(hosts)))
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for queue in hosts.values():
+                for i in range(min(per_host,len(queue))):
+                    pool.submit(fetch_queue,queue)
+
+    def clear_prefetched_imgs(self):
+        self.prefetched_imgs = {}
+
+    def get_convert_image_args(self,imgurl):
+        '''
+        convert_image() args for convert_image_with_args(), None for
+        no_image_processing.
+        '''
+        if self.no_image_processing(imgurl):
+            return None
+        # logger.debug("Doing image processing on (%s)"%imgurl)
+        try:
+            sizes = [ int(x) for x in self.getConfigList('image_max_size',['580', '725']) ]
+        except Exception as e:
+            raise exceptions.FailedToDownload("Failed to parse image_max_size from personal.ini:%s\nException: %s"%(self.getConfigList('image_max_size'),e))
+        grayscale = self.getConfig('grayscale_images')
+        imgtype = self.getConfig('convert_images_to')
+        if not imgtype:
+            imgtype = "jpg"
+        removetrans = self.getConfig('remove_transparency')
+        removetrans = removetrans or grayscale or imgtype=="jpg"
+        if 'ffdl-' in imgurl:
+            raise exceptions.FailedToDownload("ffdl image is internal only...")
+        bgcolor = self.getConfig('background_color','ffffff')
+        if not bgcolor or len(bgcolor)<3 or len(bgcolor)>6 or not re.match(r"^[0-9a-fA-F]+$",bgcolor):
+            logger.info("background_color(%s) needs to be a hexidecimal color--using ffffff instead."%bgcolor)
+            bgcolor = 'ffffff'
+        try:
+            jpg_quality = int(self.getConfig('jpg_quality', '95'))
+        except Exception as e:
+            raise exceptions.FailedToDownload("Failed to parse jpg_quality as int from personal.ini:%s\nException: %s"%(self.getConfig('jpg_quality'),e))
+        return (sizes,grayscale,removetrans,imgtype,"#"+bgcolor,jpg_quality)
+
+    def get_converted_image_cache(self):
+        directory = self.getConfig('converted_image_cache_dir')
+        if not directory:
+            return None
+        try:
+            max_size = int(float(self.getConfig('converted_image_cache_size') or 100)*1024*1024)
+        except Exception as e:
+            raise exceptions.FailedToDownload("Failed to parse converted_image_cache_size from personal.ini:%s\nException: %s"%(self.getConfig('converted_image_cache_size'),e))
+        return get_converted_image_cache(directory,max_size)
+
+    def get_image_pool(self):
+        if self.image_pool is None and ThreadPoolExecutor:
+            threads = int(self.getConfig('image_conversion_threads') or 0)
+            if threads > 0:
+                self.image_pool = ThreadPoolExecutor(max_workers=threads)
+        return self.image_pool
+
+    def close_image_pool(self):
+        if self.image_pool is not None:
+            self.image_pool.shutdown()
+            self.image_pool = None
+
+    def get_max_memory(self,key):
+        ## *_store_max_memory settings are in MB.  None keeps
+        ## everything in memory.
+        max_memory = self.getConfig(key)
+        if not max_memory:
+            return None
+        try:
+            return int(float(max_memory)*1024*1024)
+        except ValueError:
+            logger.warning("%s(%s) is not a number, keeping everything in memory."%(key,max_memory))
+            return None
+
+    def close(self):
+        '''
+        Release the chapter and image temp files and the image
+        conversion pool.  Stored chapter texts and image data can't
+        be read after this, so only call it when done writing.
+        '''
+        self.close_image_pool()
+        if self.chapter_store is not None:
+            self.chapter_store.close()
+        self.img_store.close()
+
+    def finish_img_url(self,parenturl,imgurl,future):
+        try:
+            (data,ext,mime) = future.result()
+        except Exception as e:
+            return self.failed_img_url(parenturl,imgurl,e)
+        finally:
+            del self.pending_imgs[imgurl]
+        imginfo = self.img_store.add_img(imgurl,
+                                         ext,
+                                         mime,
+                                         data)
+        self.img_store.debug_out()
+        return (imginfo['newsrc'], imginfo['url'])
+
+    def failed_img_url(self,parenturl,imgurl,e):
+        try:
+            logger.info("Failed to load or convert image, \nparent:%s\nskipping:%s\nException: %s"%(parenturl,imgurl,e))
+        except:
+            logger.info("Failed to load or convert image, \nparent:%s\nskipping:%s\n(Exception output also caused exception)"%(parenturl,imgurl))
+        self.img_store.cache_failed_url(imgurl)
+        fs = "failedtoload %s"%imgurl
+        return (fs,'')
+
     def check_cover_min_size(self,imgdata):
         cover_big_enough = True
         if not self.no_image_processing():
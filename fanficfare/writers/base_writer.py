@@ -16,10 +16,14 @@
 #
 from __future__ import absolute_import
 
+import sys
 import os.path
 import datetime
+import time
+import zlib
+import struct
 import string
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, BadZipfile, ZIP_STORED, ZIP_DEFLATED
 import logging
 
 # py2 vs py3 transition
@@ -51,6 +55,9 @@ class BaseStoryWriter(Requestable):
         self.story.setMetadata('formatname',self.getFormatName())
         self.story.setMetadata('formatext',self.getFormatExt())
 
+        ## file extension -> deflate level, from zip_compression_levels.
+        self.zip_compression_levels = None
+
     def getMetadata(self,key, removeallentities=False):
         return stripHTML(self.story.getMetadata(key, removeallentities))
 
@@ -66,6 +73,71 @@ class BaseStoryWriter(Requestable):
     def getZipFileName(self):
         return self.story.formatFileName(self.getConfig('zip_filename'),self.getConfig('allow_unsafe_filename'))
 
+    def get_zip_compression_level(self,filename):
+        '''
+        zip_compression_levels level for filename inside epub and
+        zip_output files, None for the default level.
+        '''
+        if self.zip_compression_levels is None:
+            self.zip_compression_levels = {}
+            for entry in self.getConfigList('zip_compression_levels'):
+                try:
+                    (ext,level) = entry.rsplit(':',1)
+                    level = int(level)
+                    if level < 0 or level > 9:
+                        raise ValueError(level)
+                    self.zip_compression_levels[ext.strip().lower()] = level
+                except ValueError:
+                    logger.warning("zip_compression_levels entry(%s) should be <file extension>:<0-9>"%entry)
+        ext = ''
+        basename = filename.rsplit('/',1)[-1]
+        if '.' in basename:
+            ext = basename.rsplit('.',1)[-1].lower()
+        return self.zip_compression_levels.get(ext,self.zip_compression_levels.get('*'))
+
+    def zip_writestr(self,zipfile,filename,data,comment=None):
+        level = self.get_zip_compression_level(filename)
+        if comment is not None:
+            ## the same ZipInfo writestr() makes for a file name, plus
+            ## the comment.
+            zinfo = ZipInfo(filename,date_time=time.localtime(time.time())[:6])
+            zinfo.external_attr = 0o600 << 16
+            zinfo.compress_type = zipfile.compression
+            zinfo.comment = comment
+            filename = zinfo
+        if level is None:
+            zipfile.writestr(filename,data)
+        elif level == 0:
+            zipfile.writestr(filename,data,compress_type=ZIP_STORED)
+        elif sys.version_info >= (3,7):
+            zipfile.writestr(filename,data,compress_type=ZIP_DEFLATED,compresslevel=level)
+        else:
+            ## compresslevel is new in Python 3.7.
+            zipfile.writestr(filename,data,compress_type=ZIP_DEFLATED)
+
+    def zip_compress(self,filename,data):
+        '''
+        (ZipInfo,compressed data) for zip_write_compressed(), using
+        zip_compression_levels the same as zip_writestr().  Call
+        get_zip_compression_level() once first to use it in threads.
+        '''
+        level = self.get_zip_compression_level(filename)
+        zinfo = ZipInfo(filename,date_time=time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16 # same as writestr()
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        if level == 0:
+            zinfo.compress_type = ZIP_STORED
+            compressed = data
+        else:
+            zinfo.compress_type = ZIP_DEFLATED
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+                                          zlib.DEFLATED,
+                                          -15)
+            compressed = compressor.compress(data) + compressor.flush()
+        zinfo.compress_size = len(compressed)
+        return (zinfo,compressed)
+
     def _write(self, out, text):
         out.write(ensure_binary(text))
 
@@ -80,6 +152,7 @@ class BaseStoryWriter(Requestable):
         names as Story.metadata, but ENTRY should use label and value.
         """
         if self.getConfig("include_titlepage"):
+            before = dict(self.story.metadata_cache.counts)
 
             if self.hasConfig("titlepage_start"):
                 START = string.Template(self.getConfig("titlepage_start"))
@@ -134,6 +207,7 @@ class BaseStoryWriter(Requestable):
                     self._write(out, entry)
 
             self._write(out,END.substitute(self.story.getAllMetadata()))
+            logger.debug("writeTitlePage metadata cache %s"%self.story.metadata_cache.counts_since(before))
 
     def writeTOCPage(self, out, START, ENTRY, END):
         """
@@ -216,31 +290,42 @@ class BaseStoryWriter(Requestable):
                 # get full story now, just before writing.  Fetch
                 # before opening file.
                 self.story = self.adapter.getStory(notification)
-            outstream = open(outfilename,"wb")
+            ## Written to a temp file next to outfilename and renamed
+            ## over it when done, so a failed write doesn't leave a
+            ## partial file or lose the existing one.
+            tmpfilename = outfilename+".tmp"
+            outstream = open(tmpfilename,"wb")
         else:
             close=False
             logger.debug("Save to stream")
 
-        if not metaonly:
-            # get full story now, just before writing.  Okay if double
-            # called with above, it will only fetch once.
-            self.story = self.adapter.getStory(notification)
-        if self.getConfig('zip_output'):
-            out = BytesIO()
-            self.zipout = ZipFile(outstream, 'w', compression=ZIP_DEFLATED)
-            self.writeStoryImpl(out)
-            self.zipout.writestr(self.getBaseFileName(),out.getvalue())
-            # declares all the files created by Windows.  otherwise, when
-            # it runs in appengine, windows unzips the files as 000 perms.
-            for zf in self.zipout.filelist:
-                zf.create_system = 0
-            self.zipout.close()
-            out.close()
-        else:
-            self.writeStoryImpl(outstream)
+        try:
+            if not metaonly:
+                # get full story now, just before writing.  Okay if double
+                # called with above, it will only fetch once.
+                self.story = self.adapter.getStory(notification)
+            if self.getConfig('zip_output'):
+                out = BytesIO()
+                self.zipout = ZipFile(outstream, 'w', compression=ZIP_DEFLATED)
+                self.writeStoryImpl(out)
+                self.zip_writestr(self.zipout,self.getBaseFileName(),out.getvalue())
+                # declares all the files created by Windows.  otherwise, when
+                # it runs in appengine, windows unzips the files as 000 perms.
+                for zf in self.zipout.filelist:
+                    zf.create_system = 0
+                self.zipout.close()
+                out.close()
+            else:
+                self.writeStoryImpl(outstream)
+        except:
+            if close:
+                outstream.close()
+                os.remove(tmpfilename)
+            raise
 
         if close:
             outstream.close()
+            replace_file(tmpfilename,outfilename)
 
     def writeFile(self, filename, data):
         logger.debug("writeFile:%s"%filename)
@@ -249,7 +334,7 @@ class BaseStoryWriter(Requestable):
             outputdirs = os.path.dirname(self.getBaseFileName())
             if outputdirs:
                 filename=outputdirs+'/'+filename
-            self.zipout.writestr(filename,data)
+            self.zip_writestr(self.zipout,filename,data)
         else:
             outputdirs = os.path.dirname(self.outfilename)
             if outputdirs:
@@ -265,3 +350,56 @@ class BaseStoryWriter(Requestable):
 
     def writeStoryImpl(self, out):
         "Must be overriden by sub classes."
+
+def replace_file(src,dst):
+    if hasattr(os,'replace'):
+        os.replace(src,dst)
+    else:
+        ## py2 os.rename() won't replace an existing file on Windows.
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src,dst)
+
+## The ZipFile internals zip_write_compressed() and
+## zip_read_compressed() use, they follow Python 3's ZipFile.
+ZIP_WRITE_ATTRS = ('fp','start_dir','_lock','_seekable','_writecheck',
+                   '_didModify','filelist','NameToInfo')
+ZIP_READ_ATTRS = ('fp','_lock')
+
+def can_write_compressed(zipfile):
+    return all([ hasattr(zipfile,a) for a in ZIP_WRITE_ATTRS ])
+
+def can_read_compressed(zipfile):
+    return all([ hasattr(zipfile,a) for a in ZIP_READ_ATTRS ])
+
+def zip_write_compressed(zipfile,zinfo,compressed):
+    '''
+    Add a file from BaseStoryWriter.zip_compress() to zipfile.
+    ZipFile has no public way to add already compressed data, this
+    does what ZipFile.writestr() does with the data it compresses.
+    '''
+    with zipfile._lock:
+        if zipfile._seekable:
+            zipfile.fp.seek(zipfile.start_dir)
+        zinfo.header_offset = zipfile.fp.tell()
+        zipfile._writecheck(zinfo)
+        zipfile._didModify = True
+        zipfile.fp.write(zinfo.FileHeader())
+        zipfile.fp.write(compressed)
+        zipfile.start_dir = zipfile.fp.tell()
+        zipfile.filelist.append(zinfo)
+        zipfile.NameToInfo[zinfo.filename] = zinfo
+
+def zip_read_compressed(zipfile,zinfo):
+    '''
+    The still compressed data of zinfo in zipfile opened for reading,
+    to copy to another zip with zip_write_compressed().
+    '''
+    with zipfile._lock:
+        zipfile.fp.seek(zinfo.header_offset)
+        header = zipfile.fp.read(30)
+        if header[0:4] != b'PK\x03\x04':
+            raise BadZipfile("Bad local file header for %s"%zinfo.filename)
+        (namelen,extralen) = struct.unpack('<HH',header[26:30])
+        zipfile.fp.seek(zinfo.header_offset+30+namelen+extralen)
+        return zipfile.fp.read(zinfo.compress_size)
@@ -18,8 +18,10 @@
 from __future__ import absolute_import
 import logging
 import string
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
 import re
+import zlib
+from collections import deque
 
 # py2 vs py3 transition
 from ..six import text_type as unicode
@@ -31,14 +33,22 @@ from io import BytesIO
 ## use DOM to generate the XML files.
 from xml.dom.minidom import getDOMImplementation
 
-import bs4
+from .base_writer import BaseStoryWriter, can_write_compressed, can_read_compressed, zip_read_compressed, zip_write_compressed
+from ..htmlcleanup import stripHTML,removeEntities,internalize_links
+from ..story import commaGroups, OldChapterFile
+from ..epubutils import chapter_file_key
 
-from .base_writer import BaseStoryWriter
-from ..htmlcleanup import stripHTML,removeEntities
-from ..story import commaGroups
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # py2 without the futures backport, chapters written in turn.
+    ThreadPoolExecutor = None
 
 logger = logging.getLogger(__name__)
 
+## One newline after each </p> and <br/> in chapter files.
+p_br_newlines_re = re.compile(r'(</p>|<br ?/>)\n*')
+
 class EpubWriter(BaseStoryWriter):
 
     @staticmethod
@@ -337,24 +347,13 @@ div { margin: 0pt; padding: 0pt; }
         else:
             self.use_oldcover = False
 
-        ## Python 2.5 ZipFile is rather more primative than later
-        ## versions.  It can operate on a file, or on a BytesIO, but
-        ## not on an open stream.  OTOH, I suspect we would have had
-        ## problems with closing and opening again to change the
-        ## compression type anyway.
-        zipio = BytesIO()
-
-        ## mimetype must be first file and uncompressed.  Python 2.5
-        ## ZipFile can't change compression type file-by-file, so we
-        ## have to close and re-open
-        outputepub = ZipFile(zipio, 'w', compression=ZIP_STORED)
+        ## Files are compressed and written to out as they're added,
+        ## the whole epub is never kept in memory.
+        outputepub = ZipFile(out, 'w', compression=ZIP_DEFLATED)
         outputepub.debug=3
-        outputepub.writestr('mimetype','application/epub+zip')
-        outputepub.close()
 
-        ## Re-open file for content.
-        outputepub = ZipFile(zipio, 'a', compression=ZIP_DEFLATED)
-        outputepub.debug=3
+        ## mimetype must be first file and uncompressed.
+        outputepub.writestr('mimetype','application/epub+zip',compress_type=ZIP_STORED)
 
         epub3 = self.getConfig("epub_version",default="2.0").startswith("3")
         # epub3 wants manifest items that have <svg> tags marked.  I
@@ -366,11 +365,11 @@ div { margin: 0pt; padding: 0pt; }
         ## Only need to check for svg with epub3.
         if epub3:
             def write_to_epub(href, data):
-                outputepub.writestr(href,data)
+                self.zip_writestr(outputepub,href,data)
                 svg_files[href] = b'<svg' in ensure_binary(data)
         else:
             def write_to_epub(href, data):
-                outputepub.writestr(href,data)
+                self.zip_writestr(outputepub,href,data)
 
         ## Create META-INF/container.xml file.  The only thing it does is
         ## point to content.opf
@@ -399,30 +398,28 @@ div { margin: 0pt; padding: 0pt; }
             self.story.getList('authorId')[0],
             self.getMetadata('storyId'))
 
-        contentdom = getDOMImplementation().createDocument(None, "package", None)
-        package = contentdom.documentElement
+        ## content.opf is written with PrettyXMLWriter after the
+        ## chapters, these collect what goes in it until then.
+        package = [] # (name,value) attributes
         ## might want 3.1 or something in future.
         if epub3:
-            package.setAttribute("version","3.0")
+            package.append(("version","3.0"))
             ## for the calibre: settings, especially calibre:title-page
-            package.setAttribute("prefix","calibre: https://calibre-ebook.com")
+            package.append(("prefix","calibre: https://calibre-ebook.com"))
         else:
-            package.setAttribute("version","2.0")
-        logger.info("Saving EPUB Version "+package.getAttribute("version"))
-        package.setAttribute("xmlns","http://www.idpf.org/2007/opf")
-        package.setAttribute("unique-identifier","fanficfare-uid")
-        metadata=newTag(contentdom,"metadata",
-                        attrs={"xmlns:dc":"http://purl.org/dc/elements/1.1/",
-                               "xmlns:opf":"http://www.idpf.org/2007/opf"})
-        package.appendChild(metadata)
-
-        metadata.appendChild(newTag(contentdom,"dc:identifier",
-                                    text=uniqueid,
-                                    attrs={"id":"fanficfare-uid"}))
+            package.append(("version","2.0"))
+        logger.info("Saving EPUB Version "+package[0][1])
+        package.append(("xmlns","http://www.idpf.org/2007/opf"))
+        package.append(("unique-identifier","fanficfare-uid"))
+        metadata = [] # xmlTag()s
+
+        metadata.append(xmlTag("dc:identifier",
+                               text=uniqueid,
+                               attrs={"id":"fanficfare-uid"}))
 
         if self.getMetadata('title'):
-            metadata.appendChild(newTag(contentdom,"dc:title",text=self.getMetadata('title'),
-                                        attrs={"id":"id"}))
+            metadata.append(xmlTag("dc:title",text=self.getMetadata('title'),
+                                   attrs={"id":"id"}))
 
         def creator_attrs(idnum):
             if epub3:
@@ -433,25 +430,25 @@ div { margin: 0pt; padding: 0pt; }
         if self.getMetadata('author'):
             if self.story.isList('author'):
                 for auth in self.story.getList('author'):
-                    metadata.appendChild(newTag(contentdom,"dc:creator",
-                                                attrs=creator_attrs(idnum),
-                                                text=auth))
+                    metadata.append(xmlTag("dc:creator",
+                                           attrs=creator_attrs(idnum),
+                                           text=auth))
                     idnum += 1
             else:
-                metadata.appendChild(newTag(contentdom,"dc:creator",
-                                            attrs=creator_attrs(idnum),
-                                            text=self.getMetadata('author')))
+                metadata.append(xmlTag("dc:creator",
+                                       attrs=creator_attrs(idnum),
+                                       text=self.getMetadata('author')))
                 idnum += 1
 
-        metadata.appendChild(newTag(contentdom,"dc:contributor",text="FanFicFare [https://github.com/JimmXinu/FanFicFare]",
-                                    attrs={"id":"id-%d"%idnum}))
+        metadata.append(xmlTag("dc:contributor",text="FanFicFare [https://github.com/JimmXinu/FanFicFare]",
+                               attrs={"id":"id-%d"%idnum}))
         idnum += 1
-        # metadata.appendChild(newTag(contentdom,"dc:rights",text=""))
+        # metadata.append(xmlTag("dc:rights",text=""))
         if self.story.getMetadata('langcode'):
             langcode=self.story.getMetadata('langcode')
         else:
             langcode='en'
-        metadata.appendChild(newTag(contentdom,"dc:language",text=langcode))
+        metadata.append(xmlTag("dc:language",text=langcode))
 
         #  published, created, updated, calibre
         #  Leave calling self.story.getMetadataRaw directly in case date format changes.
@@ -459,27 +456,27 @@ div { margin: 0pt; padding: 0pt; }
             ## epub3 requires an updated modified date on every change of
             ## any kind, not just *content* change.
             from ..dateutils import utcnow
-            metadata.appendChild(newTag(contentdom,"meta",
-                                        attrs={"property":"dcterms:modified"},
-                                        text=utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")))
+            metadata.append(xmlTag("meta",
+                                   attrs={"property":"dcterms:modified"},
+                                   text=utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")))
         else:
             if self.story.getMetadataRaw('datePublished'):
-                metadata.appendChild(newTag(contentdom,"dc:date",
-                                            attrs={"opf:event":"publication"},
-                                            text=self.story.getMetadataRaw('datePublished').strftime("%Y-%m-%d")))
+                metadata.append(xmlTag("dc:date",
+                                       attrs={"opf:event":"publication"},
+                                       text=self.story.getMetadataRaw('datePublished').strftime("%Y-%m-%d")))
 
             if self.story.getMetadataRaw('dateCreated'):
-                metadata.appendChild(newTag(contentdom,"dc:date",
-                                            attrs={"opf:event":"creation"},
-                                            text=self.story.getMetadataRaw('dateCreated').strftime("%Y-%m-%d")))
+                metadata.append(xmlTag("dc:date",
+                                       attrs={"opf:event":"creation"},
+                                       text=self.story.getMetadataRaw('dateCreated').strftime("%Y-%m-%d")))
 
             if self.story.getMetadataRaw('dateUpdated'):
-                metadata.appendChild(newTag(contentdom,"dc:date",
-                                            attrs={"opf:event":"modification"},
-                                            text=self.story.getMetadataRaw('dateUpdated').strftime("%Y-%m-%d")))
-                metadata.appendChild(newTag(contentdom,"meta",
-                                            attrs={"name":"calibre:timestamp",
-                                                   "content":self.story.getMetadataRaw('dateUpdated').strftime("%Y-%m-%dT%H:%M:%S")}))
+                metadata.append(xmlTag("dc:date",
+                                       attrs={"opf:event":"modification"},
+                                       text=self.story.getMetadataRaw('dateUpdated').strftime("%Y-%m-%d")))
+                metadata.append(xmlTag("meta",
+                                       attrs={"name":"calibre:timestamp",
+                                              "content":self.story.getMetadataRaw('dateUpdated').strftime("%Y-%m-%dT%H:%M:%S")}))
 
         series = self.story.getMetadata('series')
         if series and self.getConfig('calibre_series_meta'):
@@ -496,62 +493,62 @@ div { margin: 0pt; padding: 0pt; }
                 ## calibre series is the only float at this time)
                 series_index = "%.2f" % float(series_index)
 
-            metadata.appendChild(newTag(contentdom,"meta",
-                                        attrs={"name":"calibre:series",
-                                               "content":series}))
-            metadata.appendChild(newTag(contentdom,"meta",
-                                        attrs={"name":"calibre:series_index",
-                                               "content":series_index}))
+            metadata.append(xmlTag("meta",
+                                   attrs={"name":"calibre:series",
+                                          "content":series}))
+            metadata.append(xmlTag("meta",
+                                   attrs={"name":"calibre:series_index",
+                                          "content":series_index}))
 
         if self.getMetadata('description'):
-            metadata.appendChild(newTag(contentdom,"dc:description",text=
-                                        self.getMetadata('description')))
+            metadata.append(xmlTag("dc:description",text=
+                                   self.getMetadata('description')))
 
         for subject in self.story.getSubjectTags():
-            metadata.appendChild(newTag(contentdom,"dc:subject",text=subject))
+            metadata.append(xmlTag("dc:subject",text=subject))
 
 
         if self.getMetadata('site'):
-            metadata.appendChild(newTag(contentdom,"dc:publisher",
-                                        text=self.getMetadata('site')))
+            metadata.append(xmlTag("dc:publisher",
+                                   text=self.getMetadata('site')))
 
         if self.getMetadata('storyUrl'):
             if epub3:
-                metadata.appendChild(newTag(contentdom,"dc:identifier",
-                                            text="URL:"+self.getMetadata('storyUrl')))
+                metadata.append(xmlTag("dc:identifier",
+                                       text="URL:"+self.getMetadata('storyUrl')))
             else:
-                metadata.appendChild(newTag(contentdom,"dc:identifier",
-                                            attrs={"opf:scheme":"URL"},
-                                            text=self.getMetadata('storyUrl')))
-            metadata.appendChild(newTag(contentdom,"dc:source",
-                                        text=self.getMetadata('storyUrl')))
+                metadata.append(xmlTag("dc:identifier",
+                                       attrs={"opf:scheme":"URL"},
+                                       text=self.getMetadata('storyUrl')))
+            metadata.append(xmlTag("dc:source",
+                                   text=self.getMetadata('storyUrl')))
 
         if epub3:
             # <meta refines="#id" property="title-type">main</meta>
-            metadata.appendChild(newTag(contentdom,"meta",
-                                        attrs={"property":"title-type",
-                                               "refines":"#id",
-                                               },
-                                        text="main"))
+            metadata.append(xmlTag("meta",
+                                   attrs={"property":"title-type",
+                                          "refines":"#id",
+                                          },
+                                   text="main"))
 
             # epub3 removes attrs that identify dc:creator and
             # dc:contributor types and instead put them here.
             # 'aut' for 1-(idnum-1)
             for j in range(1,idnum-1):
                 #<meta property="role" refines="#id-1" scheme="marc:relators">aut</meta>
-                metadata.appendChild(newTag(contentdom,"meta",
-                                            attrs={"property":"role",
-                                                   "refines":"#id-%d"%j,
-                                                   "scheme":"marc:relators",
-                                                   },
-                                            text="aut"))
-
-            metadata.appendChild(newTag(contentdom,"meta",
-                                        attrs={"property":"role",
-                                               "refines":"#id-%d"%(idnum-1),
-                                               "scheme":"marc:relators",
-                                               },
-                                        text="bkp"))
+                metadata.append(xmlTag("meta",
+                                       attrs={"property":"role",
+                                              "refines":"#id-%d"%j,
+                                              "scheme":"marc:relators",
+                                              },
+                                       text="aut"))
+
+            metadata.append(xmlTag("meta",
+                                   attrs={"property":"role",
+                                          "refines":"#id-%d"%(idnum-1),
+                                          "scheme":"marc:relators",
+                                          },
+                                   text="bkp"))
 
         ## end of metadata, create manifest.
         items = [] # list of (id, href, type, title) tuples(all strings)
@@ -581,12 +578,12 @@ div { margin: 0pt; padding: 0pt; }
                           None))
             items.append(("cover",oldcoverhtmlhref,oldcoverhtmltype,None))
             itemrefs.append("cover")
-            metadata.appendChild(newTag(contentdom,"meta",{"content":coverimgid,
-                                                           "name":"cover"}))
-            guide = newTag(contentdom,"guide")
-            guide.appendChild(newTag(contentdom,"reference",attrs={"type":"cover",
-                                                                   "title":"Cover",
-                                                                   "href":oldcoverhtmlhref}))
+            # Nook insists on name before content.
+            metadata.append(xmlTag("meta",[("name","cover"),
+                                           ("content",coverimgid)]))
+            guide = [xmlTag("reference",attrs={"type":"cover",
+                                               "title":"Cover",
+                                               "href":oldcoverhtmlhref})]
             imgcount+=1
 
         if self.getConfig('include_images'):
@@ -615,17 +612,17 @@ div { margin: 0pt; padding: 0pt; }
             itemrefs.append("cover")
             #
             # <meta name="cover" content="cover.jpg"/>
-            metadata.appendChild(newTag(contentdom,"meta",{"content":coverimgid,
-                                                           "name":"cover"}))
+            # Nook insists on name before content.
+            metadata.append(xmlTag("meta",[("name","cover"),
+                                           ("content",coverimgid)]))
             # cover stuff for later:
             # at end of <package>:
             # <guide>
             # <reference type="cover" title="Cover" href="Text/cover.xhtml"/>
             # </guide>
-            guide = newTag(contentdom,"guide")
-            guide.appendChild(newTag(contentdom,"reference",attrs={"type":"cover",
-                                                       "title":"Cover",
-                                                       "href":"OEBPS/cover.xhtml"}))
+            guide = [xmlTag("reference",attrs={"type":"cover",
+                                               "title":"Cover",
+                                               "href":"OEBPS/cover.xhtml"})]
 
             if self.hasConfig("cover_content"):
                 COVER = string.Template(self.getConfig("cover_content"))
@@ -726,63 +723,141 @@ div { margin: 0pt; padding: 0pt; }
         else:
             CHAPTER_END = self.EPUB_CHAPTER_END
 
-        for index, chap in enumerate(self.story.getChapters()): # (url,title,html)
-            # logger.debug("chapter:%s %s %s"%(len(chap['html']), chap['title'],chap['url']))
-            if chap['html']:
-                chap_data = chap['html']
-                if self.getConfig('internalize_text_links'):
-                    soup = bs4.BeautifulSoup(chap['html'],'html5lib')
-                    changed=False
-                    for alink in soup.find_all('a'):
-                        ## Chapters can be inserted in the middle
-                        ## which can break existing internal links.
-                        ## So let's save the original href and update.
-                        # logger.debug("found %s"%alink)
-                        if alink.has_attr('data-orighref') and alink['data-orighref'] in chapurlmap:
-                            alink['href']=chapurlmap[alink['data-orighref']]
-                            # logger.debug("set1  %s"%alink)
-                            changed=True
-                        elif alink.has_attr('href') and alink['href'] in chapurlmap:
-                            if not alink['href'].startswith('file'):
-                                # only save orig href if not already internal.
-                                alink['data-orighref']=alink['href']
-                            alink['href']=chapurlmap[alink['href']]
-                            # logger.debug("set2  %s"%alink)
-                            changed=True
-                    if changed:
-                        chap_data = unicode(soup)
-                        # Don't want html, head or body tags in
-                        # chapter html--bs4 insists on adding them.
-                        chap_data = re.sub(r"</?(html|head|body)[^>]*>\r?\n?","",chap_data)
-
-                # logger.debug('Writing chapter text for: %s' % chap.title)
-                chap['url']=removeEntities(chap['url'])
-                chap['chapter']=removeEntities(chap['chapter'])
-                chap['title']=removeEntities(chap['title'])
-                chap['origchapter']=removeEntities(chap['origtitle'])
-                chap['tocchapter']=removeEntities(chap['toctitle'])
-                # escape double quotes in all vals.
-                for k,v in chap.items():
-                    if isinstance(v,basestring): chap[k]=v.replace('"','&quot;')
-                fullhtml = CHAPTER_START.substitute(chap) + \
-                    chap_data.strip() + \
-                    CHAPTER_END.substitute(chap)
-                # strip to avoid ever growning numbers of newlines.
-                # ffnet(& maybe others) gives the whole chapter text
-                # as one line.  This causes problems for nook(at
-                # least) when the chapter size starts getting big
-                # (200k+)
-                fullhtml = re.sub(r'(</p>|<br ?/>)\n*',r'\1\n',fullhtml)
-
-                # logger.debug("write OEBPS/file%s.xhtml"%chap['index04'])
-                write_to_epub("OEBPS/file%s.xhtml"%chap['index04'],fullhtml.encode('utf-8'))
-                del fullhtml
+        internalize_text_links = self.getConfig('internalize_text_links')
+        def make_chapter(chap):
+            ## (href,xhtml) for a chapter, None if it has no html.
+            if not chap['html']:
+                return None
+            chap_data = chap['html']
+            if internalize_text_links:
+                chap_data = internalize_links(chap_data,chapurlmap,keep_orighref=True)
+
+            # logger.debug('Writing chapter text for: %s' % chap.title)
+            chap['url']=removeEntities(chap['url'])
+            chap['chapter']=removeEntities(chap['chapter'])
+            chap['title']=removeEntities(chap['title'])
+            chap['origchapter']=removeEntities(chap['origtitle'])
+            chap['tocchapter']=removeEntities(chap['toctitle'])
+            # escape double quotes in all vals.
+            for k,v in chap.items():
+                if isinstance(v,basestring): chap[k]=v.replace('"','&quot;')
+            fullhtml = CHAPTER_START.substitute(chap) + \
+                chap_data.strip() + \
+                CHAPTER_END.substitute(chap)
+            # strip to avoid ever growning numbers of newlines.
+            # ffnet(& maybe others) gives the whole chapter text
+            # as one line.  This causes problems for nook(at
+            # least) when the chapter size starts getting big
+            # (200k+)
+            fullhtml = p_br_newlines_re.sub(r'\1\n',fullhtml)
+
+            return ("OEBPS/file%s.xhtml"%chap['index04'],fullhtml.encode('utf-8'))
+
+        def file_key(index,data):
+            ## chapter_file_key() for a chapter's new file, saved as
+            ## its zip comment.  None without a chapter key.
+            chapterkey = self.story.chapter_keys[index]
+            if not chapterkey:
+                return None
+            crc = zlib.crc32(data) & 0xffffffff
+            if internalize_text_links:
+                return chapter_file_key(chapterkey,crc,len(data),data.decode('utf-8'),chapurlmap)
+            return chapter_file_key(chapterkey,crc,len(data))
+
+        def make_compressed_chapter(index,chap):
+            (href,data) = make_chapter(chap)
+            (zinfo,compressed) = self.zip_compress(href,data)
+            svg = b'<svg' in data
+            key = file_key(index,data)
+            if key:
+                zinfo.comment = key + (b' svg' if svg else b'')
+            return (zinfo,compressed,svg)
+
+        chapters = self.story.getChapters() # (url,title,html)
+        oldepub = None
+        reused = []
+        if [ chap for chap in chapters if isinstance(chap['html'],OldChapterFile) ]:
+            oldepub = ZipFile(self.story.oldepub, 'r')
+
+        def copy_old_chapter(chap):
+            ## unchanged chapter file from the old epub, still
+            ## compressed when possible.
+            href = "OEBPS/file%s.xhtml"%chap['index04']
+            oldinfo = oldepub.getinfo(chap['html'].href)
+            if( can_write_compressed(outputepub) and can_read_compressed(oldepub) and
+                oldinfo.compress_type in (ZIP_STORED, ZIP_DEFLATED) and
+                not oldinfo.flag_bits & 0x1 ): # not encrypted
+                zinfo = ZipInfo(href,date_time=oldinfo.date_time)
+                for a in ('compress_type','external_attr','file_size','compress_size','CRC','comment'):
+                    setattr(zinfo,a,getattr(oldinfo,a))
+                zip_write_compressed(outputepub,zinfo,zip_read_compressed(oldepub,oldinfo))
+            else:
+                self.zip_writestr(outputepub,href,oldepub.read(oldinfo),comment=oldinfo.comment)
+            svg_files[href] = oldinfo.comment.endswith(b' svg')
+            reused.append(href)
+
+        def write_chapter(index,chap,future=None):
+            if isinstance(chap['html'],OldChapterFile):
+                copy_old_chapter(chap)
+            elif future:
+                (zinfo,compressed,svg) = future.result()
+                zip_write_compressed(outputepub,zinfo,compressed)
+                svg_files[zinfo.filename] = svg
+            else:
+                (href,data) = make_chapter(chap)
+                svg = b'<svg' in data
+                key = file_key(index,data)
+                self.zip_writestr(outputepub,href,data,
+                                  comment=key + (b' svg' if svg else b'') if key else None)
+                svg_files[href] = svg
+
+        try:
+            threads = int(self.getConfig('epub_write_threads') or 0)
+            if not ThreadPoolExecutor or not can_write_compressed(outputepub):
+                threads = 0
+            if threads > 0:
+                ## Chapters made and compressed in epub_write_threads,
+                ## written in order as they're done.  A few are
+                ## started ahead of the one being written.
+                pool = ThreadPoolExecutor(max_workers=threads)
+                pending = deque()
+                try:
+                    for index, chap in enumerate(chapters):
+                        if not chap['html']:
+                            continue
+                        future = None
+                        if not isinstance(chap['html'],OldChapterFile):
+                            future = pool.submit(make_compressed_chapter,index,chap)
+                        pending.append((index,chap,future))
+                        if len(pending) > threads*4:
+                            write_chapter(*pending.popleft())
+                    while pending:
+                        write_chapter(*pending.popleft())
+                finally:
+                    pool.shutdown()
+            else:
+                for index, chap in enumerate(chapters):
+                    # logger.debug("chapter:%s %s %s"%(len(chap['html']), chap['title'],chap['url']))
+                    if chap['html']:
+                        write_chapter(index,chap)
+        finally:
+            if oldepub:
+                oldepub.close()
+                logger.debug("Copied %s unchanged chapters from old epub"%len(reused))
 
         if self.story.calibrebookmark:
             write_to_epub("META-INF/calibre_bookmarks.txt",self.story.calibrebookmark)
 
-        manifest = contentdom.createElement("manifest")
-        package.appendChild(manifest)
+        contentxml = PrettyXMLWriter()
+        contentxml.start("package",package)
+        contentxml.start("metadata",
+                         attrs={"xmlns:dc":"http://purl.org/dc/elements/1.1/",
+                                "xmlns:opf":"http://www.idpf.org/2007/opf"})
+        for tag in metadata:
+            contentxml.element(*tag)
+        contentxml.end()
+
+        contentxml.start("manifest")
         for item in items:
             (id,href,type,title)=item
             attrs = {'id':id,
@@ -801,65 +876,60 @@ div { margin: 0pt; padding: 0pt; }
                     props.append('svg')
                 if props:
                     attrs['properties'] = ' '.join(props)
-            manifest.appendChild(newTag(contentdom, "item", attrs=attrs))
+            contentxml.element("item",attrs=attrs)
         if epub3:
             # epub3 nav
             # <item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>
-            manifest.appendChild(newTag(contentdom,"item",
-                                        attrs={'href':'nav.xhtml',
-                                               'id':'nav',
-                                               'media-type':'application/xhtml+xml',
-                                               'properties':'nav'
-                                               }))
-
-
-        spine = newTag(contentdom,"spine",attrs={"toc":"ncx"})
+            contentxml.element("item",
+                               attrs={'href':'nav.xhtml',
+                                      'id':'nav',
+                                      'media-type':'application/xhtml+xml',
+                                      'properties':'nav'
+                                      })
+        contentxml.end()
+
+        spineattrs = {"toc":"ncx"}
         if self.getConfig('page_progression_direction_rtl'):
-            spine.setAttribute("page-progression-direction","rtl")
-        package.appendChild(spine)
+            spineattrs["page-progression-direction"] = "rtl"
+        contentxml.start("spine",attrs=spineattrs)
         for itemref in itemrefs:
-            spine.appendChild(newTag(contentdom,"itemref",
-                                     attrs={"idref":itemref,
-                                            "linear":"yes"}))
+            contentxml.element("itemref",
+                               attrs={"idref":itemref,
+                                      "linear":"yes"})
+        contentxml.end()
         # guide only exists if there's a cover.
         if guide:
-            package.appendChild(guide)
+            contentxml.start("guide")
+            for tag in guide:
+                contentxml.element(*tag)
+            contentxml.end()
+        contentxml.end()
 
         # write content.opf to zip.
-        contentxml = contentdom.toprettyxml(encoding='utf-8')
-        # tweak for brain damaged Nook STR.  Nook insists on name before content.
-        contentxml = contentxml.replace(ensure_binary('<meta content="%s" name="cover"/>'%coverimgid),
-                                        ensure_binary('<meta name="cover" content="%s"/>'%coverimgid))
-
         # write_to_epub used, but already passed using svg_files
-        write_to_epub("content.opf",contentxml)
-
-        contentdom.unlink()
-        del contentdom
+        write_to_epub("content.opf",contentxml.getvalue())
+        del contentxml
 
         ## create toc.ncx file
-        tocncxdom = getDOMImplementation().createDocument(None, "ncx", None)
-        ncx = tocncxdom.documentElement
-        ncx.setAttribute("version","2005-1")
-        ncx.setAttribute("xmlns","http://www.daisy.org/z3986/2005/ncx/")
-        head = tocncxdom.createElement("head")
-        ncx.appendChild(head)
-        head.appendChild(newTag(tocncxdom,"meta",
-                                attrs={"name":"dtb:uid", "content":uniqueid}))
-        head.appendChild(newTag(tocncxdom,"meta",
-                                attrs={"name":"dtb:depth", "content":"1"}))
-        head.appendChild(newTag(tocncxdom,"meta",
-                                attrs={"name":"dtb:totalPageCount", "content":"0"}))
-        head.appendChild(newTag(tocncxdom,"meta",
-                                attrs={"name":"dtb:maxPageNumber", "content":"0"}))
-
-        docTitle = tocncxdom.createElement("docTitle")
-        docTitle.appendChild(newTag(tocncxdom,"text",text=self.getMetadata('title')))
-        ncx.appendChild(docTitle)
-
-        tocnavMap = tocncxdom.createElement("navMap")
-        ncx.appendChild(tocnavMap)
-
+        tocncx = PrettyXMLWriter()
+        tocncx.start("ncx",attrs={"version":"2005-1",
+                                  "xmlns":"http://www.daisy.org/z3986/2005/ncx/"})
+        tocncx.start("head")
+        tocncx.element("meta",
+                       attrs={"name":"dtb:uid", "content":uniqueid})
+        tocncx.element("meta",
+                       attrs={"name":"dtb:depth", "content":"1"})
+        tocncx.element("meta",
+                       attrs={"name":"dtb:totalPageCount", "content":"0"})
+        tocncx.element("meta",
+                       attrs={"name":"dtb:maxPageNumber", "content":"0"})
+        tocncx.end()
+
+        tocncx.start("docTitle")
+        tocncx.element("text",text=self.getMetadata('title'))
+        tocncx.end()
+
+        tocncx.start("navMap")
         # <navPoint id="<id>" playOrder="<risingnumberfrom0>">
         #   <navLabel>
         #     <text><chapter title></text>
@@ -871,57 +941,54 @@ div { margin: 0pt; padding: 0pt; }
             (id,href,type,title)=item
             # only items to be skipped, cover.xhtml, images, toc.ncx, stylesheet.css, should have no title.
             if title :
-                navPoint = newTag(tocncxdom,"navPoint",
-                                  attrs={'id':id,
-                                         'playOrder':unicode(index)})
-                tocnavMap.appendChild(navPoint)
-                navLabel = newTag(tocncxdom,"navLabel")
-                navPoint.appendChild(navLabel)
-                ## the xml library will re-escape as needed.
-                navLabel.appendChild(newTag(tocncxdom,"text",text=stripHTML(title)))
-                navPoint.appendChild(newTag(tocncxdom,"content",attrs={"src":href}))
+                tocncx.start("navPoint",
+                             attrs={'id':id,
+                                    'playOrder':unicode(index)})
+                tocncx.start("navLabel")
+                ## the xml writer will escape as needed.
+                tocncx.element("text",text=stripHTML(title))
+                tocncx.end()
+                tocncx.element("content",attrs={"src":href})
+                tocncx.end()
                 index=index+1
+        tocncx.end()
+        tocncx.end()
 
         # write_to_epub used, but already passed using svg_files
-        write_to_epub("toc.ncx",tocncxdom.toprettyxml(encoding='utf-8'))
-        tocncxdom.unlink()
-        del tocncxdom
+        write_to_epub("toc.ncx",tocncx.getvalue())
+        del tocncx
 
         if epub3:
             ## create nav.xhtml file
-            tocnavdom = getDOMImplementation().createDocument(None, "html", None)
-            navxhtml = tocnavdom.documentElement
-            navxhtml.setAttribute("xmlns","http://www.w3.org/1999/xhtml")
-            navxhtml.setAttribute("xmlns:epub","http://www.idpf.org/2007/ops")
-            navxhtml.setAttribute("lang",langcode)
-            navxhtml.setAttribute("xml:lang",langcode)
-            head = tocnavdom.createElement("head")
-            navxhtml.appendChild(head)
-            head.appendChild(newTag(tocnavdom,"title",text="Navigation"))
+            tocnav = PrettyXMLWriter()
+            ## Only xml:lang, minidom always dropped lang for it.
+            tocnav.start("html",attrs={"xmlns":"http://www.w3.org/1999/xhtml",
+                                       "xmlns:epub":"http://www.idpf.org/2007/ops",
+                                       "xml:lang":langcode})
+            tocnav.start("head")
+            tocnav.element("title",text="Navigation")
             # <meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>
-            head.appendChild(newTag(tocnavdom,"meta",
-                                    attrs={"http-equiv":"Content-Type",
-                                           "content":"text/html; charset=utf-8"}))
+            tocnav.element("meta",
+                           attrs={"http-equiv":"Content-Type",
+                                  "content":"text/html; charset=utf-8"})
+            tocnav.end()
 
-            body = tocnavdom.createElement("body")
-            navxhtml.appendChild(body)
-            nav = newTag(tocnavdom,"nav",
+            tocnav.start("body")
+            tocnav.start("nav",
                          attrs={"epub:type":"toc"})
-            body.appendChild(nav)
-            ol = newTag(tocnavdom,"ol")
-            nav.appendChild(ol)
-
+            tocnav.start("ol")
             for item in items:
                 (id,href,type,title)=item
                 # only items to be skipped, cover.xhtml, images, toc.nav,
                 # stylesheet.css, should have no title.
                 if title:
-                    li = newTag(tocnavdom,"li")
-                    ol.appendChild(li)
-                    atag = newTag(tocnavdom,"a",
-                                  attrs={"href":href},
-                                  text=stripHTML(title))
-                    li.appendChild(atag)
+                    tocnav.start("li")
+                    tocnav.element("a",
+                                   attrs={"href":href},
+                                   text=stripHTML(title))
+                    tocnav.end()
+            tocnav.end()
+            tocnav.end()
 
             if self.story.cover and not self.use_oldcover:
                 # <nav epub:type="landmarks" hidden="">
@@ -929,32 +996,88 @@ div { margin: 0pt; padding: 0pt; }
                 #     <li><a href="OEBPS/cover.xhtml" epub:type="cover">Cover</a></li>
                 #   </ol>
                 # </nav>
-                nav = newTag(tocnavdom,"nav",
+                tocnav.start("nav",
                              attrs={"epub:type":"landmarks",
                                     "hidden":""})
-                body.appendChild(nav)
-                ol = newTag(tocnavdom,"ol")
-                nav.appendChild(ol)
-                li = newTag(tocnavdom,"li")
-                ol.appendChild(li)
-                atag = newTag(tocnavdom,"a",
-                              attrs={"href":"OEBPS/cover.xhtml",
-                                     "epub:type":"cover"},
-                              text="Cover")
-                li.appendChild(atag)
+                tocnav.start("ol")
+                tocnav.start("li")
+                tocnav.element("a",
+                               attrs={"href":"OEBPS/cover.xhtml",
+                                      "epub:type":"cover"},
+                               text="Cover")
+                tocnav.end()
+                tocnav.end()
+                tocnav.end()
+            tocnav.end()
+            tocnav.end()
 
             # write_to_epub used, but already passed using svg_files
-            write_to_epub("nav.xhtml",tocnavdom.toprettyxml(encoding='utf-8'))
-            tocnavdom.unlink()
-            del tocnavdom
+            write_to_epub("nav.xhtml",tocnav.getvalue())
+            del tocnav
 
         # declares all the files created by Windows.  otherwise, when
         # it runs in appengine, windows unzips the files as 000 perms.
         for zf in outputepub.filelist:
             zf.create_system = 0
         outputepub.close()
-        out.write(zipio.getvalue())
-        zipio.close()
+
+## Utility method for tags to write later with PrettyXMLWriter.element().
+def xmlTag(name,attrs=None,text=None):
+    return (name,attrs,text)
+
+class PrettyXMLWriter(object):
+    '''
+    Writes XML the same as minidom's toprettyxml(encoding='utf-8'),
+    but as it goes instead of making a DOM first, which is slow and
+    takes a lot of memory for stories with thousands of chapters.
+    attrs can be a dict or a list of (name,value) to keep the order.
+    '''
+    def __init__(self):
+        self.parts = [u'<?xml version="1.0" encoding="utf-8"?>\n']
+        self.open_tags = []
+        self.start_open = False # last start() tag still needs '>'
+
+    def _start_tag(self,name,attrs):
+        self._close_start()
+        self.parts.append(u'\t'*len(self.open_tags) + u'<' + name)
+        if attrs:
+            if isinstance(attrs,dict):
+                attrs = attrs.items()
+            for (attr,value) in attrs:
+                self.parts.append(u' %s="%s"'%(attr,xml_escape(value)))
+
+    def _close_start(self):
+        if self.start_open:
+            self.parts.append(u'>\n')
+            self.start_open = False
+
+    def start(self,name,attrs=None):
+        self._start_tag(name,attrs)
+        self.open_tags.append(name)
+        self.start_open = True
+
+    def end(self):
+        name = self.open_tags.pop()
+        if self.start_open:
+            self.parts.append(u'/>\n')
+            self.start_open = False
+        else:
+            self.parts.append(u'%s</%s>\n'%(u'\t'*len(self.open_tags),name))
+
+    def element(self,name,attrs=None,text=None):
+        self._start_tag(name,attrs)
+        if text is None:
+            self.parts.append(u'/>\n')
+        else:
+            self.parts.append(u'>%s</%s>\n'%(xml_escape(text),name))
+
+    def getvalue(self):
+        return u''.join(self.parts).encode('utf-8','xmlcharrefreplace')
+
+def xml_escape(data):
+    ## same as minidom
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+        replace("\"", "&quot;").replace(">", "&gt;")
 
 ## Utility method for creating new tags.
 def newTag(dom,name,attrs=None,text=None):
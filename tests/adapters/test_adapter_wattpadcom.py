@@ -57,7 +57,7 @@ class TestExtractChapterUrlsAndMetadata(GenericAdapterTestExtractChapterUrlsAndM
             SPECIFIC_TEST_DATA['specific_path_adapter'],
             SPECIFIC_TEST_DATA['list_chapters_fixture'])
 
-        self.configuration.validEntries.extend(['reads'])
+        self.configuration.validEntries = self.configuration.validEntries + ['reads']
 
     @pytest.fixture(autouse=True)
     def setup_env(self):
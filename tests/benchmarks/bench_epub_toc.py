@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+'''
+Time making the content.opf manifest and spine and toc.ncx navMap for
+a story with many chapters with minidom, the way EpubWriter used to,
+and with PrettyXMLWriter, then time writing a whole epub of it.  Not
+collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_epub_toc [chapters]
+'''
+from __future__ import print_function
+import logging
+import sys
+import time
+from io import BytesIO
+from xml.dom.minidom import getDOMImplementation
+
+from fanficfare.writers.writer_epub import PrettyXMLWriter, newTag
+from tests.test_writers import make_writer
+
+def make_items(chapters):
+    return [ ("file%04d" % (i+1), "OEBPS/file%04d.xhtml" % (i+1), "application/xhtml+xml",
+              u"Chapter %d & <Part> \"%d\"" % (i+1, i % 7))
+             for i in range(chapters) ]
+
+def with_minidom(items):
+    contentdom = getDOMImplementation().createDocument(None, "package", None)
+    package = contentdom.documentElement
+    manifest = contentdom.createElement("manifest")
+    package.appendChild(manifest)
+    for (id, href, type, title) in items:
+        manifest.appendChild(newTag(contentdom, "item", attrs={'id':id, 'href':href, 'media-type':type}))
+    spine = newTag(contentdom, "spine", attrs={"toc":"ncx"})
+    package.appendChild(spine)
+    for (id, href, type, title) in items:
+        spine.appendChild(newTag(contentdom, "itemref", attrs={"idref":id, "linear":"yes"}))
+    contentxml = contentdom.toprettyxml(encoding='utf-8')
+
+    tocncxdom = getDOMImplementation().createDocument(None, "ncx", None)
+    navMap = tocncxdom.createElement("navMap")
+    tocncxdom.documentElement.appendChild(navMap)
+    for (index, (id, href, type, title)) in enumerate(items):
+        navPoint = newTag(tocncxdom, "navPoint", attrs={'id':id, 'playOrder':str(index)})
+        navMap.appendChild(navPoint)
+        navLabel = newTag(tocncxdom, "navLabel")
+        navPoint.appendChild(navLabel)
+        navLabel.appendChild(newTag(tocncxdom, "text", text=title))
+        navPoint.appendChild(newTag(tocncxdom, "content", attrs={"src":href}))
+    return (contentxml, tocncxdom.toprettyxml(encoding='utf-8'))
+
+def with_writer(items):
+    contentxml = PrettyXMLWriter()
+    contentxml.start("package")
+    contentxml.start("manifest")
+    for (id, href, type, title) in items:
+        contentxml.element("item", attrs={'id':id, 'href':href, 'media-type':type})
+    contentxml.end()
+    contentxml.start("spine", attrs={"toc":"ncx"})
+    for (id, href, type, title) in items:
+        contentxml.element("itemref", attrs={"idref":id, "linear":"yes"})
+    contentxml.end()
+    contentxml.end()
+
+    tocncx = PrettyXMLWriter()
+    tocncx.start("ncx")
+    tocncx.start("navMap")
+    for (index, (id, href, type, title)) in enumerate(items):
+        tocncx.start("navPoint", attrs={'id':id, 'playOrder':str(index)})
+        tocncx.start("navLabel")
+        tocncx.element("text", text=title)
+        tocncx.end()
+        tocncx.element("content", attrs={"src":href})
+        tocncx.end()
+    tocncx.end()
+    tocncx.end()
+    return (contentxml.getvalue(), tocncx.getvalue())
+
+def write_epub(chapters):
+    writer = make_writer(epub_version='3.0', internalize_text_links='false')
+    for i in range(chapters):
+        writer.story.addChapter({'url': 'http://test1.com?sid=12&chapter=%d' % (i+1),
+                                 'title': 'Chapter %d' % (i+1),
+                                 'html': u'<div><p>Chapter %d.</p></div>' % (i+1)})
+    writer.adapter.storyDone = True
+    out = BytesIO()
+    start = time.time()
+    writer.writeStory(outstream=out)
+    return time.time() - start
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    chapters = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    items = make_items(chapters)
+    start = time.time()
+    old = with_minidom(items)
+    minidom_time = time.time() - start
+    start = time.time()
+    new = with_writer(items)
+    writer_time = time.time() - start
+    assert old == new
+    print("%d chapters, %d bytes of content.opf and toc.ncx" % (chapters, sum(len(x) for x in new)))
+    print("minidom:          %6.3fs" % minidom_time)
+    print("PrettyXMLWriter:  %6.3fs  x%.1f" % (writer_time, minidom_time/writer_time))
+    print("whole epub3:      %6.3fs" % write_epub(chapters))
+
+if __name__ == '__main__':
+    main()
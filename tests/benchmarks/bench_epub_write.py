@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+'''
+Time EpubWriter writing a story with many chapters with different
+epub_write_threads.  Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_epub_write [chapters]
+'''
+from __future__ import print_function
+import logging
+import os
+import sys
+import time
+from io import BytesIO
+
+from tests.test_writers import make_writer
+
+PARAGRAPHS = 60
+
+def write_epub(chapters, threads):
+    writer = make_writer(epub_write_threads=str(threads), internalize_text_links='false')
+    text = u''.join(u'<p>Paragraph %d of the chapter, with some words %s in it.</p>' % (i, os.urandom(8).hex())
+                    for i in range(PARAGRAPHS))
+    for i in range(chapters):
+        writer.story.addChapter({'url': 'http://test1.com?sid=12&chapter=%d' % (i+1),
+                                 'title': 'Chapter %d' % (i+1),
+                                 'html': u'<div>%s</div>' % text})
+    writer.adapter.storyDone = True
+    out = BytesIO()
+    start = time.time()
+    writer.writeStory(outstream=out)
+    return time.time() - start, len(out.getvalue())
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    chapters = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    (serial, size) = write_epub(chapters, 0)
+    print("cpus:%s  %d chapters  %d bytes  in turn: %6.2fs" % (os.cpu_count(), chapters, size, serial))
+    for threads in (1, 2, 4, 8, 16):
+        (elapsed, size) = write_epub(chapters, threads)
+        print("epub_write_threads:%-2d  %6.2fs  x%.1f" % (threads, elapsed, serial/elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Time Story.getAllMetadata on a story with a large
+extra_valid_entries list, with and without the set-based
+Configuration.isValidMetaEntry & co.  Not collected by pytest, run
+with:
+
+    python -m tests.benchmarks.bench_getallmetadata
+'''
+from __future__ import print_function
+import logging
+import os
+import timeit
+
+from fanficfare.configurable import Configuration
+from fanficfare.story import Story
+
+DEFAULTS_INI = os.path.join(os.path.dirname(__file__), '..', '..', 'fanficfare', 'defaults.ini')
+
+def make_story(extra):
+    configuration = Configuration(['test1.com'], 'epub')
+    configuration.read(DEFAULTS_INI)
+    configuration.set('defaults', 'extra_valid_entries',
+                      ','.join('extra%d' % i for i in range(extra)))
+    story = Story(configuration)
+    story.setMetadata('title', 'Title')
+    story.setMetadata('author', 'Author')
+    story.extendList('genre', ['Fantasy', 'Humor'])
+    for i in range(0, extra, 2):
+        story.setMetadata('extra%d' % i, 'value %d' % i)
+    return story
+
+## previous list-based lookups.
+def isListType(self, key):
+    return key in self.listTypeEntries or self.hasConfig("include_in_"+key)
+
+def isValidMetaEntry(self, key):
+    return key in self.validEntries + self.getConfigList("extra_valid_entries")
+
+def getValidMetaList(self):
+    return self.validEntries + self.getConfigList("extra_valid_entries")
+
+def isImmutableMetaEntry(self, key):
+    return key in self.immutableEntries
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    for extra in (0, 100, 1000):
+        story = make_story(extra)
+        n = 5
+        new_md = story.getAllMetadata()
+        new = timeit.timeit(story.getAllMetadata, number=n) / n
+        config = story.configuration
+        for f in (isListType, isValidMetaEntry, getValidMetaList, isImmutableMetaEntry):
+            setattr(config, f.__name__, f.__get__(config))
+        assert story.getAllMetadata() == new_md
+        old = timeit.timeit(story.getAllMetadata, number=n) / n
+        print("extra_valid_entries:%5d  lists:%9.2fms  sets:%8.2fms  x%.1f" %
+              (extra, old*1000, new*1000, old/new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''
+Time converting an image heavy chapter with Story.addImgUrl(...,
+pending=True) and different image_conversion_threads.  Needs Pillow.
+Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_image_conversion
+'''
+from __future__ import print_function
+import logging
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from fanficfare.configurable import Configuration
+from fanficfare.story import Story
+
+IMAGES = 24
+
+def make_images():
+    images = {}
+    for i in range(IMAGES):
+        img = Image.frombytes('RGB', (1600, 1200), os.urandom(1600*1200*3))
+        out = BytesIO()
+        img.save(out, 'PNG' if i % 2 else 'JPEG')
+        images['http://test1.com/img%d.%s' % (i, 'png' if i % 2 else 'jpg')] = out.getvalue()
+    return images
+
+def convert_all(images, threads):
+    configuration = Configuration(['test1.com'], 'epub')
+    configuration.add_section('defaults')
+    configuration.set('defaults', 'image_max_size', '580, 725')
+    configuration.set('defaults', 'image_conversion_threads', str(threads))
+    story = Story(configuration)
+    story.cover = 'images/cover.jpg' # no first image cover
+    fetch = lambda url, referer=None, image=False: images[url]
+    start = time.time()
+    pending = [ story.addImgUrl('http://test1.com/', url, fetch, pending=True) for url in images ]
+    newsrcs = [ finish()[0] for finish in pending ]
+    elapsed = time.time() - start
+    story.close_image_pool()
+    return elapsed, newsrcs
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    images = make_images()
+    (inline, expected) = convert_all(images, 0)
+    print("cpus:%s  %d images  inline: %7.2fs" % (os.cpu_count() if hasattr(os, 'cpu_count') else '?', IMAGES, inline))
+    for threads in (1, 2, 4, 8):
+        (elapsed, newsrcs) = convert_all(images, threads)
+        assert newsrcs == expected
+        print("image_conversion_threads:%d  %7.2fs  x%.1f" % (threads, elapsed, inline/elapsed))
+
+if __name__ == '__main__':
+    main()
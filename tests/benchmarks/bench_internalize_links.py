@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+Compare htmlcleanup.internalize_links with re-parsing the chapter with
+bs4 and html5lib, the way the epub and html writers used to, on
+chapters linking to other chapters.  Not collected by pytest, run
+with:
+
+    python -m tests.benchmarks.bench_internalize_links [chapters]
+'''
+from __future__ import print_function
+import sys
+import time
+
+from fanficfare.htmlcleanup import internalize_links
+from tests.test_htmlcleanup import internalize_links_soup
+
+PARAGRAPHS = 60
+
+def make_chapters(chapters):
+    urlmap = dict(('http://test1.com?sid=12&chapter=%d' % (i+1), 'file%04d.xhtml' % (i+1))
+                  for i in range(chapters))
+    pages = []
+    for i in range(chapters):
+        text = u''.join(u'<p>Paragraph %d of the chapter, with <i>some</i> words in it.</p>\n' % j
+                        for j in range(PARAGRAPHS))
+        pages.append(u'<div class="chapter">\n%s<p><a href="http://test1.com?sid=12&amp;chapter=%d">Previous</a>'
+                     u' <a href="http://other.com/">Elsewhere</a></p>\n</div>' % (text, i or 1))
+    return (urlmap, pages)
+
+def main():
+    chapters = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    (urlmap, pages) = make_chapters(chapters)
+    for keep_orighref in (False, True):
+        start = time.time()
+        old = [ internalize_links_soup(page, urlmap, keep_orighref) for page in pages ]
+        soup_time = time.time() - start
+        start = time.time()
+        new = [ internalize_links(page, urlmap, keep_orighref) for page in pages ]
+        links_time = time.time() - start
+        assert old == new
+        print("%d chapters keep_orighref=%-5s  bs4:%7.3fs  internalize_links:%7.3fs  x%.0f" %
+              (chapters, keep_orighref, soup_time, links_time, soup_time/links_time))
+
+if __name__ == '__main__':
+    main()
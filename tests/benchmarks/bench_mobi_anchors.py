@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+'''
+Compare filling in the filepos anchor stubs of a mobi book with many
+chapters in one pass with the previous find and replace per anchor.
+The text is made the way HtmlProcessor leaves it, without parsing a
+whole book with html5lib first.  Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_mobi_anchors [chapters]
+'''
+from __future__ import print_function
+import sys
+import time
+
+from fanficfare.mobihtml import _FillAnchorStubs
+from tests.test_mobi import fill_anchor_stubs_loop
+
+PARAGRAPHS = 30
+
+def make_book(chapters):
+    references = [ (i, '#mobi_article_%d_MOBI_START' % (i+1)) for i in range(chapters) ]
+    references.append((chapters, '#TOCTOP'))
+    html = [u'<html><head><title>Bibliorize</title><guide><reference filepos="%.10d" title="Table of Contents" type="toc"/>'
+            u'</guide></head><body><h1>A Story</h1><mbp:pagebreak/><a name="TOCTOP"><h3>Table of Contents</h3><br/>'
+            % chapters]
+    html.extend(u'<a filepos="%.10d">Chapter %d</a><br/>' % (i, i+1) for i in range(chapters))
+    text = u''.join(u'<p>Paragraph %d of the chapter, with <i>some</i> words in it.</p>\n' % j for j in range(PARAGRAPHS))
+    for i in range(chapters):
+        html.append(u'<mbp:pagebreak/><a name="mobi_article_%d_MOBI_START"></a><h3>Chapter %d</h3>\n%s' % (i+1, i+1, text))
+    html.append(u'</a></body></html>')
+    return (u''.join(html).encode('utf-8'), references)
+
+def main():
+    chapters = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    (text, references) = make_book(chapters)
+    start = time.time()
+    old = fill_anchor_stubs_loop(text, references)
+    loop_time = time.time() - start
+    start = time.time()
+    new = _FillAnchorStubs(text, references)
+    fill_time = time.time() - start
+    assert old == new
+    print("%d chapters, %.1fMB  find/replace loop:%7.3fs  one pass:%7.3fs  x%.0f" %
+          (chapters, len(text)/1048576.0, loop_time, fill_time, loop_time/fill_time))
+
+if __name__ == '__main__':
+    main()
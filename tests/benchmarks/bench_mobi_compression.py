@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+Time mobi.Converter making a book with and without PalmDoc record
+compression and compare the sizes.  Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_mobi_compression [chapters]
+'''
+from __future__ import print_function
+import logging
+import sys
+import time
+
+from fanficfare.mobi import Converter, PalmDocCompress, Record
+
+PARAGRAPHS = 60
+
+def make_chapters(chapters):
+    html = [u'<html><head><title>Title Page</title></head><body><h1>A Story</h1></body></html>'.encode('utf-8')]
+    for i in range(chapters):
+        text = u''.join(u'<p>Paragraph %d of chapter %d, with <i>some</i> words in it, and a few '
+                        u'more “quoted” ones—like café and déjà vu.</p>\n' % (j, i+1)
+                        for j in range(PARAGRAPHS))
+        html.append((u'<html><head><title>Chapter %d</title></head><body><h3>Chapter %d</h3>\n%s</body></html>'
+                     % (i+1, i+1, text)).encode('utf-8'))
+    return html
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    chapters = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    html = Converter().MakeOneHTML(make_chapters(chapters))
+    sizes = {}
+    for compress in (False, True):
+        start = time.time()
+        sizes[compress] = len(Converter(compress=compress).ConvertString(html))
+        print("%d chapters compress=%-5s  %6.3fs  %8d bytes" % (chapters, compress, time.time() - start, sizes[compress]))
+    print("compressed is %.0f%% of uncompressed" % (100.0 * sizes[True] / sizes[False]))
+
+    text = html.encode('utf-8')
+    records = [ text[i:i+Record.MAX_SIZE] for i in range(0, len(text), Record.MAX_SIZE) ]
+    start = time.time()
+    for record in records:
+        PalmDocCompress(record)
+    elapsed = time.time() - start
+    print("PalmDocCompress alone: %.2fMB/s" % (len(text) / elapsed / 1048576.0))
+
+if __name__ == '__main__':
+    main()
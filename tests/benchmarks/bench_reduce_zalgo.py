@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+'''
+Compare htmlcleanup.reduce_zalgo with the previous per-character loop
+on a few multi-hundred-KB pages.  Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_reduce_zalgo
+'''
+from __future__ import print_function
+import timeit
+import unicodedata
+
+from fanficfare.htmlcleanup import reduce_zalgo, ZALGO_CHAR_CATEGORIES
+
+def reduce_zalgo_loop(text,max_zalgo=1):
+    lineout=[]
+    count=0
+    for c in unicodedata.normalize('NFD', text):
+        if unicodedata.category(c) not in ZALGO_CHAR_CATEGORIES:
+            lineout.append(c)
+            count=0
+        else:
+            if count < max_zalgo:
+                lineout.append(c)
+            count+=1
+    return ''.join(lineout)
+
+PARA = u'<p>Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>\n'
+PAGES = {
+    'ascii': PARA * 3000,
+    'accented': (PARA + u'<p>Café déjà vu, naïve façade, Ångström, Dvořák, 魔法少女まどか★マギカ.</p>\n') * 1500,
+    'zalgo': (PARA + u'<p>H̵̡̧e̴͓̤ c̶̰͕̩o̷̙m̸̖̗̘ẹ̢̤̥̦s⃝⃞⃟</p>\n') * 1500,
+    'emoji': (PARA + u'<p>Zalgo and emoji \U0001F600\U0001F44D\U0001F3FD a\U0001D167\U0001D168\U0001D169 b\U000E0100\u0301\u0302</p>\n') * 1500,
+}
+
+def main():
+    for name, page in sorted(PAGES.items()):
+        for max_zalgo in (0, 1, 3):
+            assert reduce_zalgo(page, max_zalgo) == reduce_zalgo_loop(page, max_zalgo)
+            n = 5
+            old = timeit.timeit(lambda: reduce_zalgo_loop(page, max_zalgo), number=n) / n
+            new = timeit.timeit(lambda: reduce_zalgo(page, max_zalgo), number=n) / n
+            print("%-9s %4dKB max_zalgo=%d  loop:%8.2fms  regexp:%8.2fms  x%.1f" %
+                  (name, len(page)//1024, max_zalgo, old*1000, new*1000, old/new))
+
+if __name__ == '__main__':
+    main()
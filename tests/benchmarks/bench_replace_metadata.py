@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+'''
+Time Story.doReplacements over every list entry of a story with a
+large synthetic replace_metadata table, compared with the previous
+line by line loop.  Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_replace_metadata
+'''
+from __future__ import print_function
+import logging
+import timeit
+
+from fanficfare.configurable import Configuration
+from fanficfare.story import Story
+from tests.test_story import doReplacements_loop
+
+def make_story(lines):
+    replace = []
+    for i in range(lines):
+        if i % 10 == 9:
+            replace.append(u'genre,characters=>^(.*) \\(Tag%d\\)$=>\\1' % i)
+        elif i % 2:
+            replace.append(u'characters=>^Character %d$=>Char %d' % (i, i))
+        else:
+            replace.append(u'genre=>^Genre %d$=>Genre Renamed %d' % (i, i))
+    configuration = Configuration(['test1.com'], 'epub')
+    configuration.add_section('defaults')
+    configuration.set('defaults', 'replace_metadata', '\n'.join(replace))
+    story = Story(configuration)
+    story.extendList('genre', ['Genre %d' % i for i in range(0, 400, 3)])
+    story.extendList('characters', ['Character %d (Tag%d)' % (i, i) for i in range(0, 400, 3)])
+    story.prepare_replacements()
+    return story
+
+def replace_all(story, doReplacements):
+    return [ doReplacements(v, k, return_list=True)
+             for k in ('genre', 'characters')
+             for v in story.metadata[k] ]
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    for lines in (100, 1000, 5000):
+        story = make_story(lines)
+        loop = lambda value, key, return_list: doReplacements_loop(story, value, key, return_list)
+        assert replace_all(story, story.doReplacements) == replace_all(story, loop)
+        n = 3
+        old = timeit.timeit(lambda: replace_all(story, loop), number=n) / n
+        new = timeit.timeit(lambda: replace_all(story, story.doReplacements), number=n) / n
+        print("replace_metadata lines:%5d  loop:%9.2fms  indexed:%8.2fms  x%.1f" %
+              (lines, old*1000, new*1000, old/new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''
+Time writing the files of an image heavy epub with different
+zip_compression_levels and compare the output sizes.  Needs Pillow.
+Not collected by pytest, run with:
+
+    python -m tests.benchmarks.bench_zip_compression
+'''
+from __future__ import print_function
+import logging
+import os
+import time
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from PIL import Image, ImageFilter
+
+from tests.test_writers import make_writer
+
+CHAPTERS = 100
+IMAGES = 200
+
+def make_files():
+    files = []
+    noise = Image.frombytes('L', (580, 725), os.urandom(580*725)).filter(ImageFilter.GaussianBlur(1))
+    for i in range(IMAGES):
+        img = Image.merge('RGB', (Image.linear_gradient('L').resize((580, 725)),
+                                  noise.rotate(i),
+                                  Image.radial_gradient('L').resize((580, 725))))
+        out = BytesIO()
+        if i % 4:
+            img.save(out, 'JPEG', quality=90)
+            files.append(('OEBPS/images/ffdl-%d.jpg' % i, out.getvalue()))
+        else:
+            img.quantize(64).save(out, 'PNG')
+            files.append(('OEBPS/images/ffdl-%d.png' % i, out.getvalue()))
+    text = u''.join(u'<p>Paragraph %d of the chapter, with some words in it.</p>\n' % i for i in range(300))
+    for i in range(CHAPTERS):
+        files.append(('OEBPS/file%04d.xhtml' % i, text.encode('utf-8')))
+    return files
+
+def write_zip(files, levels):
+    writer = make_writer(zip_compression_levels=levels)
+    out = BytesIO()
+    start = time.time()
+    zipfile = ZipFile(out, 'w', compression=ZIP_DEFLATED)
+    for (filename, data) in files:
+        writer.zip_writestr(zipfile, filename, data)
+    zipfile.close()
+    return time.time() - start, len(out.getvalue())
+
+def main():
+    logging.getLogger('fanficfare').setLevel(logging.WARNING)
+    files = make_files()
+    print("%d images, %d chapters, %.1fMB uncompressed" % (IMAGES, CHAPTERS,
+                                                          sum(len(d) for (f, d) in files)/1048576.0))
+    (base_time, base_size) = write_zip(files, '')
+    for levels in ('', 'jpg:0,jpeg:0,png:0,gif:0,webp:0,avif:0',
+                   'jpg:0,jpeg:0,png:0,gif:0,webp:0,avif:0,xhtml:9',
+                   'jpg:0,jpeg:0,png:0,gif:0,webp:0,avif:0,*:1'):
+        (elapsed, size) = write_zip(files, levels)
+        print("%-48s %6.3fs x%4.1f  %8d bytes %+5.1f%%" % (levels or '(all deflated)', elapsed,
+                                                         base_time/elapsed, size,
+                                                         100.0*(size-base_size)/base_size))
+
+if __name__ == '__main__':
+    main()
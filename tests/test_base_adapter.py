@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from fanficfare import adapters
+from fanficfare.adapters import base_adapter
+from fanficfare.configurable import Configuration
+
+DEFAULTS_INI = os.path.join(os.path.dirname(__file__), '..', 'fanficfare', 'defaults.ini')
+
+PAGE = u'<html><body><div id="story"><p>Page %d.</p></div></body></html>'
+
+
+def make_adapter(url='http://test1.com?sid=12', **settings):
+    config = Configuration(adapters.getConfigSectionsFor(url), 'epub')
+    config.read([DEFAULTS_INI])
+    config.set('overrides', 'is_adult', 'true')
+    for key, value in settings.items():
+        config.set('overrides', key, value)
+    return adapters.getAdapter(config, url)
+
+
+def counts(adapter):
+    return (adapter.times.get('make_soup->parses', 0), adapter.times.get('make_soup->cache hits', 0))
+
+
+def test_soup_cache_hits_and_misses():
+    adapter = make_adapter()
+    first = adapter.make_soup(PAGE % 1)
+    assert counts(adapter) == (1, 0)
+    assert not adapter.soup_cache  # seen once, not copied and kept
+    second = adapter.make_soup(PAGE % 1)
+    assert counts(adapter) == (2, 0)
+    third = adapter.make_soup(PAGE % 1)
+    assert counts(adapter) == (2, 1)
+    assert len(set(map(id, (first, second, third)))) == 3
+    adapter.make_soup(PAGE % 2)
+    assert counts(adapter) == (3, 1)
+
+
+def test_soup_cache_copies_not_shared():
+    adapter = make_adapter()
+    for i in range(2):
+        adapter.make_soup(PAGE % 1)
+    soup = adapter.make_soup(PAGE % 1)
+    soup.find('p').string = u'changed'
+    soup.find('div').decompose()
+    again = adapter.make_soup(PAGE % 1)
+    assert counts(adapter) == (2, 2)
+    assert again.find('p').string == u'Page 1.'
+
+
+@pytest.mark.parametrize('size', ['0', 'lots'])
+def test_soup_cache_off(size):
+    adapter = make_adapter(soup_cache_size=size)
+    for i in range(3):
+        adapter.make_soup(PAGE % 1)
+    assert counts(adapter) == (0, 0)
+    assert not adapter.soup_cache and not adapter.soup_cache_seen
+
+
+def test_soup_cache_lru():
+    adapter = make_adapter(soup_cache_size='2')
+    for page in (1, 2, 3, 1, 2, 3):
+        adapter.make_soup(PAGE % page)  # seen, then cached
+    assert counts(adapter) == (6, 0)
+    assert len(adapter.soup_cache) == 2  # 1 evicted
+    adapter.make_soup(PAGE % 2)  # hit, now most recent
+    adapter.make_soup(PAGE % 1)  # evicted before, cached again, evicts 3
+    adapter.make_soup(PAGE % 2)
+    assert counts(adapter) == (7, 2)
+    adapter.make_soup(PAGE % 3)
+    assert counts(adapter) == (8, 2)
+
+
+def test_image_pool_closed_when_chapter_fails(monkeypatch):
+    adapter = make_adapter(image_conversion_threads='2')
+    adapter.getStoryMetadataOnly()
+    assert adapter.story.get_image_pool() is not None
+    def fail(url, index):
+        raise IOError('chapter failed')
+    monkeypatch.setattr(adapter, 'getChapterTextNum', fail)
+    with pytest.raises(IOError):
+        adapter.getStory()
+    assert adapter.story.image_pool is None
+
+
+def test_prefetched_imgs_cleared_when_chapter_fails(monkeypatch):
+    adapter = make_adapter(include_images='true', image_prefetch_threads='2')
+    adapter.getStoryMetadataOnly()
+    def prefetch(parenturl, urls):
+        adapter.story.prefetched_imgs['http://test1.com/a.jpg'] = (b'data', None)
+    monkeypatch.setattr(adapter.story, 'prefetch_img_urls', prefetch)
+    def fail(parenturl, style):
+        raise IOError('style failed')
+    monkeypatch.setattr(adapter, 'include_css_urls', fail)
+    soup = adapter.make_soup(u'<div><style>p { color: red; }</style><p>Text.</p></div>')
+    with pytest.raises(IOError):
+        adapter.utf8FromSoup('http://test1.com?sid=12', soup.find('div'))
+    assert adapter.story.prefetched_imgs == {}
@@ -0,0 +1,114 @@
+import codecs
+import os
+from io import StringIO
+
+from fanficfare.configurable import Configuration
+
+DEFAULTS_INI = os.path.join(os.path.dirname(__file__), '..', 'fanficfare', 'defaults.ini')
+
+PERSONAL_INI = u"""[defaults]
+is_adult:true
+titlepage_entries: category,genre
+ status,rating
+[test1.com]
+extra_valid_entries:stars
+[newsection]
+x:1
+[defaults]
+add_to_titlepage_entries:,words
+"""
+
+
+def make_config():
+    return Configuration(['test1.com'], 'epub')
+
+
+def read_uncached():
+    config = make_config()
+    with codecs.open(DEFAULTS_INI, encoding='utf-8') as fp:
+        config._read(fp, DEFAULTS_INI)
+    config._read(StringIO(PERSONAL_INI), '<string>')
+    return config
+
+
+def read_cached():
+    config = make_config()
+    config.read([DEFAULTS_INI, '/does/not/exist.ini'])
+    config.read_text(PERSONAL_INI)
+    return config
+
+
+def test_snapshot_same_as_read():
+    expected = read_uncached()
+    for i in range(2):  # first parses, second from snapshot
+        config = read_cached()
+        assert list(config._sections.keys()) == list(expected._sections.keys())
+        for section in expected._sections:
+            assert list(config._sections[section].items()) == list(expected._sections[section].items())
+        assert config.linenos == expected.linenos
+        assert config.getConfig('titlepage_entries') == u'category,genre\nstatus,rating,words'
+
+
+def test_snapshot_not_shared():
+    config = read_cached()
+    config.set('overrides', 'always_overwrite', 'true')
+    config.set('test1.com', 'extra_valid_entries', 'changed')
+    config = read_cached()
+    assert not config.has_option('overrides', 'always_overwrite')
+    assert config.get('test1.com', 'extra_valid_entries') == 'stars'
+
+
+def test_resolved_config_same_as_sections():
+    config = read_cached()
+    config.addUrlConfigSection('http://test1.com?sid=1')
+    keys = set()
+    for options in config._sections.values():
+        keys.update(options.keys())
+    keys.update(['add_to_' + k for k in list(keys)] + ['not_a_setting'])
+    keys.discard('__name__')
+    for key in keys:
+        # a copy of sectionslist goes through the uncached path.
+        assert config.getConfig(key) == config.get_config(list(config.sectionslist), key)
+        assert config.hasConfig(key) == config.has_config(list(config.sectionslist), key)
+
+
+def test_resolved_config_invalidated():
+    config = read_cached()
+    assert config.getConfig('titlepage_entries') == u'category,genre\nstatus,rating,words'
+    assert config.getConfig('not_a_setting', 'default') == 'default'
+    config.set('overrides', 'titlepage_entries', 'title')
+    config.set('overrides', 'add_to_not_a_setting', ',more')
+    assert config.getConfig('titlepage_entries') == u'title,words'
+    assert config.getConfig('not_a_setting', 'default') == 'default,more'
+    config.addConfigSection('newsection')
+    assert config.getConfig('x') == '1'
+
+
+def test_meta_entry_sets_extra_valid_entries():
+    config = read_cached()
+    config.addUrlConfigSection('http://test1.com?sid=1')
+    assert config.isValidMetaEntry('stars')
+    assert not config.isValidMetaEntry('likes')
+    config.set('overrides', 'extra_valid_entries', 'likes')
+    assert config.isValidMetaEntry('likes')
+    assert not config.isValidMetaEntry('stars')
+    assert config.getValidMetaList()[-1] == 'likes'
+
+
+def test_meta_entry_sets_adapter_changes_lists():
+    config = read_cached()
+    assert not config.isValidMetaEntry('reads')
+    config.validEntries = config.validEntries + ['reads']
+    assert config.isValidMetaEntry('reads')
+    # changed in place, needs reset_meta_entry_sets().
+    config.validEntries[-1] = 'zzz'
+    assert config.isValidMetaEntry('reads')
+    config.reset_meta_entry_sets()
+    assert config.isValidMetaEntry('zzz')
+    assert not config.isValidMetaEntry('reads')
+    assert not config.isListType('reads')
+    config.listTypeEntries = config.listTypeEntries + ['reads']
+    assert config.isListType('reads')
+    config.immutableEntries = ['zzz']
+    assert config.isImmutableMetaEntry('zzz')
+    assert not config.isImmutableMetaEntry('title')
@@ -0,0 +1,53 @@
+from fanficfare import epubutils
+from fanficfare.epubutils import get_update_data, get_dcsource_chaptercount
+
+from tests.test_writers import make_writer
+
+
+def write_epub(tmp_path, chapters):
+    writer = make_writer(include_logpage='true')
+    for i in range(chapters):
+        writer.story.addChapter({'url': 'http://test1.com?sid=12&chapter=%d' % (i+1),
+                                 'title': 'Chapter %d' % (i+1),
+                                 'html': u'<div><p>Text %d</p></div>' % (i+1)})
+    writer.adapter.storyDone = True
+    outfilename = str(tmp_path / 'story.epub')
+    writer.writeStory(outfilename=outfilename, forceOverwrite=True)
+    return outfilename
+
+
+def test_update_data_lazy(tmp_path, monkeypatch):
+    epubfilename = write_epub(tmp_path, 3)
+    soups_made = []
+    make_soup = epubutils.make_soup
+    def count_make_soup(data, *args, **kwargs):
+        soups_made.append(data)
+        return make_soup(data, *args, **kwargs)
+    monkeypatch.setattr(epubutils, 'make_soup', count_make_soup)
+
+    assert get_dcsource_chaptercount(epubfilename) == ('http://test1.com?sid=12', 3)
+    updatedata = get_update_data(epubfilename)
+    assert 'Update Log' in updatedata[6]
+    (source, filecount, soups, images, oldcover, calibrebookmark,
+     logfile, urlsoups, datamaps) = updatedata[0:9]
+    assert soups_made == []
+
+    assert filecount == len(soups) == 3
+    assert list(urlsoups) == ['http://test1.com?sid=12&chapter=%d' % (i+1) for i in range(3)]
+    assert datamaps['http://test1.com?sid=12&chapter=2']['chaptertitle'] == 'Chapter 2'
+    assert soups_made == []
+    soup = urlsoups['http://test1.com?sid=12&chapter=2']
+    assert soup.find('p').string == 'Text 2'
+    assert soup.find('h3') is None
+    assert len(soups_made) == 1
+    updatedata.close()
+
+
+def test_update_data_closes(tmp_path):
+    epubfilename = write_epub(tmp_path, 2)
+    with get_update_data(epubfilename) as updatedata:
+        assert 'Update Log' in updatedata.logfile
+        # lazy slices still read from the same epub.
+        assert updatedata.soups[1:][0].find('p').string == 'Text 2'
+    assert updatedata.epub.fp is None
+
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unicodedata
+
+import bs4
+import pytest
+
+from fanficfare.htmlcleanup import removeEntities, _replaceNamedEntities, _replaceNamedEntitiesLoop
+from fanficfare.htmlcleanup import reduce_zalgo, ZALGO_CHAR_CATEGORIES
+from fanficfare.htmlcleanup import internalize_links, get_link_hrefs, remove_html_head_body
+
+
+@pytest.mark.parametrize('text', [
+    u'',
+    u'no entities at all',
+    u'AT&amp;T &mdash; &eacute;t&eacute; &amp;eacute; &aacute',
+    u'&amp;amp;amp; &AMP;aacute; &notin; &not &nbsp;&nbsp',
+    u'&lt;p&gt; &#38;hellip; &Uuml;ber &uuml &bogus;',
+])
+@pytest.mark.parametrize('space_only', [False, True])
+def test_named_entities_same_as_loop(text, space_only):
+    assert _replaceNamedEntities(text, space_only) == _replaceNamedEntitiesLoop(text, space_only)
+
+
+def test_removeEntities():
+    assert removeEntities(u'AT&amp;T &mdash; &eacute;t&eacute; &lt;b&gt;') == u'AT&amp;T — été &lt;b&gt;'
+
+
+def reduce_zalgo_loop(text, max_zalgo):
+    # previous per-character implementation
+    lineout = []
+    count = 0
+    for c in unicodedata.normalize('NFD', text):
+        if unicodedata.category(c) not in ZALGO_CHAR_CATEGORIES:
+            lineout.append(c)
+            count = 0
+        else:
+            if count < max_zalgo:
+                lineout.append(c)
+            count += 1
+    return ''.join(lineout)
+
+
+@pytest.mark.parametrize('text', [
+    u'',
+    u'plain ascii text',
+    u'Café déjà vu, naïve, 魔法少女まどか★マギカ',
+    u'H̵̡̧e̴͓̤ c̶̰͕̩o̷̙m̸̖̗̘ẹ̢̤̥̦s⃝⃞⃟',
+    u'́leading mark, emoji 😀👍🏽 a\U0001D167\U0001D168\U0001D169 b\U000E0100́̂',
+])
+@pytest.mark.parametrize('max_zalgo', [0, 1, 2, 5])
+def test_reduce_zalgo_same_as_loop(text, max_zalgo):
+    assert reduce_zalgo(text, max_zalgo) == reduce_zalgo_loop(text, max_zalgo)
+
+
+def internalize_links_soup(html, urlmap, keep_orighref):
+    # previous bs4 implementation
+    soup = bs4.BeautifulSoup(html, 'html5lib')
+    changed = False
+    for alink in soup.find_all('a'):
+        if keep_orighref and alink.has_attr('data-orighref') and alink['data-orighref'] in urlmap:
+            alink['href'] = urlmap[alink['data-orighref']]
+            changed = True
+        elif alink.has_attr('href') and alink['href'] in urlmap:
+            if keep_orighref and not alink['href'].startswith('file'):
+                alink['data-orighref'] = alink['href']
+            alink['href'] = urlmap[alink['href']]
+            changed = True
+    return remove_html_head_body(u'%s' % soup) if changed else html
+
+
+URLMAP = {'http://test1.com?sid=1&chapter=1': 'file0001.xhtml',
+          'http://test1.com?sid=1&chapter=2': 'file0002.xhtml',
+          'file0003.xhtml': 'file0004.xhtml',
+          'http://test1.com/"q"': 'file0005.xhtml'}
+
+@pytest.mark.parametrize('html', [
+    u'<p>no links</p>',
+    u'<p><a href="http://test1.com?sid=1&amp;chapter=1">one</a> <a href="http://other.com">other</a></p>',
+    u'<p><a class="c" href="http://test1.com?sid=1&amp;chapter=2" id="x">two</a><a name="n">n</a></p>',
+    u'<a data-orighref="http://test1.com?sid=1&amp;chapter=2" href="file0009.xhtml">moved</a>',
+    u'<a data-orighref="http://other.com" href="http://test1.com?sid=1&amp;chapter=1">other</a>',
+    u'<a href="file0003.xhtml">internal</a><a href=\'http://test1.com/"q"\'>quote</a>',
+    u'<!-- <a href="file0003.xhtml"> --><script>s="<a href=\'file0003.xhtml\'>";</script><br/>',
+])
+@pytest.mark.parametrize('keep_orighref', [False, True])
+def test_internalize_links_same_as_soup(html, keep_orighref):
+    assert internalize_links(html, URLMAP, keep_orighref) == internalize_links_soup(html, URLMAP, keep_orighref)
+
+
+def test_get_link_hrefs():
+    assert get_link_hrefs(u'<a href="a?b=1&amp;c=2" data-orighref=\'d\'>x</a><A HREF=e>y</A><img src="f"/>'
+                          u'<!-- <a href="g"> -->') == set([u'a?b=1&c=2', u'd', u'e'])
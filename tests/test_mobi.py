@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import struct
+
+import pytest
+
+from fanficfare.mobi import Converter, PalmDocCompress
+from fanficfare import mobihtml
+from fanficfare.mobihtml import HtmlProcessor
+from fanficfare.six import ensure_binary
+from fanficfare.six.moves.urllib.parse import unquote
+
+
+def palmdoc_uncompress(data):
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i]
+        i += 1
+        if 1 <= c <= 8:
+            out += data[i:i+c]
+            i += c
+        elif c < 0x80:
+            out.append(c)
+        elif c < 0xC0:
+            pair = (c << 8) | data[i]
+            i += 1
+            for n in range((pair & 7) + 3):
+                out.append(out[-((pair >> 3) & 0x7FF)])
+        else:
+            out += bytearray([0x20, c ^ 0x80])
+    return bytes(out)
+
+
+def read_text(mobi):
+    count = struct.unpack('>H', mobi[76:78])[0]
+    offsets = [struct.unpack('>I', mobi[78+8*i:82+8*i])[0] for i in range(count)] + [len(mobi)]
+    record0 = mobi[offsets[0]:offsets[1]]
+    (compression, length) = struct.unpack('>H2xI', record0[:8])
+    assert struct.unpack('>H', record0[0xF2:0xF4])[0] == 1
+    text = b''
+    for i in range(1, count):
+        record = mobi[offsets[i]:offsets[i+1]]
+        # strip the trailing multibyte entry, keep its bytes of the
+        # next record's first character out of this one's text.
+        record = record[:-((bytearray(record[-1:])[0] & 3) + 1)]
+        text += palmdoc_uncompress(record) if compression == 2 else record
+    assert len(text) == length
+    return (compression, text)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'abc',
+    b'<p>the the the the the the the the</p> <p>the the</p>' * 50,
+    u'Café déjà vu, 魔法少女まどか★マギカ \x01\x02 \x00 @ ~'.encode('utf-8') * 80,
+    bytes(bytearray(range(256))) * 16,
+])
+def test_palmdoc_compress(data):
+    data = data[:4096]
+    assert palmdoc_uncompress(PalmDocCompress(data)) == data
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_converter_text_records(compress):
+    # mostly 3 byte characters, so records end in the middle of some.
+    paragraph = u'<p>“魔法少女まどか★マギカ” 魔法少女まどか★マギカ.</p>\n'
+    html = [b'<html><head><title>Title</title></head><body><p>Title page</p></body></html>'] + [
+        (u'<html><head><title>Chapter %d</title></head><body>%s</body></html>' % (i, paragraph * 200)).encode('utf-8')
+        for i in range(3)]
+    converter = Converter(compress=compress)
+    onehtml = converter.MakeOneHTML(html)
+    mobi = converter.ConvertString(onehtml)
+    (compression, text) = read_text(mobi)
+    assert compression == (2 if compress else 1)
+    assert text == HtmlProcessor(onehtml).CleanHtml()
+
+
+def test_converter_record0_header():
+    converter = Converter()
+    mobi = converter.ConvertString(converter.MakeOneHTML(
+        [b'<html><head><title>Title</title></head><body><p>Text</p></body></html>']))
+    offset = struct.unpack('>I', mobi[78:82])[0]
+    record0 = mobi[offset:]
+    assert struct.unpack('>H', record0[0:2])[0] == 2 # PalmDoc compression
+    assert record0[16:20] == b'MOBI'
+    header_len = struct.unpack('>I', record0[20:24])[0]
+    # extra_data_flags at 0xF2 is only read if the header covers it.
+    assert 16 + header_len >= 0xF4
+    assert struct.unpack('>H', record0[0xF2:0xF4])[0] == 1
+    # file version and min version, readers ignore extra_data_flags
+    # before version 5.
+    assert struct.unpack('>I', record0[0x24:0x28])[0] >= 5
+    assert struct.unpack('>I', record0[0x68:0x6C])[0] >= 5
+
+
+def fill_anchor_stubs_loop(assembled_text, anchor_references):
+    # previous implementation, a find and a replace per anchor.
+    for anchor_num, original_ref in anchor_references:
+        ref = unquote(original_ref[1:])
+        newpos = assembled_text.find(b'name="' + ensure_binary(ref))
+        if newpos == -1:
+            continue
+        newpos = assembled_text.rfind(b'<', 0, newpos)
+        old_filepos = b'filepos="%.10d"' % anchor_num
+        new_filepos = b'filepos="%.10d"' % newpos
+        assert assembled_text.find(old_filepos) != -1
+        assembled_text = assembled_text.replace(old_filepos, new_filepos, 1)
+    return assembled_text
+
+
+def test_fill_anchor_stubs_same_as_loop(monkeypatch):
+    html = [b'<html><head><title>Title</title></head><body><p>Title page</p></body></html>'] + [
+        (u'<html><head><title>Chapter %d</title></head><body><p><a href="#n1">n1</a> <a href="#n%%20x">space</a>'
+         u' <a href="#missing">missing</a> <a href="#n">prefix</a></p><p><a name="n10">10</a> <a name="n1">1</a>'
+         u' <a name="n x">x</a></p></body></html>' % i).encode('utf-8')
+        for i in range(5)]
+    onehtml = Converter().MakeOneHTML(html)
+    text = HtmlProcessor(onehtml).CleanHtml()
+    monkeypatch.setattr(mobihtml, '_FillAnchorStubs', fill_anchor_stubs_loop)
+    assert text == HtmlProcessor(onehtml).CleanHtml()
+    assert text.count(b'filepos="') == 26
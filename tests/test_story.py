@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+import os
+import string
+import threading
+import time
+from collections import defaultdict
+from io import BytesIO
+
+import pytest
+
+from fanficfare.configurable import Configuration
+from fanficfare import story as story_module
+from fanficfare.adapters.base_adapter import TimeKeeper
+from fanficfare.story import Story, MetadataCache, Chapter, ChapterView, ImageStore, SPLIT_META
+from fanficfare.story import ConvertedImageCache, convert_image_with_args
+
+REPLACE_METADATA = u"""genre=>^Fantasy$=>FANTASY
+genre=>^FANTASY$=>High Fantasy
+genre=>Sci-?Fi=>Science Fiction
+category,genre=>^(.*) AU$=>\\1
+genre=>^Romance$=>Romance\\,Love
+genre=>^Love$=>Feelings
+=>Humour=>Humor
+^Harry Potter$=>HP
+genre=>^Angst=>Hurt
+genre=>Angst$=>Pain
+genre=>^Drama$=>DRAMA&&category=>HP
+genre=>^Drama$=>Tragedy
+characters=>^Harry Potter$=>Harry
+characters=>^Harry$=>Harry James Potter
+genre=>(?i)^other$=>OTHER
+genre=>(o)\\1=>\\1
+genre=>^(?P<x>Dr)ama=>Tr
+genre=>^(?P<x>Ot)her=>Ot
+""" + u"".join(u"genre=>^Pad%d .$=>x\n" % i for i in range(70)) + u"""genre=>^OTHER$=>Done
+"""
+
+def make_story():
+    configuration = Configuration(['test1.com'], 'epub')
+    configuration.add_section('defaults')
+    configuration.set('defaults', 'replace_metadata', REPLACE_METADATA)
+    story = Story(configuration)
+    story.setMetadata('title', 'Title')
+    story.extendList('category', ['Harry Potter', 'Twilight AU'])
+    return story
+
+def doReplacements_loop(story, value, key, return_list=False, seen_list={}):
+    # previous line by line implementation, without include/exclude.
+    retlist = [value]
+    for (repl_line,metakeys,regexp,replacement,cond_match) in story.replacements:
+        if (metakeys == None or key in metakeys) \
+                and isinstance(value,str) \
+                and regexp.search(value):
+            if repl_line in seen_list:
+                continue
+            doreplace=True
+            if cond_match and cond_match.key() != key:
+                new_seen_list = dict(seen_list)
+                new_seen_list[repl_line]=True
+                condval = story.getMetadataForConditional(cond_match.key(),seen_list=new_seen_list)
+                doreplace = condval != None and cond_match.is_match(condval)
+            if doreplace:
+                if SPLIT_META in replacement:
+                    retlist = []
+                    for splitrepl in replacement.split(SPLIT_META):
+                        new_seen_list = dict(seen_list)
+                        new_seen_list[repl_line]=True
+                        retlist.extend(doReplacements_loop(story,
+                                                           regexp.sub(splitrepl,value),
+                                                           key,
+                                                           return_list=True,
+                                                           seen_list=new_seen_list))
+                    break
+                else:
+                    value = regexp.sub(replacement,value)
+                    retlist = [value]
+    if return_list:
+        return retlist
+    return story.join_list(key,retlist)
+
+@pytest.mark.parametrize('key', ['genre', 'category', 'characters', 'title'])
+@pytest.mark.parametrize('value', [
+    u'Fantasy', u'Fantasy\n', u'SciFi', u'Star Wars AU', u'Romance', u'Humour',
+    u'Harry Potter', u'Angst', u'Drama', u'Angst and Drama', u'Other', u'Boo', u'other', u'Pad65 x', None,
+])
+def test_doReplacements_same_as_loop(key, value):
+    story = make_story()
+    story.prepare_replacements()
+    assert story.doReplacements(value, key, return_list=True) == \
+        doReplacements_loop(story, value, key, return_list=True)
+
+
+def test_metadata_cache_invalidate():
+    cache = MetadataCache()
+    cache.add_dependencies('category', ['genre'])
+    cache.add_dependencies('genre', ['category'])
+    cache.add_dependencies('title', ['category_LIST'])
+    cache.add_dependencies('', ['status'])
+    for key in ('genre', 'category', 'title', 'author'):
+        cache.set_cached_scalar(key, False, True, key)
+        cache.set_cached_list(key, False, True, [key])
+    cache.invalidate('genre')
+    assert sorted(cache.processed_metadata_cache) == ['author']
+    assert sorted(cache.processed_metadata_list_cache) == ['author']
+    assert cache.is_cached_scalar('author', False, True)
+    assert not cache.is_cached_scalar('title', False, True)
+    cache.invalidate('status')
+    assert not cache.is_cached_list('author', False, True)
+    assert cache.counts_since({}) == 'hits:1 misses:2 (33% hits) invalidated:2 cleared:1'
+
+
+def test_getChapters_memo():
+    story = make_story()
+    story.configuration.set('defaults', 'add_chapter_numbers', 'toconly')
+    story.configuration.set('defaults', 'chapter_title_add_pattern', '${index}. ${title}')
+    story.configuration.set('defaults', 'replace_chapter_text', 'Lorem=>LOREM')
+    story.addChapter({'title': 'One Lorem', 'html': '<p>Lorem</p>'})
+    assert [ c['title'] for c in story.getChapters(fortoc=True) ] == ['One LOREM']
+    story.addChapter({'title': 'Two', 'html': '<p>ipsum</p>'}, newchap=True)
+    chapters = story.getChapters()
+    assert [ c['title'] for c in chapters ] == ['One LOREM', 'Two']
+    assert [ c['html'] for c in chapters ] == ['<p>LOREM</p>', '<p>ipsum</p>']
+    chapters[0]['html'] = 'changed'
+    assert [ c['title'] for c in story.getChapters(fortoc=True) ] == ['1. One LOREM', '2. Two']
+    assert story.getChapters()[0]['html'] == '<p>LOREM</p>'
+    assert story.getMetadata('marked_new_chapters') == '1'
+
+
+def test_chapter_mapping():
+    chapter = Chapter({'url': 'http://x', 'title': 'T', 'date': 'D'})
+    view = ChapterView(chapter)
+    assert view['missing'] == u'' and 'missing' not in view
+    assert string.Template('${title} ${date} ${html}.').substitute(view) == 'T D .'
+    view['title'] = 'Changed'
+    view['extra'] = 'E'
+    del view['url']
+    assert dict(view) == {'title': 'Changed', 'date': 'D', 'extra': 'E'}
+    assert dict(chapter) == {'url': 'http://x', 'title': 'T', 'date': 'D'}
+    assert dict(view.copy()) == dict(view)
+
+
+@pytest.mark.parametrize('make', [
+    lambda d: defaultdict(str, d),
+    Chapter,
+    lambda d: ChapterView(Chapter(d)),
+], ids=['defaultdict', 'Chapter', 'ChapterView'])
+def test_chapter_get_pop_setdefault(make):
+    chapter = make({'url': 'http://x', 'date': 'D'})
+    assert chapter.get('title', 'default') == 'default'
+    assert chapter.get('title') is None
+    assert chapter.get('url', 'default') == 'http://x'
+    assert chapter.pop('title', 'default') == 'default'
+    assert chapter.pop('date', 'default') == 'D'
+    with pytest.raises(KeyError):
+        chapter.pop('date')
+    assert chapter.setdefault('title', 'T') == 'T'
+    assert chapter.setdefault('url', 'changed') == 'http://x'
+    assert chapter.setdefault('extra', 'E') == 'E'
+    assert dict(chapter) == {'url': 'http://x', 'title': 'T', 'extra': 'E'}
+
+
+def test_chapter_store_spill():
+    story = make_story()
+    story.configuration.set('defaults', 'chapter_store_max_memory', '0.00002') # ~20 chars
+    story.configuration.set('defaults', 'replace_chapter_text', 'Lorem=>LOREM')
+    texts = [u'<p>Chapter %d Lorem ipsum ☺</p>' % i if i % 2 else u'<p>%d</p>' % i for i in range(6)]
+    for i, text in enumerate(texts):
+        story.addChapter({'title': 'Ch %d' % i, 'html': text})
+    assert story.chapter_store.tempfilestore.size > 0
+    assert [ c['html'] for c in story.getChapters() ] == [ t.replace('Lorem', 'LOREM') for t in texts ]
+
+
+def test_store_max_memory_not_a_number():
+    story = make_story()
+    story.configuration.set('defaults', 'chapter_store_max_memory', '1.5')
+    assert story.get_max_memory('chapter_store_max_memory') == 1572864
+    story.configuration.set('defaults', 'chapter_store_max_memory', 'lots')
+    assert story.get_max_memory('chapter_store_max_memory') is None
+    story.addChapter({'title': 'Ch', 'html': u'<p>text</p>'})
+    assert story.chapter_store.max_memory is None
+
+
+def test_story_close():
+    story = make_story()
+    story.configuration.set('defaults', 'chapter_store_max_memory', '0.00002') # ~20 chars
+    for i in range(3):
+        story.addChapter({'title': 'Ch %d' % i, 'html': u'<p>Chapter %d Lorem ipsum</p>' % i})
+    story.img_store.tempfilestore.put(b'data')
+    assert story.chapter_store.tempfilestore.tempfile is not None
+    story.close()
+    assert story.chapter_store.tempfilestore.tempfile is None
+    assert story.img_store.tempfilestore.tempfile is None
+    assert story.image_pool is None
+    story.close()
+
+
+def test_image_store_dedup_spill():
+    store = ImageStore(dedup=True, max_memory=10)
+    first = store.add_img('http://x/1.jpg', 'jpg', 'image/jpeg', b'12345678')
+    second = store.add_img('http://x/2.jpg', 'jpg', 'image/jpeg', b'abcdefgh')
+    dup = store.add_img('http://x/3.jpg', 'jpg', 'image/jpeg', b'abcdefgh', actuallyused=False)
+    assert dup is second
+    assert store.tempfilestore.size == 8
+    assert store.get_img_by_url('http://x/3.jpg') is second
+    assert store.get_img_by_url('http://x/2.jpg')['data'] == b'abcdefgh'
+    assert store.get_img_by_url(second['newsrc']) is second
+    assert [ (i['url'], i['data']) for i in store.get_imgs() ] == \
+        [('http://x/1.jpg', b'12345678'), ('http://x/2.jpg', b'abcdefgh')]
+
+
+def test_converted_image_cache(tmp_path, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    if not story_module.image_converter:
+        pytest.skip('no image converter')
+    out = BytesIO()
+    Image.new('RGB', (40, 20), 'red').save(out, 'PNG')
+    data = out.getvalue()
+    cache = ConvertedImageCache(str(tmp_path), 10**6)
+    args = ([20, 20], False, True, 'jpg', '#ffffff', 95)
+    converted = convert_image_with_args('http://x/1.png', data, args, cache)
+    assert converted[1:] == ('jpg', 'image/jpeg')
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError('converted again')
+    monkeypatch.setattr(story_module, 'convert_image', fail)
+    assert convert_image_with_args('http://x/2.png', data, args, cache) == converted
+    # different args, different key.
+    with pytest.raises(AssertionError):
+        convert_image_with_args('http://x/1.png', data, ([10, 10],) + args[1:], cache)
+
+    # least recently used evicted first.
+    cache.max_size = len(converted[0]) + 3
+    old = cache.make_key(b'old', args)
+    cache.put(old, (b'old', 'jpg', 'image/jpeg'))
+    past = time.time() - 100
+    os.utime(os.path.join(str(tmp_path), old + '.jpg'), (past, past))
+    cache.put(cache.make_key(b'new', args), (b'new', 'jpg', 'image/jpeg'))
+    assert cache.get(old, args) is None
+    assert cache.get(cache.make_key(b'new', args), args) == (b'new', 'jpg', 'image/jpeg')
+    # recently hit, kept.
+    assert cache.get(cache.make_key(data, args), args) == converted
+
+
+def test_convert_image_stages():
+    Image = pytest.importorskip('PIL.Image')
+    if story_module.image_converter != 'pillow':
+        pytest.skip('needs Pillow convert_image')
+    out = BytesIO()
+    Image.new('RGB', (4000, 6000), 'blue').save(out, 'JPEG')
+    times = TimeKeeper()
+    (data, ext, mime) = story_module.convert_image('http://x/1.jpg', out.getvalue(), [580, 725],
+                                                   True, True, 'jpg', times=times)
+    img = Image.open(BytesIO(data))
+    assert (img.size, img.mode, ext) == ((483, 725), 'L', 'jpg')
+    assert sorted(times) == ['convert_image->decode', 'convert_image->encode',
+                             'convert_image->grayscale', 'convert_image->resize']
+
+    # opaque RGBA png doesn't need re-encoding for remove_transparency.
+    out = BytesIO()
+    Image.new('RGBA', (40, 20), (255, 0, 0, 255)).save(out, 'PNG')
+    data = out.getvalue()
+    assert story_module.convert_image('http://x/2.png', data, [580, 725],
+                                      False, True, 'png')[0] is data
+
+
+def test_image_conversion_threads(monkeypatch):
+    lock = threading.Lock()
+    converted = []
+    def convert(url, data, args, converted_image_cache=None, times=None):
+        with lock:
+            converted.append(url)
+        time.sleep(0.01 if '1' in url else 0.03) # finish out of order
+        if 'bad' in url:
+            raise IOError('cannot convert')
+        return (b'converted ' + data, 'gif', 'image/gif')
+    monkeypatch.setattr(story_module, 'convert_image_with_args', convert)
+    def fetch(url, referer=None, image=False):
+        return url.encode('utf-8')
+    urls = ['/0.gif', '/1.gif', '/bad.gif', '/0.gif', '/2.gif', '/bad.gif', '/1.gif']
+
+    def add_imgs(threads):
+        del converted[:]
+        story = make_story()
+        story.configuration.set('defaults', 'image_conversion_threads', threads)
+        story.cover = 'images/cover.jpg' # no first image cover
+        pending = [ story.addImgUrl('http://a.com/story', url, fetch, pending=True) for url in urls ]
+        if threads != '0':
+            assert story.pending_imgs
+        results = [ finish() for finish in pending ]
+        story.close_image_pool()
+        assert not story.pending_imgs
+        images = [ (i['url'], i['newsrc'], i['data']) for i in story.img_store.get_imgs() ]
+        return (results, images, sorted(converted))
+
+    serial = add_imgs('0')
+    threaded = add_imgs('3')
+    assert threaded == serial
+    (results, images, converted_urls) = threaded
+    assert converted_urls == ['http://a.com/0.gif', 'http://a.com/1.gif', 'http://a.com/2.gif', 'http://a.com/bad.gif']
+    assert results[2] == ('failedtoload http://a.com/bad.gif', '')
+    assert results[5][0] == 'failedtoload http://a.com/bad.gif'
+    assert results[0] == results[3] and results[1] == results[6]
+    assert [ url for (url, newsrc, data) in images ] == \
+        ['http://a.com/0.gif', 'http://a.com/1.gif', 'http://a.com/2.gif']
+
+
+def test_prefetch_img_urls():
+    story = make_story()
+    story.configuration.set('defaults', 'image_prefetch_threads', '6')
+    story.configuration.set('defaults', 'image_prefetch_per_host', '2')
+    story.configuration.set('defaults', 'no_image_processing', 'true')
+    story.cover = 'images/cover.jpg' # no first image cover
+    lock = threading.Lock()
+    active = {}
+    most = {}
+    def fetch(url, referer=None, image=False):
+        host = url.split('/')[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            most[host] = max(most.get(host, 0), active[host])
+        time.sleep(0.02)
+        with lock:
+            active[host] -= 1
+        if 'missing' in url:
+            raise IOError('404')
+        return b'GIF89a' + url.encode('utf-8')
+    urls = [ 'http://a.com/%d.gif' % i for i in range(5) ] + \
+        [ 'http://b.com/%d.gif' % i for i in range(3) ] + \
+        [ '/missing.gif', 'http://a.com/0.gif', 'data:image/gif;base64,R0lGODlh' ]
+    story.prefetch_img_urls('http://b.com/story', [ (url, fetch) for url in urls ])
+    assert most == {'a.com': 2, 'b.com': 2}
+    assert len(story.prefetched_imgs) == 9
+
+    def no_fetch(url, referer=None, image=False):
+        raise AssertionError('not prefetched')
+    assert story.addImgUrl('http://b.com/story', 'http://a.com/3.gif', no_fetch)[1] == 'http://a.com/3.gif'
+    assert story.img_store.get_img_by_url('http://a.com/3.gif')['data'] == b'GIF89ahttp://a.com/3.gif'
+    assert story.addImgUrl('http://b.com/story', '/missing.gif', no_fetch) == \
+        ('failedtoload http://b.com/missing.gif', '')
+    story.clear_prefetched_imgs()
+    assert story.prefetched_imgs == {}
+
+
+@pytest.mark.parametrize('setting', ['use_nsapa_proxy', 'use_cloudscraper', 'use_browser_cache'])
+def test_prefetch_img_urls_not_thread_safe(setting):
+    story = make_story()
+    story.configuration.set('defaults', 'image_prefetch_threads', '6')
+    story.configuration.set('defaults', setting, 'true')
+    story.configuration.browser_cache = object() # not used, no fetch.
+    def fetch(url, referer=None, image=False):
+        raise AssertionError('not fetched in turn')
+    story.prefetch_img_urls('http://b.com/story', [ ('http://a.com/0.gif', fetch) ])
+    assert story.prefetched_imgs == {}
@@ -0,0 +1,208 @@
+import os
+import re
+import zipfile
+
+import pytest
+
+from fanficfare import adapters, writers
+from fanficfare.configurable import Configuration
+
+DEFAULTS_INI = os.path.join(os.path.dirname(__file__), '..', 'fanficfare', 'defaults.ini')
+
+
+def make_writer(writeformat='epub', url='http://test1.com?sid=12', **settings):
+    config = Configuration(adapters.getConfigSectionsFor(url), writeformat)
+    config.read([DEFAULTS_INI])
+    config.set('overrides', 'is_adult', 'true')
+    for key, value in settings.items():
+        config.set('overrides', key, value)
+    adapter = adapters.getAdapter(config, url)
+    return writers.getWriter(writeformat, config, adapter)
+
+
+def test_epub_written_in_place(tmp_path):
+    outfilename = str(tmp_path / 'story.epub')
+    make_writer().writeStory(outfilename=outfilename, forceOverwrite=True)
+    assert os.listdir(str(tmp_path)) == ['story.epub']
+    with open(outfilename, 'rb') as f:
+        assert f.read(58)[30:] == b'mimetypeapplication/epub+zip'
+    epub = zipfile.ZipFile(outfilename)
+    assert epub.testzip() is None
+    assert epub.getinfo('mimetype').compress_type == zipfile.ZIP_STORED
+    assert epub.getinfo('content.opf').compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_failed_write_keeps_old_file(tmp_path):
+    outfilename = str(tmp_path / 'story.epub')
+    with open(outfilename, 'wb') as f:
+        f.write(b'old')
+    writer = make_writer()
+    def fail(out):
+        out.write(b'partial')
+        raise IOError('disk full')
+    writer.writeStoryImpl = fail
+    with pytest.raises(IOError):
+        writer.writeStory(outfilename=outfilename, forceOverwrite=True)
+    assert os.listdir(str(tmp_path)) == ['story.epub']
+    with open(outfilename, 'rb') as f:
+        assert f.read() == b'old'
+
+
+def test_zip_compression_levels(tmp_path):
+    writer = make_writer(zip_compression_levels='jpg:0, PNG:0,xhtml:9,bad,css:x')
+    assert writer.get_zip_compression_level('OEBPS/images/cover.JPG') == 0
+    assert writer.get_zip_compression_level('OEBPS/images/ffdl-1.png') == 0
+    assert writer.get_zip_compression_level('OEBPS/file0001.xhtml') == 9
+    assert writer.get_zip_compression_level('OEBPS/stylesheet.css') is None
+    assert writer.get_zip_compression_level('mimetype') is None
+
+    outfilename = str(tmp_path / 'story.epub')
+    make_writer(zip_compression_levels='opf:0,*:1').writeStory(outfilename=outfilename, forceOverwrite=True)
+    epub = zipfile.ZipFile(outfilename)
+    assert epub.getinfo('content.opf').compress_type == zipfile.ZIP_STORED
+    assert epub.getinfo('toc.ncx').compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_epub_write_threads(tmp_path):
+    # same writer both times, test1 chapters include the time.
+    writer = make_writer(url='http://test1.com?sid=6', epub_version='3.0')
+    epubs = []
+    for threads in ('', '3'):
+        outfilename = str(tmp_path / ('story%s.epub' % threads))
+        writer.configuration.set('overrides', 'epub_write_threads', threads)
+        writer.writeStory(outfilename=outfilename, forceOverwrite=True)
+        epubs.append(zipfile.ZipFile(outfilename))
+    (serial, threaded) = epubs
+    assert threaded.testzip() is None
+    assert serial.namelist() == threaded.namelist()
+    for (info, tinfo) in zip(serial.infolist(), threaded.infolist()):
+        if info.filename.startswith('OEBPS/file'):
+            assert serial.read(info) == threaded.read(tinfo)
+            assert (info.compress_type, info.compress_size, info.external_attr) == \
+                (tinfo.compress_type, tinfo.compress_size, tinfo.external_attr)
+    def manifest(epub):
+        return re.sub(br'dcterms:modified">[^<]*', b'', epub.read('content.opf'))
+    assert manifest(serial) == manifest(threaded)
+
+
+@pytest.mark.parametrize('threads', ['', '2'])
+def test_update_copies_unchanged_chapters(tmp_path, threads):
+    from fanficfare.epubutils import get_update_data
+
+    def write(outfilename, oldepub=None, last=None, **settings):
+        writer = make_writer(url='http://test1.com?sid=6', epub_write_threads=threads, **settings)
+        adapter = writer.adapter
+        if last:
+            adapter.setChaptersRange('1', last)
+        if oldepub:
+            (url, chaptercount,
+             adapter.oldchapters,
+             adapter.oldimgs,
+             adapter.oldcover,
+             adapter.calibrebookmark,
+             adapter.logfile,
+             adapter.oldchaptersmap,
+             adapter.oldchaptersdata) = get_update_data(oldepub)[0:9]
+            adapter.oldepub = oldepub
+        # old chapters processed again and chapters fetched.
+        (remade, fetched) = ([], [])
+        utf8FromSoup = adapter.utf8FromSoup
+        getChapterText = adapter.getChapterText
+        def spy_utf8FromSoup(url, soup, *args, **kwargs):
+            if url is None:
+                remade.append(soup)
+            return utf8FromSoup(url, soup, *args, **kwargs)
+        def spy_getChapterText(url):
+            fetched.append(url)
+            return getChapterText(url)
+        adapter.utf8FromSoup = spy_utf8FromSoup
+        adapter.getChapterText = spy_getChapterText
+        writer.writeStory(outfilename=outfilename, forceOverwrite=True)
+        return (len(remade), len(fetched))
+
+    oldfilename = str(tmp_path / 'old.epub')
+    newfilename = str(tmp_path / 'new.epub')
+    otherfilename = str(tmp_path / 'other.epub')
+    assert write(oldfilename, last='2') == (0, 2)
+    assert write(newfilename, oldepub=oldfilename) == (0, 7)
+
+    old = zipfile.ZipFile(oldfilename)
+    new = zipfile.ZipFile(newfilename)
+    assert new.testzip() is None
+    for filename in ('OEBPS/file0001.xhtml', 'OEBPS/file0002.xhtml'):
+        assert new.read(filename) == old.read(filename)
+        assert new.getinfo(filename).comment == old.getinfo(filename).comment
+    assert new.getinfo('OEBPS/file0003.xhtml').comment
+    assert b'file0003.xhtml' in new.read('content.opf')
+
+    # different settings, old chapters made again.
+    assert write(otherfilename, oldepub=oldfilename, chapter_end='<p>end</p></body></html>') == (2, 7)
+    other = zipfile.ZipFile(otherfilename)
+    assert b'<p>end</p>' in other.read('OEBPS/file0001.xhtml')
+    assert other.getinfo('OEBPS/file0001.xhtml').comment != old.getinfo('OEBPS/file0001.xhtml').comment
+
+
+def test_pretty_xml_writer_same_as_minidom():
+    from xml.dom.minidom import getDOMImplementation
+    from fanficfare.writers.writer_epub import PrettyXMLWriter, newTag
+
+    dom = getDOMImplementation().createDocument(None, "package", None)
+    dom.documentElement.setAttribute("version", "2.0")
+    metadata = newTag(dom, "metadata", attrs={"xmlns:dc": "http://purl.org/dc/elements/1.1/"})
+    dom.documentElement.appendChild(metadata)
+    metadata.appendChild(newTag(dom, "dc:title", attrs={"id": "id"}, text=u'A & B <C> –'))
+    metadata.appendChild(newTag(dom, "dc:rights", text=u''))
+    metadata.appendChild(newTag(dom, "meta", attrs={"name": "a&b", "content": u'"x" <y>'}))
+    dom.documentElement.appendChild(newTag(dom, "spine", attrs={"toc": "ncx"}))
+
+    xml = PrettyXMLWriter()
+    xml.start("package", [("version", "2.0")])
+    xml.start("metadata", attrs={"xmlns:dc": "http://purl.org/dc/elements/1.1/"})
+    xml.element("dc:title", attrs={"id": "id"}, text=u'A & B <C> –')
+    xml.element("dc:rights", text=u'')
+    xml.element("meta", attrs={"name": "a&b", "content": u'"x" <y>'})
+    xml.end()
+    xml.start("spine", attrs={"toc": "ncx"})
+    xml.end()
+    xml.end()
+    assert xml.getvalue() == dom.toprettyxml(encoding='utf-8')
+
+
+ZIPINFO_ATTRS = ('filename', 'date_time', 'compress_type', 'comment', 'extra', 'create_system',
+                 'create_version', 'extract_version', 'reserved', 'flag_bits', 'volume',
+                 'internal_attr', 'external_attr', 'header_offset', 'CRC', 'compress_size', 'file_size')
+
+def test_zip_write_compressed_same_as_writestr():
+    from io import BytesIO
+    from fanficfare.writers.base_writer import can_write_compressed, zip_write_compressed
+
+    writer = make_writer(zip_compression_levels='png:0,xhtml:9')
+    entries = [('OEBPS/file0001.xhtml', b'<p>Chapter text.</p>\n' * 500),
+               ('OEBPS/images/ffdl-0.png', bytes(bytearray(range(256))) * 40),
+               (u'OEBPS/st\u00e9.css', b'p { margin: 0; }'),
+               ('OEBPS/empty.xhtml', b'')]
+    compressed_out = BytesIO()
+    writestr_out = BytesIO()
+    compressed_zip = zipfile.ZipFile(compressed_out, 'w', compression=zipfile.ZIP_DEFLATED)
+    writestr_zip = zipfile.ZipFile(writestr_out, 'w', compression=zipfile.ZIP_DEFLATED)
+    assert can_write_compressed(compressed_zip)
+    for (filename, data) in entries:
+        (zinfo, compressed) = writer.zip_compress(filename, data)
+        zinfo.comment = b'key'
+        zip_write_compressed(compressed_zip, zinfo, compressed)
+        same = zipfile.ZipInfo(filename, date_time=zinfo.date_time)
+        same.external_attr = zinfo.external_attr
+        same.compress_type = zinfo.compress_type
+        same.comment = b'key'
+        writestr_zip.writestr(same, data, compresslevel=writer.get_zip_compression_level(filename))
+    compressed_zip.close()
+    writestr_zip.close()
+
+    compressed_zip = zipfile.ZipFile(BytesIO(compressed_out.getvalue()))
+    writestr_zip = zipfile.ZipFile(BytesIO(writestr_out.getvalue()))
+    assert compressed_zip.testzip() is None
+    for (info, sinfo) in zip(compressed_zip.infolist(), writestr_zip.infolist()):
+        assert [getattr(info, a) for a in ZIPINFO_ATTRS] == [getattr(sinfo, a) for a in ZIPINFO_ATTRS]
+        assert compressed_zip.read(info) == writestr_zip.read(sinfo)
+    assert len(compressed_zip.infolist()) == len(writestr_zip.infolist()) == len(entries)
+    assert compressed_out.getvalue() == writestr_out.getvalue()